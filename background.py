@@ -0,0 +1,79 @@
+import cv2 as cv
+import numpy as np
+
+# intensity and texture thresholds of empty tiles per stain:
+# bright_background - glass is bright (brightfield) or dark (fluorescence)
+# intensity - gray level separating tissue from background
+# min_saturation - pixels with higher HSV saturation are tissue too (brightfield only), 0 disables
+# min_tissue - smallest tissue fraction of a non-empty tile
+# min_texture - smallest standard deviation of the Laplacian of a non-empty tile
+# step - subsampling of the tile before the statistics are computed
+STAINS = {
+    'brightfield': {'bright_background': True, 'intensity': 220, 'min_saturation': 25, 'min_tissue': 0.02,
+                    'min_texture': 2.0, 'step': 4},
+    'he': {'bright_background': True, 'intensity': 210, 'min_saturation': 30, 'min_tissue': 0.02,
+           'min_texture': 2.0, 'step': 4},
+    'fluorescence': {'bright_background': False, 'intensity': 25, 'min_saturation': 0, 'min_tissue': 0.002,
+                     'min_texture': 1.0, 'step': 4},
+}
+
+
+class BackgroundDetector:
+    """
+    Cheap pre-filter marking glass and background tiles as empty, so they are not passed to the networks.
+    A tile is empty if it has too few tissue pixels or almost no texture.
+
+    Parameters
+    ----------
+    stain : str
+        Key of STAINS with default thresholds.
+    params
+        Thresholds overriding the stain defaults, see STAINS.
+    """
+
+    def __init__(self, stain='brightfield', **params):
+        if stain not in STAINS:
+            raise ValueError(f'Unknown stain {stain}, use one of {list(STAINS)}')
+        self.stain = stain
+        self.params = dict(STAINS[stain], **params)
+        self.reset_stats()
+
+    def tile_stats(self, tile):
+        """
+        Parameters
+        ----------
+        tile : numpy ndarray
+            BGR uint8 tile, see inference.prepare_tile.
+
+        Returns
+        -------
+        tissue : float
+            Fraction of tissue pixels.
+        texture : float
+            Standard deviation of the Laplacian of the gray tile.
+        """
+        p = self.params
+        small = np.ascontiguousarray(tile[::p['step'], ::p['step']])
+        gray = cv.cvtColor(small, cv.COLOR_BGR2GRAY)
+        if p['bright_background']:
+            tissue = gray < p['intensity']
+            if p['min_saturation']:
+                tissue |= cv.cvtColor(small, cv.COLOR_BGR2HSV)[..., 1] > p['min_saturation']
+        else:
+            tissue = gray > p['intensity']
+        return float(tissue.mean()), float(cv.Laplacian(gray, cv.CV_32F).std())
+
+    def is_empty(self, tile):
+        tissue, texture = self.tile_stats(tile)
+        empty = tissue < self.params['min_tissue'] or texture < self.params['min_texture']
+        self.checked += 1
+        self.skipped += empty
+        return empty
+
+    def reset_stats(self):
+        self.checked = 0
+        self.skipped = 0
+
+    def report(self):
+        share = self.skipped / self.checked if self.checked else 0
+        return f'background ({self.stain}): skipped {self.skipped} of {self.checked} tiles ({share:.0%})'
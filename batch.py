@@ -0,0 +1,283 @@
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from datetime import datetime
+from pathlib import Path
+
+# directories of dsb2018_topcoders which are used as working directories or parents of outputs,
+# they are recreated in every workspace, everything else is linked
+SHADOW_DIRS = ['.', 'selim', 'victor', 'albu', os.path.join('albu', 'src')]
+# outputs of predict_test.sh, never shared between jobs
+OUTPUT_DIRS = ['data_test', 'predictions', os.path.join('albu', 'results_test')]
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+_segmenter = None
+_worker_options = {}
+
+
+def shadow_network_dir(network_dir, workspace_dir):
+    """
+    Creates a private copy of dsb2018_topcoders for one job without copying anything large:
+    the directories the scripts run in are real, their contents are symlinks to network_dir.
+    The scripts resolve '../data_test', '../predictions' and '../results_test' relative to their
+    working directory, so they end up in the workspace.
+
+    Parameters
+    ----------
+    network_dir : str
+        Full path to dsb2018_topcoders.
+    workspace_dir : str
+        Full path to the new directory.
+
+    Returns
+    -------
+    workspace_dir : str
+    """
+    network_dir = Path(network_dir).resolve()
+    workspace_dir = Path(workspace_dir)
+    for rel in SHADOW_DIRS:
+        os.makedirs(workspace_dir / rel, exist_ok=True)
+        for entry in os.listdir(network_dir / rel):
+            rel_entry = os.path.normpath(os.path.join(rel, entry))
+            if rel_entry in SHADOW_DIRS or rel_entry in OUTPUT_DIRS or entry == '__pycache__':
+                continue
+            if not os.path.lexists(workspace_dir / rel_entry):
+                os.symlink(network_dir / rel_entry, workspace_dir / rel_entry)
+    return str(workspace_dir)
+
+
+def available_memory():
+    """
+    Available physical memory in bytes.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def pool_size(jobs, threads_per_job=4, memory_per_job=16 * 2 ** 30):
+    """
+    Number of workers the machine can keep busy: limited by the cores, the available memory and the number of jobs.
+    """
+    by_cores = (os.cpu_count() or 1) // threads_per_job
+    by_memory = available_memory() // memory_per_job
+    return int(max(1, min(by_cores, by_memory, jobs)))
+
+
+@contextlib.contextmanager
+def _thread_env(threads):
+    # OpenMP and MKL read their thread counts when numpy and torch are imported, which a spawned worker may do
+    # before _init_worker runs, so the workers get them from the environment they are started with
+    saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(threads) for var in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _init_worker(network_dir, threads_per_job, cache_dir, progress=None, segmenter_class=None):
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads_per_job)
+    import cv2 as cv
+    cv.setNumThreads(threads_per_job)
+    _worker_options.update(network_dir=network_dir, cache_dir=cache_dir, progress=progress,
+                           segmenter_class=segmenter_class)
+
+
+def _run_job(job, debug, segmentation_kwargs):
+    global _segmenter
+    import data_tools
+
+    started = time.time()
+    cpu_started = time.process_time()
+    result = {'started': datetime.now().isoformat(timespec='seconds'), 'pid': os.getpid()}
+    if _worker_options.get('progress') is not None:
+        _worker_options['progress'].put((job['name'], dict(result, status='running')))
+    try:
+        network_dir = _worker_options['network_dir']
+        sample_dir = os.path.join(job['workspace'], job['name'])
+        if debug:
+            network_dir = shadow_network_dir(network_dir, os.path.join(job['workspace'], 'dsb2018_topcoders'))
+            segmenter = None
+        else:
+            if _segmenter is None:
+                segmenter_class = _worker_options.get('segmenter_class')
+                if segmenter_class is None:
+                    from inference import Segmenter as segmenter_class
+                _segmenter = segmenter_class(network_dir, cache=_worker_options['cache_dir'])
+            segmenter = _segmenter
+        # labels are streamed into the stitched labels.npy, debug runs keep their tiles in the workspace
+        labels_path = os.path.join(job['workspace'], 'labels.npy')
+        labels, tile_names = data_tools.perform_segmentation(job['slide'], sample_dir, network_dir, force=True,
+                                                             debug=debug, segmenter=segmenter,
+                                                             labels_out=None if debug else labels_path,
+                                                             **segmentation_kwargs)
+        if labels is not None:
+            result['labels'] = labels_path
+            del labels
+        result['tiles'] = len(tile_names)
+        result['status'] = 'done'
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    result['finished'] = datetime.now().isoformat(timespec='seconds')
+    result['wall_s'] = round(time.time() - started, 3)
+    result['cpu_s'] = round(time.process_time() - cpu_started, 3)
+    return result
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _update_running(progress, jobs):
+    # jobs picked up by a worker since the last call, a finished job is not set back to running
+    updated = False
+    while not progress.empty():
+        name, update = progress.get()
+        if jobs[name]['status'] == 'queued':
+            jobs[name].update(update)
+            updated = True
+    return updated
+
+
+def _fail_lost(jobs):
+    # a pool replaces a killed worker (e.g. out of memory) but never returns a result for its job
+    lost = [job for job in jobs.values() if job['status'] == 'running' and not _alive(job['pid'])]
+    for job in lost:
+        job.update(status='failed', error=f"worker {job['pid']} exited",
+                   finished=datetime.now().isoformat(timespec='seconds'))
+        print(f"{job['name']}: {job['status']}")
+    return bool(lost)
+
+
+def _write_manifest(path, manifest):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def run_batch(slides, out_dir, network_dir, workers=None, threads_per_job=4, memory_per_job=16 * 2 ** 30,
+              debug=False, cache_dir=None, segmenter_class=None, **segmentation_kwargs):
+    """
+    Segments many slides at once, every slide in its own workspace out_dir/<slide name>.
+    Jobs run on a process pool, each worker loads the models once and keeps them for its next slides.
+    In debug mode every job gets a shadow copy of network_dir (see shadow_network_dir), so the on-disk
+    layouts of concurrent jobs do not collide. The manifest out_dir/manifest.json is rewritten
+    whenever a job starts (status 'running' with its start time) or finishes.
+
+    Parameters
+    ----------
+    slides : list
+        Paths to slides.
+    out_dir : str
+        Full path to directory for workspaces and the manifest.
+    network_dir : str
+        Full path to dsb2018_topcoders.
+    workers : int
+        Number of processes, by default pool_size(len(slides), threads_per_job, memory_per_job).
+    threads_per_job : int
+        Threads of every worker (OpenMP, MKL, OpenCV).
+    memory_per_job : int
+        Memory one worker needs, bytes.
+    debug : bool
+        Use the on-disk layout and predict_test.sh, see perform_segmentation.
+    cache_dir : str
+        Tile cache shared by all workers, see tile_cache.TileCache.
+    segmenter_class : callable
+        Called as segmenter_class(network_dir, cache=cache_dir) once in every worker to load the models,
+        inference.Segmenter by default. It is pickled to the workers, so use a module-level class or a
+        functools.partial of one (e.g. partial(Segmenter, precision=...)).
+    segmentation_kwargs
+        Passed to perform_segmentation (features, tile_size, halo).
+
+    Returns
+    -------
+    manifest : dict
+        Per-slide status and timings, also saved to out_dir/manifest.json.
+        The restored label image of a slide is saved to <workspace>/labels.npy,
+        results of the debug mode stay in <workspace>/<slide name>_segmented.
+    """
+    out_dir = os.path.abspath(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    network_dir = os.path.abspath(network_dir)
+    if workers is None:
+        workers = pool_size(len(slides), threads_per_job, memory_per_job)
+
+    jobs = []
+    names = set()
+    for slide in slides:
+        name = os.path.splitext(os.path.basename(slide))[0]
+        while name in names:
+            name += '_'
+        names.add(name)
+        jobs.append({'slide': os.path.abspath(slide), 'name': name, 'workspace': os.path.join(out_dir, name),
+                     'status': 'queued'})
+
+    manifest = {'network_dir': network_dir, 'workers': workers, 'started': datetime.now().isoformat(timespec='seconds'),
+                'jobs': jobs}
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    _write_manifest(manifest_path, manifest)
+
+    started = time.time()
+    context = multiprocessing.get_context('spawn')
+    # workers report the jobs they pick up on progress, the pool's result thread puts finished jobs to results.
+    # SimpleQueue.put writes before the job starts, a worker killed during the job has reported it
+    progress = context.SimpleQueue()
+    results = queue.Queue()
+    by_name = {job['name']: job for job in jobs}
+
+    def on_error(name):
+        def put(error):
+            results.put((name, {'status': 'failed', 'error': ''.join(
+                traceback.format_exception(type(error), error, error.__traceback__))}))
+        return put
+
+    # the pool starts replacement workers too, so the environment is kept until it is closed
+    with _thread_env(threads_per_job), \
+            context.Pool(workers, initializer=_init_worker,
+                         initargs=(network_dir, threads_per_job, cache_dir, progress, segmenter_class)) as pool:
+        for job in jobs:
+            os.makedirs(job['workspace'], exist_ok=True)
+            pool.apply_async(_run_job, (job, debug, segmentation_kwargs),
+                             callback=lambda result, name=job['name']: results.put((name, result)),
+                             error_callback=on_error(job['name']))
+        while any(job['status'] in ('queued', 'running') for job in jobs):
+            try:
+                name, result = results.get(timeout=1)
+            except queue.Empty:
+                name = None
+            updated = _update_running(progress, by_name)
+            if name is not None:
+                by_name[name].update(result)
+                print(f"{name}: {result['status']} {result.get('wall_s', '')}")
+                updated = True
+            updated = _fail_lost(by_name) or updated
+            if updated:
+                _write_manifest(manifest_path, manifest)
+
+    manifest['finished'] = datetime.now().isoformat(timespec='seconds')
+    manifest['wall_s'] = round(time.time() - started, 3)
+    _write_manifest(manifest_path, manifest)
+    return manifest
@@ -0,0 +1,68 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class BatchStats:
+    """
+    Shapes, batches and throughput of predict_buckets calls.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.shapes = OrderedDict()
+        self.batches = 0
+        self.items = 0
+        self.seconds = 0.
+
+    def add(self, shape, items, seconds):
+        self.shapes[shape] = self.shapes.get(shape, 0) + items
+        self.batches += 1
+        self.items += items
+        self.seconds += seconds
+
+    def report(self):
+        rate = self.items / self.seconds if self.seconds else 0
+        lines = [f'{self.items} inputs in {self.batches} batches of {len(self.shapes)} shapes, {rate:.2f} inputs/s']
+        lines += [f'  {"x".join(map(str, shape))}: {items}' for shape, items in self.shapes.items()]
+        return '\n'.join(lines)
+
+
+def predict_buckets(predict, inputs, batch_size=4, stats=None):
+    """
+    Runs predict on inputs grouped by shape, so every call gets a full batch of equally shaped inputs
+    and networks with (None, None, C) inputs see few distinct shapes.
+
+    Parameters
+    ----------
+    predict : callable
+        Takes an array of stacked inputs and returns one output per input.
+    inputs : list
+        Arrays of any shapes.
+    batch_size : int
+        Largest number of inputs passed to predict at once.
+    stats : BatchStats
+        Updated with every batch.
+
+    Returns
+    -------
+    outputs : list
+        Outputs in the order of inputs.
+    """
+    buckets = OrderedDict()
+    for i, x in enumerate(inputs):
+        buckets.setdefault(x.shape, []).append(i)
+    outputs = [None] * len(inputs)
+    for shape, indexes in buckets.items():
+        for start in range(0, len(indexes), batch_size):
+            batch = indexes[start:start + batch_size]
+            t0 = time.perf_counter()
+            preds = predict(np.stack([inputs[i] for i in batch]))
+            if stats is not None:
+                stats.add(shape, len(batch), time.perf_counter() - t0)
+            for i, pred in zip(batch, preds):
+                outputs[i] = pred
+    return outputs
@@ -0,0 +1,63 @@
+"""
+CPU throughput of the albu configs of predict_test.sh, one fold each, on random tiles.
+
+    python benchmarks/bench_albu_cpu.py --network-dir dsb2018_topcoders
+    python benchmarks/bench_albu_cpu.py --network-dir dsb2018_topcoders --threads 4 --batch-size 2 --tta flips
+
+Weights are read from albu/weights/<folder>/fold0_best.pth as in AlbuPredictor. A tile costs one forward pass
+per transform of --tta for every fold, so multiply the time by 4 for the full ensemble of one config.
+'eager' is the model as trained, 'frozen' the same model after pytorch_utils.freeze (batch norms folded into
+convolutions, traced and frozen), 'max diff' the largest difference of their sigmoid outputs.
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from inference import ALBU_CONFIGS, family_context
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--network-dir', required=True)
+    parser.add_argument('--configs', nargs='+', default=ALBU_CONFIGS)
+    parser.add_argument('--tile-size', type=int, default=1024, help='padded tile size, a multiple of 32')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--threads', type=int, help='torch intra-op threads, the torch default if not set')
+    parser.add_argument('--interop-threads', type=int)
+    parser.add_argument('--tta', default='none', help='policy of tta.py')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    network_dir = os.path.abspath(args.network_dir)
+    rows = []
+    for config_name in args.configs:
+        with family_context(network_dir, 'albu'):
+            albu_eval = importlib.import_module('pytorch_utils.eval')
+            torch = importlib.import_module('torch')
+            albu_eval.set_threads(args.threads, args.interop_threads)
+            with open(os.path.join('configs', f'{config_name}.json')) as f:
+                config = json.load(f)
+            albu_freeze = importlib.import_module('pytorch_utils.freeze')
+            model = albu_eval.read_model(config['folder'], 0, 'cpu', frozen=False)
+        rng = np.random.RandomState(0)
+        batch = torch.from_numpy(rng.rand(args.batch_size, config['num_channels'], args.tile_size,
+                                          args.tile_size).astype(np.float32))
+        frozen = albu_freeze.freeze(model, batch)
+        walls = []
+        for m in [model, frozen]:
+            albu_eval.predict(m, batch, transforms=args.tta, device='cpu')
+            walls.append(min(timeit.repeat(lambda: albu_eval.predict(m, batch, transforms=args.tta, device='cpu'),
+                                           number=1, repeat=args.repeat)))
+        rows.append((config_name, torch.get_num_threads(), *walls, albu_freeze.max_difference(model, frozen, batch)))
+
+    print(f'{args.tile_size}x{args.tile_size} tiles, batch {args.batch_size}, tta {args.tta}, one fold')
+    print(f'{"config":<24}{"threads":>8}{"eager, s":>10}{"frozen, s":>11}{"tiles/s":>9}{"speedup":>9}{"max diff":>10}')
+    for config_name, threads, eager, frozen, difference in rows:
+        print(f'{config_name:<24}{threads:>8}{eager:>10.3f}{frozen:>11.3f}{args.batch_size / frozen:>9.3f}'
+              f'{eager / frozen:>9.2f}{difference:>10.1e}')
@@ -0,0 +1,53 @@
+"""
+Resident memory of a Segmenter that keeps only --max-loaded models loaded: every pass of the tiles through the
+ensemble loads and drops the other models, so the RSS after each pass stays flat only if dropped models are freed.
+
+    python benchmarks/bench_eviction.py --network-dir dsb2018_topcoders --image test_img.jpg --max-loaded 2
+
+The RSS after the first pass is the baseline, the script fails if a later pass grows it by more than --max-growth.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from data_tools import split_image
+from inference import Segmenter, prepare_tile
+from slides import read_image
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--network-dir', required=True)
+    parser.add_argument('--image', required=True, help='slide to split into tiles')
+    parser.add_argument('--tile-size', type=int, default=1000)
+    parser.add_argument('--tiles', type=int, default=4, help='tiles passed through the ensemble at once')
+    parser.add_argument('--max-loaded', type=int, default=2)
+    parser.add_argument('--passes', type=int, default=5)
+    parser.add_argument('--max-growth', type=float, default=256, help='MB allowed above the first pass')
+    args = parser.parse_args()
+
+    tiles, _ = split_image(read_image(args.image), x_tile_size=args.tile_size, y_tile_size=args.tile_size)
+    tiles = [prepare_tile(tile) for tile in tiles[:args.tiles]]
+    segmenter = Segmenter(os.path.abspath(args.network_dir), lazy=True, max_loaded=args.max_loaded)
+
+    print(f'{len(tiles)} tiles of {args.tile_size} px, {args.max_loaded} of {len(segmenter.predictors)} models loaded')
+    print(f'{"pass":>4}{"wall, s":>10}{"loads":>7}{"evictions":>11}{"RSS, MB":>10}')
+    rss = []
+    for i in range(args.passes):
+        t0 = timeit.default_timer()
+        segmenter.predict_merged(tiles)
+        rss.append(rss_mb())
+        print(f'{i:>4}{timeit.default_timer() - t0:>10.1f}{segmenter.predictors.loads:>7}'
+              f'{segmenter.predictors.evictions:>11}{rss[-1]:>10.0f}')
+    growth = max(rss) - rss[0]
+    print(f'RSS growth after the first pass {growth:.0f} MB')
+    if growth > args.max_growth:
+        sys.exit(f'RSS grew by more than {args.max_growth:.0f} MB, dropped models are not freed')
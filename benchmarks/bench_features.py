@@ -0,0 +1,81 @@
+"""
+Wall time of NucleiFeatures.compute_tile on a synthetic label tile.
+
+    python benchmarks/bench_features.py
+    python benchmarks/bench_features.py --tile-size 1000 --nuclei 2000 --features position size ellipse color
+
+'per label' is the previous implementation (a full-tile mask and every feature function per label),
+'one pass' is compute_tile. Both must give the same rows; cv.fitEllipse computes in float32, so ellipses
+fitted on crops differ from full-tile ones by rounding, and degenerate (line-like) contours are only compared
+where both fits have both axes above 1 pixel.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import cv2 as cv
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from features import NucleiFeatures, get_x_and_y
+
+
+def make_tile(tile_size, nuclei, seed=0):
+    rng = np.random.RandomState(seed)
+    img = np.zeros((tile_size, tile_size), dtype=np.uint16)
+    for i, (x, y, a, b, angle) in enumerate(zip(rng.randint(0, tile_size, nuclei), rng.randint(0, tile_size, nuclei),
+                                                rng.randint(3, 12, nuclei), rng.randint(3, 12, nuclei),
+                                                rng.randint(0, 180, nuclei)), 1):
+        cv.ellipse(img, (int(x), int(y)), (int(a), int(b)), int(angle), 0, 360, i, -1)
+    orig = rng.randint(0, 256, (tile_size, tile_size, 3)).astype(np.uint8)
+    return img, orig
+
+
+def compute_tile_per_label(nf, img, orig, filename):
+    img = np.flip(np.rot90(img, k=3), axis=1)
+    orig = np.flip(np.rot90(orig, k=3), axis=1)
+    x_tile, y_tile = get_x_and_y(filename)
+    computed_features = []
+    for i in range(1, img.max()):
+        tmp_img = (img == i)
+        tmp = []
+        for f in nf.features:
+            tmp += nf.feature_dict[f][0](tmp_img, orig, x_tile=x_tile, y_tile=y_tile)
+        computed_features.append(tmp)
+    return computed_features
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tile-size', type=int, default=1000)
+    parser.add_argument('--nuclei', type=int, default=2000)
+    parser.add_argument('--features', nargs='+', default=['position', 'size', 'ellipse', 'color'])
+    parser.add_argument('--repeat', type=int, default=5, help='runs of the one pass engine')
+    args = parser.parse_args()
+
+    img, orig = make_tile(args.tile_size, args.nuclei)
+    filename = 'sample_3_2'
+    nf = NucleiFeatures(None, None, args.features, x_min=100, y_min=200)
+
+    t0 = timeit.default_timer()
+    reference = np.array(compute_tile_per_label(nf, img, orig, filename), dtype=float)
+    per_label = timeit.default_timer() - t0
+    one_pass = min(timeit.repeat(lambda: nf.compute_tile(img, orig, filename), number=1, repeat=args.repeat))
+    rows = np.array(nf.compute_tile(img, orig, filename), dtype=float)
+
+    assert rows.shape == reference.shape
+    exact = np.ones(rows.shape[1], dtype=bool)
+    if 'ellipse' in nf.features:
+        start = nf.feature_names.index('first_axis')
+        exact[start:start + 5] = False
+        fitted = (reference[:, start:start + 2] > 1).all(axis=1) & (rows[:, start:start + 2] > 1).all(axis=1)
+        np.testing.assert_allclose(rows[fitted, start:start + 4], reference[fitted, start:start + 4], rtol=1e-2, atol=0.05)
+    np.testing.assert_allclose(rows[:, exact], reference[:, exact], rtol=1e-6, atol=1e-6, equal_nan=True)
+
+    print(f'{args.tile_size}x{args.tile_size} tile, {len(rows)} labels, features {" ".join(args.features)}')
+    print(f'{"engine":<10}{"wall, s":>12}')
+    print(f'{"per label":<10}{per_label:>12.3f}')
+    print(f'{"one pass":<10}{one_pass:>12.3f}')
+    print(f'speedup {per_label / one_pass:.0f}x')
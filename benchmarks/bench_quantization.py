@@ -0,0 +1,130 @@
+"""
+CPU inference of the selim and albu networks with their int8 models against fp32: time per tile, speedup and
+the Kaggle AP (selim/metric.py calc_score) of single models on labelled tiles.
+
+    python benchmarks/bench_quantization.py --network-dir dsb2018_topcoders --tiles stage1_train_sample
+    python benchmarks/bench_quantization.py --network-dir dsb2018_topcoders --tiles data_test --albu resnet_softmax_s2
+
+Make the int8 models first with selim/quantize_models.sh and albu/src/quantize_models.sh.
+Tiles are laid out as the test data (<id>/images/<id>.png). With masks (<id>/masks/*.png, one nucleus per file as
+in the DSB training data) AP is computed against them, otherwise against the fp32 labels, so the int8 AP then
+says how well int8 reproduces fp32. Labels are the connected components of nucleus and not border as in the first
+step of victor/train_classifier.py, without the watershed and LightGBM steps.
+"""
+import argparse
+import importlib
+import os
+import sys
+import timeit
+
+# CPU inference for keras as well
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+import cv2 as cv
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from inference import ALBU_CONFIGS, SELIM_NETWORKS, AlbuPredictor, SelimPredictor, family_context
+
+# victor/merge_test.py swapped_folders, predictions with the nucleus in the last channel
+SWAPPED_FOLDERS = ['dpn_sigm_f0_test']
+
+
+def read_tiles(folder, limit=None):
+    tiles = []
+    truths = []
+    for tile_id in sorted(os.listdir(folder))[:limit]:
+        tile = cv.imread(os.path.join(folder, tile_id, 'images', f'{tile_id}.png'), cv.IMREAD_COLOR)
+        mask_dir = os.path.join(folder, tile_id, 'masks')
+        truth = None
+        if os.path.isdir(mask_dir):
+            truth = np.zeros(tile.shape[:2], dtype=np.int32)
+            for i, mask_name in enumerate(sorted(os.listdir(mask_dir)), 1):
+                truth[cv.imread(os.path.join(mask_dir, mask_name), cv.IMREAD_GRAYSCALE) > 0] = i
+        tiles.append(tile)
+        truths.append(truth)
+    return tiles, truths
+
+
+def label_prediction(pred, swapped=False, min_area=10):
+    if swapped:
+        pred = pred[..., ::-1]
+    pred = pred.astype(np.float32) / 255
+    nuclei = (pred[..., 0] * (1 - pred[..., 1]) > 0.5).astype(np.uint8)
+    _, labels, stats, _ = cv.connectedComponentsWithStats(nuclei, connectivity=8)
+    small = stats[:, cv.CC_STAT_AREA] < min_area
+    small[0] = False
+    labels[small[labels]] = 0
+    return labels
+
+
+def mean_ap(calc_score, truths, labels):
+    scores = [1.0 if truth.max() == 0 and label.max() == 0 else calc_score(truth, label)
+              for truth, label in zip(truths, labels)]
+    return float(np.mean(scores))
+
+
+def time_predictor(predictor, tiles, repeat):
+    predictor.predict(tiles[:1])
+    preds = None
+    walls = []
+    for _ in range(repeat):
+        t0 = timeit.default_timer()
+        preds = predictor.predict(tiles)
+        walls.append(timeit.default_timer() - t0)
+    return preds, min(walls) / len(tiles)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--network-dir', required=True)
+    parser.add_argument('--tiles', required=True, help='folder laid out as the test data, masks are optional')
+    parser.add_argument('--limit', type=int, help='number of tiles')
+    parser.add_argument('--selim', nargs='*', help='output folders of SELIM_NETWORKS, all of them without names')
+    parser.add_argument('--albu', nargs='*', help='albu configs, ALBU_CONFIGS without names; both families '
+                                                  'if neither is given')
+    parser.add_argument('--threads', type=int, help='torch threads, the torch default if not set')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.selim is None and args.albu is None:
+        args.selim, args.albu = [], []
+    network_dir = os.path.abspath(args.network_dir)
+    tiles, truths = read_tiles(args.tiles, args.limit)
+    with family_context(network_dir, 'selim'):
+        calc_score = importlib.import_module('metric').calc_score
+
+    models = []
+    if args.selim is not None:
+        for params in SELIM_NETWORKS:
+            if not args.selim or params[3] in args.selim:
+                models.append((params[3], lambda precision, params=params: SelimPredictor(network_dir, *params,
+                                                                                           precision=precision)))
+    if args.albu is not None:
+        for config_name in args.albu or ALBU_CONFIGS:
+            models.append((config_name, lambda precision, config_name=config_name: AlbuPredictor(
+                network_dir, config_name, device='cpu', precision=precision)))
+    if args.threads:
+        with family_context(network_dir, 'albu'):
+            importlib.import_module('pytorch_utils.eval').set_threads(args.threads)
+
+    rows = []
+    for name, make_predictor in models:
+        labels = {}
+        walls = {}
+        for precision in ['fp32', 'int8']:
+            predictor = make_predictor(precision)
+            preds, walls[precision] = time_predictor(predictor, tiles, args.repeat)
+            labels[precision] = [label_prediction(pred, predictor.name in SWAPPED_FOLDERS) for pred in preds]
+            del predictor, preds
+        reference = [truth if truth is not None else label for truth, label in zip(truths, labels['fp32'])]
+        aps = {precision: mean_ap(calc_score, reference, labels[precision]) for precision in labels}
+        rows.append((name, walls['fp32'], walls['int8'], aps['fp32'], aps['int8']))
+
+    with_masks = sum(truth is not None for truth in truths)
+    print(f'{len(tiles)} tiles, {with_masks} with masks, AP of the others against the fp32 labels')
+    print(f'{"model":<28}{"fp32, s":>9}{"int8, s":>9}{"speedup":>9}{"fp32 AP":>9}{"int8 AP":>9}{"AP delta":>10}')
+    for name, fp32, int8, fp32_ap, int8_ap in rows:
+        print(f'{name:<28}{fp32:>9.3f}{int8:>9.3f}{fp32 / int8:>9.2f}{fp32_ap:>9.4f}{int8_ap:>9.4f}'
+              f'{int8_ap - fp32_ap:>+10.4f}')
@@ -0,0 +1,88 @@
+"""
+Peak memory and wall time of restore_image on a synthetic mosaic of label tiles.
+
+    python benchmarks/bench_restore.py
+    python benchmarks/bench_restore.py --tiles 10 --tile-size 1000 --halo 64
+
+'stack' is the previous implementation (every tile read, shifted copies, np.hstack per row and np.vstack),
+'memory' writes into a preallocated array, 'npy' and 'tif' into a disk-backed memmap.
+Peak memory is measured with tracemalloc, which sees numpy buffers but not memmap pages.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import cv2 as cv
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import data_tools
+import slides
+
+
+def make_tiles(work_dir, tiles, tile_size, halo, nuclei=1500, seed=0):
+    rng = np.random.RandomState(seed)
+    mask = np.zeros((tiles * tile_size, tiles * tile_size), dtype=np.uint8)
+    for x, y, r in zip(rng.randint(0, mask.shape[1], nuclei * tiles ** 2),
+                       rng.randint(0, mask.shape[0], nuclei * tiles ** 2), rng.randint(4, 10, nuclei * tiles ** 2)):
+        cv.circle(mask, (int(x), int(y)), int(r), 1, -1)
+    tile_list, tile_names = data_tools.split_image(mask, x_tiles_cnt=tiles, y_tiles_cnt=tiles, halo=halo)
+    for tile, name in zip(tile_list, tile_names):
+        cv.imwrite(os.path.join(work_dir, f'{name}.tif'), cv.connectedComponents(tile)[1].astype(np.uint16))
+
+
+def restore_stack(work_dir):
+    file_names = os.listdir(work_dir)
+    tiles = dict(zip([data_tools.get_x_and_y(n) for n in file_names],
+                     [cv.imread(os.path.join(work_dir, n), -1) for n in file_names]))
+    x_max, y_max = np.array(list(tiles.keys())).max(axis=0)
+    max_number = 0
+    for coords in sorted(tiles.keys(), key=lambda x: x[::-1]):
+        tmp = tiles[coords].astype(np.uint32)
+        tmp = (tmp + max_number) * (tmp > 0)
+        max_number = max(max_number, int(tmp.max()))
+        tiles[coords] = tmp.copy()
+    return np.vstack([np.hstack([tiles[(x, y)] for x in range(x_max + 1)]) for y in range(y_max + 1)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tiles', type=int, default=10, help='tiles along each axis')
+    parser.add_argument('--tile-size', type=int, default=1000)
+    parser.add_argument('--halo', type=int, default=0)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    work_dir = os.path.join(tmp_dir, 'tiles')
+    os.makedirs(work_dir)
+    make_tiles(work_dir, args.tiles, args.tile_size, args.halo)
+
+    modes = ['memory', 'npy'] + (['tif'] if slides.tifffile is not None else [])
+    if args.halo == 0:
+        modes = ['stack'] + modes
+
+    print(f'{args.tiles ** 2} tiles of {args.tile_size}x{args.tile_size}, halo {args.halo}')
+    print(f'{"mode":<10}{"wall, s":>12}{"peak, MB":>12}')
+    reference = None
+    for mode in modes:
+        tracemalloc.start()
+        t0 = timeit.default_timer()
+        if mode == 'stack':
+            img = restore_stack(work_dir)
+        else:
+            out = None if mode == 'memory' else os.path.join(tmp_dir, f'mosaic.{mode}')
+            img = data_tools.restore_image(work_dir, tiff=True, halo=args.halo, out=out)
+        elapsed = timeit.default_timer() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if reference is None:
+            reference = np.array(img)
+        assert (reference == img).all()
+        del img
+        print(f'{mode:<10}{elapsed:>12.2f}{peak / 2 ** 20:>12.1f}')
+    shutil.rmtree(tmp_dir)
@@ -0,0 +1,84 @@
+"""
+Wall time and bytes written per slide for the in-memory and the on-disk (debug) segmentation modes.
+
+    python benchmarks/bench_segmentation_io.py test_img.jpg --network-dir dsb2018_topcoders
+    python benchmarks/bench_segmentation_io.py test_img.jpg --network-dir dsb2018_topcoders --skip-inference
+
+With --skip-inference only tile staging is measured: split_image, prepare_test_data and the copy to
+network_dir/data_test for the on-disk mode, split_image and prepare_tile for the in-memory mode.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+from distutils import dir_util
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import data_tools
+from inference import Segmenter, prepare_tile
+from slides import read_image
+
+
+def dir_size(path):
+    if not os.path.isdir(path):
+        return 0
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+def written_bytes(sample_dir, network_dir):
+    dirs = [sample_dir, f'{sample_dir}_segmented', os.path.join(network_dir, 'data_test'),
+            os.path.join(network_dir, 'predictions'), os.path.join(network_dir, 'albu', 'results_test')]
+    return sum(dir_size(d) for d in dirs)
+
+
+def clean(sample_dir, network_dir):
+    for d in [sample_dir, f'{sample_dir}_segmented', os.path.join(network_dir, 'data_test')]:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def stage_on_disk(image_path, sample_dir, network_dir):
+    tiles, tile_names = data_tools.split_image(read_image(image_path), x_tile_size=1000, y_tile_size=1000)
+    data_tools.prepare_test_data(tiles, tile_names, sample_dir, force=True)
+    os.makedirs(os.path.join(network_dir, 'data_test'), exist_ok=True)
+    dir_util.copy_tree(sample_dir, os.path.join(network_dir, 'data_test'))
+    return len(tiles)
+
+
+def stage_in_memory(image_path):
+    tiles, tile_names = data_tools.split_image(read_image(image_path), x_tile_size=1000, y_tile_size=1000)
+    return len([prepare_tile(tile) for tile in tiles])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image')
+    parser.add_argument('--network-dir', required=True)
+    parser.add_argument('--skip-inference', action='store_true')
+    parser.add_argument('--repeats', type=int, default=1)
+    args = parser.parse_args()
+
+    network_dir = os.path.abspath(args.network_dir)
+    sample_dir = os.path.join(tempfile.mkdtemp(), 'bench_sample')
+    segmenter = None if args.skip_inference else Segmenter(network_dir)
+
+    print(f'{"mode":<10}{"wall, s":>12}{"written, MB":>16}')
+    for mode in ['disk', 'memory']:
+        for _ in range(args.repeats):
+            clean(sample_dir, network_dir)
+            t0 = timeit.default_timer()
+            if args.skip_inference:
+                if mode == 'disk':
+                    stage_on_disk(args.image, sample_dir, network_dir)
+                else:
+                    stage_in_memory(args.image)
+            else:
+                data_tools.perform_segmentation(args.image, sample_dir, network_dir, force=True,
+                                                debug=mode == 'disk', segmenter=segmenter)
+            elapsed = timeit.default_timer() - t0
+            written = written_bytes(sample_dir, network_dir)
+            print(f'{mode:<10}{elapsed:>12.2f}{written / 2 ** 20:>16.1f}')
+    clean(sample_dir, network_dir)
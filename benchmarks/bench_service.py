@@ -0,0 +1,121 @@
+"""
+Load generator for segmentation_service.py: concurrent clients send tiles of a slide and the client-side
+throughput and latency percentiles are printed together with the /metrics of the service.
+
+    python benchmarks/bench_service.py --network-dir dsb2018_topcoders --image test_img.jpg --clients 16
+    python benchmarks/bench_service.py --socket /tmp/segmentation.sock --image test_img.jpg --requests 200
+
+With --network-dir a service is started in this process on a temporary UNIX socket with --max-batch and
+--max-delay, otherwise the running service at --socket or --port is used.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from data_tools import split_image
+from inference import Segmenter
+from segmentation_service import SegmentationClient, SegmentationService
+from slides import read_image
+
+
+def run_clients(address, tiles, clients, requests, rle=False):
+    """
+    Sends requests tiles, taken round-robin from tiles, from clients threads with one connection each.
+
+    Returns
+    -------
+    latencies : list
+        Seconds of every request.
+    wall : float
+        Seconds from the first request to the last response.
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def client():
+        with SegmentationClient(address) as connection:
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                t0 = timeit.default_timer()
+                try:
+                    connection.segment(tiles[i % len(tiles)], rle=rle)
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+                    return
+                with lock:
+                    latencies.append(timeit.default_timer() - t0)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    t0 = timeit.default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = timeit.default_timer() - t0
+    if errors:
+        raise errors[0]
+    return latencies, wall
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--network-dir', help='start a service in this process')
+    address.add_argument('--socket', help='UNIX socket of a running service')
+    address.add_argument('--port', type=int, help='TCP port of a running service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--image', required=True, help='slide to split into tiles')
+    parser.add_argument('--tile-size', type=int, default=1000)
+    parser.add_argument('--tiles', type=int, help='number of distinct tiles, all tiles of the image if not set')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--rle', action='store_true', help='ask for run lengths instead of label images')
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--max-delay', type=float, default=0.05)
+    parser.add_argument('--lazy', action='store_true')
+    parser.add_argument('--max-loaded', type=int)
+    args = parser.parse_args()
+
+    tiles, _ = split_image(read_image(args.image), x_tile_size=args.tile_size, y_tile_size=args.tile_size)
+    tiles = tiles[:args.tiles]
+
+    service = None
+    if args.network_dir:
+        segmenter = Segmenter(os.path.abspath(args.network_dir), lazy=args.lazy, max_loaded=args.max_loaded)
+        address = os.path.join(tempfile.mkdtemp(), 'segmentation.sock')
+        service = SegmentationService(address, segmenter, args.max_batch, args.max_delay)
+        threading.Thread(target=service.serve_forever, daemon=True).start()
+    else:
+        address = args.socket or (args.host, args.port)
+
+    try:
+        # warm-up, so model loading and first-call compilation are not measured
+        run_clients(address, tiles, 1, 1, args.rle)
+        latencies, wall = run_clients(address, tiles, args.clients, args.requests, args.rle)
+        with SegmentationClient(address) as client:
+            metrics = client.metrics()
+    finally:
+        if service is not None:
+            service.shutdown()
+            service.server_close()
+
+    p50, p90, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 90, 99])
+    print(f'{len(tiles)} distinct tiles of {args.tile_size} px, {args.clients} clients, {args.requests} requests')
+    print(f'throughput {len(latencies) / wall:.2f} tiles/s, latency p50 {p50:.0f} ms, p90 {p90:.0f} ms, '
+          f'p99 {p99:.0f} ms')
+    print('service metrics:')
+    print(json.dumps(metrics, indent=2))
@@ -1,15 +1,22 @@
 import os
 import subprocess
+from collections import deque
 from distutils import dir_util
 from pathlib import Path
 
 import cv2 as cv
 import numpy as np
 from PIL import Image
-from matplotlib import pyplot as plt
 from tqdm import tqdm
 
+from background import BackgroundDetector
 from features import NucleiFeatures
+from image_cache import CACHE_ENV
+from inference import Segmenter, prepare_tile
+from prediction_store import STORE_ENV
+from slides import TileWindows, create_slide, open_slide
+from stitching import crop_halo, merge_labels, overlap_label_pairs, sequential_lut
+from tracing import span
 
 Image.MAX_IMAGE_PIXELS = None
 
@@ -19,16 +26,18 @@ def get_x_and_y(name):
     return int(x), int(y)
 
 
-def split_image(img, x_tiles_cnt=None, y_tiles_cnt=None, x_tile_size=None, y_tile_size=None, base='img'):
+def split_image(img, x_tiles_cnt=None, y_tiles_cnt=None, x_tile_size=None, y_tile_size=None, base='img', halo=0):
     """
     Splits an image array to smaller tiles for further segmentation.
     Specify tiles count OR tiles size.
     X axis means the arr.shape[1] coordinate, be careful!
     Tile names are used to restore the initial image after segmentation.
+    With halo > 0 every tile is extended by halo pixels of its neighbours so nuclei on the tile border
+    are segmented with context, pass the same halo to restore_image.
 
     Parameters
     ----------
-    img : numpy ndarray
+    img : numpy ndarray or slides.TiffSource
         The input image.
     x_tiles_cnt : integer
         Number of tiles along the x axis of img.
@@ -40,6 +49,8 @@ def split_image(img, x_tiles_cnt=None, y_tiles_cnt=None, x_tile_size=None, y_til
         Size of tile along y axis.
     base : str
         Base for tile names.
+    halo : integer
+        Overlap of neighbouring tiles on each side, must be smaller than the tile size.
 
     Returns
     -------
@@ -59,13 +70,22 @@ def split_image(img, x_tiles_cnt=None, y_tiles_cnt=None, x_tile_size=None, y_til
     else:
         raise Exception('Specify tiles count OR tiles size.')
 
-    tiles = []
+    if halo > 0 and (halo >= np.diff(x_ticks).min() or halo >= np.diff(y_ticks).min()):
+        raise ValueError(f'halo {halo} must be smaller than the tile size')
+
+    windows = []
     tile_names = []
 
     for x_num, x in enumerate(zip(x_ticks[:-1], x_ticks[1:])):
         for y_num, y in enumerate(zip(y_ticks[:-1], y_ticks[1:])):
-            tiles.append(img[y[0]:y[1], x[0]:x[1]])
+            windows.append((max(y[0] - halo, 0), min(y[1] + halo, img.shape[0]),
+                            max(x[0] - halo, 0), min(x[1] + halo, img.shape[1])))
             tile_names.append(f'{base}_{x_num}_{y_num}')
+
+    if isinstance(img, np.ndarray):
+        tiles = [img[y0:y1, x0:x1] for y0, y1, x0, x1 in windows]
+    else:
+        tiles = TileWindows(img, windows)
     return tiles, tile_names
 
 
@@ -107,7 +127,7 @@ def prepare_test_data(tiles, tile_names, base_dir, force=False):
         cv.imwrite(str(base_dir / name / 'images' / f'{name}.png'), tile)
 
 
-def restore_image(work_dir, tiff=False):
+def restore_image(work_dir, tiff=False, halo=0, out=None):
     """
     Restores the initial image.
 
@@ -117,6 +137,10 @@ def restore_image(work_dir, tiff=False):
         Full path to directory with files.
     tiff : bool
         Is the target image a multilayer tiff or not
+    halo : integer
+        Halo used in split_image.
+    out : numpy ndarray or str
+        Where to write the image, see restore_tiles.
 
     Returns
     -------
@@ -127,48 +151,406 @@ def restore_image(work_dir, tiff=False):
 
     work_dir = Path(work_dir)
 
-    file_names = sorted(os.listdir(work_dir), key=lambda x: get_x_and_y(x)[::-1])
-    coords = np.array([get_x_and_y(n) for n in file_names])
-    x_max, y_max = coords.max(axis=0)
-
-    if tiff:
-        tiles = {}
-        max_number = int(0)
-        for n in file_names:
-            tmp = cv.imread(str(work_dir / n), -1)
-            tmp = (tmp + max_number) * (tmp > 0)
-            max_number = tmp.max()
-            tiles[get_x_and_y(n)] = tmp.copy()
+    files = {get_x_and_y(n): str(work_dir / n) for n in os.listdir(work_dir)}
+    shapes = {}
+    for coords, file in files.items():
+        with Image.open(file) as header:
+            shapes[coords] = header.size[::-1]
+    mosaic = _Mosaic(shapes, tiff, halo, out)
+    for coords in sorted(files, key=_row_major):
+        mosaic.add(coords, cv.imread(files[coords], -1))
+    return mosaic.close()
+
+
+def restore_tiles(tiles, tile_names, tiff=False, halo=0, out=None, shapes=None):
+    """
+    Restores the initial image from tile arrays.
+    The image is allocated once and every tile is written to its place, so tiles can be read one by one.
+    Halos are cropped, for label images the nuclei cut by a seam are merged:
+    labels of neighbouring tiles which mark the same nucleus in their common halo area
+    are joined with union-find and the result is renumbered to 1..n.
+
+    Parameters
+    ----------
+    tiles : iterable
+        Tiles in the order of tile_names.
+    tile_names : list
+        List of tile names from split_image. The left and top neighbours of a tile have to come before it,
+        as split_image and row by row orders do.
+    tiff : bool
+        Are the tiles label images or not, labels of every tile are shifted to stay unique
+        and the result is uint32.
+    halo : integer
+        Halo used in split_image.
+    out : numpy ndarray or str
+        Preallocated array or path to a disk-backed result, '.npy' or BigTIFF '.tif' (needs tifffile).
+        A new array is allocated if None.
+    shapes : list
+        Height and width of every tile. If given, tiles may be an iterator and only the current tile is kept
+        in memory; labels are then numbered in the order of the tiles. Otherwise tiles are collected to read
+        their shapes and restored row by row.
+
+    Returns
+    -------
+    img : numpy ndarray
+        Initial image
+    """
+    coords = [get_x_and_y(n) for n in tile_names]
+    if shapes is None:
+        by_coords = dict(zip(coords, tiles))
+        shapes = {c: tile.shape for c, tile in by_coords.items()}
+        coords = sorted(by_coords, key=_row_major)
+        tiles = [by_coords[c] for c in coords]
     else:
-        tiles = {get_x_and_y(n): cv.imread(str(work_dir / n), -1) for n in file_names}
+        shapes = dict(zip(coords, shapes))
+    mosaic = _Mosaic(shapes, tiff, halo, out)
+    for tile_coords, tile in zip(coords, tiles):
+        mosaic.add(tile_coords, tile)
+    return mosaic.close()
+
+
+def _row_major(coords):
+    x, y = coords
+    return y, x
+
+
+class _Mosaic:
+    # Tiles written one by one into the restored image, see restore_tiles. Only the halo strips of the
+    # tiles waiting for their right and bottom neighbours are kept.
+
+    def __init__(self, shapes, tiff, halo, out):
+        self.x_max, self.y_max = np.array(list(shapes.keys())).max(axis=0)
+        self.tiff = tiff
+        self.halo = halo
+        self.out = out
+
+        def cropped(size, i, i_max):
+            return size - (halo if i > 0 else 0) - (halo if i < i_max else 0)
+
+        self.y_ticks = np.cumsum([0] + [cropped(shapes[(0, y)][0], y, self.y_max) for y in range(self.y_max + 1)])
+        self.x_ticks = np.cumsum([0] + [cropped(shapes[(x, 0)][1], x, self.x_max) for x in range(self.x_max + 1)])
+        self.img = None
+        self.max_number = 0
+        self.pairs = [np.zeros((0, 2), dtype=np.int64)]
+        self.right_strips = {}
+        self.bottom_strips = {}
+
+    def add(self, coords, tile):
+        x, y = coords
+        halo = self.halo
+        if self.img is None:
+            dtype = np.uint32 if self.tiff else tile.dtype
+            self.img = _allocate_mosaic(self.out, (self.y_ticks[-1], self.x_ticks[-1]) + tile.shape[2:], dtype)
+
+        if self.tiff:
+            tile_max = int(tile.max())
+            tile = tile.astype(np.uint32)
+            np.add(tile, self.max_number, out=tile, where=tile > 0)
+            self.max_number += tile_max
+            if halo:
+                if x > 0:
+                    self.pairs.append(overlap_label_pairs(self.right_strips.pop((x - 1, y)), tile[:, :2 * halo]))
+                if y > 0:
+                    self.pairs.append(overlap_label_pairs(self.bottom_strips.pop((x, y - 1)), tile[:2 * halo, :]))
+                if x < self.x_max:
+                    self.right_strips[coords] = tile[:, -2 * halo:].copy()
+                if y < self.y_max:
+                    self.bottom_strips[coords] = tile[-2 * halo:, :].copy()
+
+        if halo:
+            tile = crop_halo(tile, x, y, self.x_max, self.y_max, halo)
+        self.img[self.y_ticks[y]:self.y_ticks[y + 1], self.x_ticks[x]:self.x_ticks[x + 1]] = tile
+
+    def close(self):
+        img = self.img
+        if self.tiff and self.halo:
+            lut = merge_labels(np.concatenate(self.pairs), self.max_number)
+            windows = [(slice(y0, y1), slice(x0, x1)) for y0, y1 in zip(self.y_ticks[:-1], self.y_ticks[1:])
+                       for x0, x1 in zip(self.x_ticks[:-1], self.x_ticks[1:])]
+            present = np.zeros(self.max_number + 1, dtype=bool)
+            for window in windows:
+                present[img[window]] = True
+            lut = sequential_lut(lut, present).astype(np.uint32)
+            for window in windows:
+                img[window] = lut[img[window]]
+        return img
+
+
+def _allocate_mosaic(out, shape, dtype):
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if isinstance(out, np.ndarray):
+        if out.shape != shape:
+            raise ValueError(f'out has shape {out.shape}, expected {shape}')
+        return out
+    return create_slide(str(out), shape, dtype)
+
+
+def perform_segmentation(full_img_path, sample_dir, network_dir, force=False, features=None, debug=False,
+                         segmenter=None, tile_size=1000, halo=0, cache_dir=None, background=None,
+                         features_format='csv', prediction_store=None, labels_out=None):
+    """
+    Segments nuclei on a whole image.
+    The slide is opened with slides.open_slide, so .npy, .raw and TIFF slides are read tile by tile.
+    By default the tiles are passed to the networks in memory and nothing but the features table is written.
+    With debug=True the old on-disk layout is used: tiles are written to sample_dir, copied to
+    network_dir/data_test, predict_test.sh is run and all predictions are copied to sample_dir + '_segmented'.
+    With halo > 0 the tiles overlap and features are computed on the stitched label image,
+    so nuclei on tile borders are counted once.
+    With labels_out set, labels are streamed tile by tile into a stitched label image and memory holds
+    a few tiles besides the models.
+    With background set, glass and background tiles are not segmented: they get all-zero labels
+    (in debug mode all-zero tiles are written to the lgbm_test and color_test folders) and no features.
 
-    long_tiles = []
+    Parameters
+    ----------
+    full_img_path : str
+        Path to the image, or a slide already opened with slides.open_slide (e.g. a .raw file).
+    sample_dir : str
+        Full path to directory for tiles, sample_dir + '_segmented' is used for results.
+    network_dir : str
+        Full path to dsb2018_topcoders.
+    force : bool
+        Rewrite existing files in debug mode.
+    features : list or str
+        Features to compute with NucleiFeatures, results are saved to sample_dir + '_segmented'.
+    debug : bool
+        Use the on-disk layout and predict_test.sh.
+    segmenter : inference.Segmenter
+        Already loaded models, a new Segmenter is created if None.
+    tile_size : integer
+        Size of tiles along both axes.
+    halo : integer
+        Overlap of neighbouring tiles, see split_image. Pass the same value to restore_image.
+    cache_dir : str
+        Full path to a tile_cache.TileCache directory for the new Segmenter: predictions of tiles
+        seen before by the same models are taken from the cache. Hit/miss statistics are printed.
+    background : str or background.BackgroundDetector
+        Stain from background.STAINS or a configured detector, the number of skipped tiles is printed.
+    features_format : str
+        'csv' for a <sample>.csv table, 'columns' to stream features tile by tile to a <sample>.features
+        table with float32/int32 columns and tile_x/tile_y, see feature_store.FeatureTable.
+        An existing table is updated: only new features and tiles with changed labels are computed.
+    prediction_store : str
+        Codec ('none', 'zlib', 'lz4') of the intermediate predictions in debug mode: the scripts write
+        chunked prediction_store datasets instead of PNG folders. PNGs are written if None.
+    labels_out : str or numpy ndarray
+        Where to stitch the label image of the slide, see restore_tiles: '.npy' or BigTIFF '.tif' path,
+        or an array. The stitched image is returned instead of the label images of tiles.
+        With halo > 0 and features, a temporary .npy next to the features table is used if None.
 
-    for y in range(y_max + 1):
-        long_tiles.append([])
-        for x in range(x_max + 1):
-            long_tiles[-1].append(tiles[(x, y)])
+    Returns
+    -------
+    labels : list or numpy ndarray
+        Label images of tiles, or the stitched label image if labels_out is set. None in debug mode.
+    tile_names : list
+        List of tile names.
+    """
+    with span('read_slide'):
+        full_img = open_slide(str(full_img_path)) if isinstance(full_img_path, (str, Path)) else full_img_path
+    with span('split_image'):
+        tiles, tile_names = split_image(img=full_img, x_tile_size=tile_size, y_tile_size=tile_size, halo=halo)
+    result_dir = str(Path(sample_dir)) + '_segmented'
+    if features_format not in ('csv', 'columns'):
+        raise ValueError(f'Unknown features_format {features_format}, use csv or columns')
+    extension = '.csv' if features_format == 'csv' else '.features'
+    features_path = f'{result_dir}/{os.path.split(sample_dir)[1]}{extension}'
+    if isinstance(background, str):
+        background = BackgroundDetector(background)
+    if background is not None:
+        background.reset_stats()
+
+    if debug:
+        empty = set()
+        if background is not None:
+            with span('background', tiles=len(tile_names)):
+                empty = {name for tile, name in zip(tiles, tile_names) if background.is_empty(prepare_tile(tile))}
+            print(background.report())
+        _segment_on_disk(tiles, tile_names, sample_dir, network_dir, result_dir, force=force, empty=empty,
+                         prediction_store=prediction_store)
+        if features is not None and halo == 0:
+            _save_features(NucleiFeatures(f'{result_dir}/lgbm_test_sub2', sample_dir, features=features),
+                           features_path)
+        elif features is not None:
+            labels = (cv.imread(f'{result_dir}/lgbm_test_sub2/{name}.tif', -1) for name in tile_names)
+            _stitched_features(labels, tiles, tile_names, full_img, features, halo, features_path)
+        return None, tile_names
+
+    if segmenter is None:
+        segmenter = Segmenter(network_dir, cache=cache_dir)
+    if segmenter.cache is not None:
+        segmenter.cache.reset_stats()
+    if features is not None:
+        os.makedirs(result_dir, exist_ok=True)
+    with span('segment', tiles=len(tile_names)):
+        labels = segmenter.segment(tiles, background=background)
+        if labels_out is None:
+            # the caller gets the label images of all tiles
+            labels = list(labels)
+        if features is not None and halo > 0:
+            stitched = _stitched_features(labels, tiles, tile_names, full_img, features, halo, features_path,
+                                          labels_out)
+        elif labels_out is not None:
+            mosaic = _Mosaic(_tile_shapes(tiles, tile_names), tiff=True, halo=halo, out=labels_out)
+            labels = _added(mosaic, labels, tile_names)
+            if features is not None:
+                _tile_features(labels, tiles, tile_names, features, features_path)
+            else:
+                deque(labels, maxlen=0)
+            stitched = mosaic.close()
+        elif features is not None:
+            _tile_features(labels, tiles, tile_names, features, features_path)
+    if segmenter.cache is not None:
+        print(segmenter.cache.report())
+    if background is not None:
+        print(background.report())
+    return (stitched if labels_out is not None else labels), tile_names
+
+
+def _tile_shapes(tiles, tile_names):
+    # shapes of the tiles by coordinates without reading them
+    if isinstance(tiles, TileWindows):
+        shapes = [(y1 - y0, x1 - x0) for y0, y1, x0, x1 in tiles.windows]
+    else:
+        shapes = [tile.shape[:2] for tile in tiles]
+    return {get_x_and_y(name): shape for name, shape in zip(tile_names, shapes)}
 
-    long_tiles = [np.hstack(i) for i in long_tiles]
 
-    return np.vstack(long_tiles)
+def _added(mosaic, labels, tile_names):
+    # passes the label images on after writing them to the mosaic
+    for name, tile_labels in zip(tile_names, labels):
+        mosaic.add(get_x_and_y(name), tile_labels)
+        yield tile_labels
 
 
-def perform_segmentation(full_img_path, sample_dir, network_dir, force=False, features=None):
+def _unzip(items, n):
+    # n iterators over the fields of items for zip, which takes one field of each in turn,
+    # so only the current item is held (itertools.tee would buffer dozens)
+    items = iter(items)
+    current = [None]
+
+    def field(i):
+        while True:
+            if i == 0:
+                current[0] = next(items, None)
+                if current[0] is None:
+                    return
+            yield current[0][i]
+
+    return [field(i) for i in range(n)]
+
+
+def _tile_features(labels, tiles, tile_names, features, path):
+    # tiles without nuclei, background tiles included, are not read again
+    segmented = ((tile_labels, prepare_tile(tiles[i]), tile_names[i])
+                 for i, tile_labels in enumerate(labels) if tile_labels.any())
+    _save_features(NucleiFeatures(None, None, features=features), path, *_unzip(segmented, 3))
+
+
+def _save_features(nuclei_features, path, labels=None, tiles=None, tile_names=None, windows=None):
+    if path.endswith('.features'):
+        stats = nuclei_features.update(path, labels, tiles, tile_names, windows)
+        print(f"features: {stats['computed']} tiles computed, {stats['extended']} extended with new features, "
+              f"{stats['reused']} reused")
+    elif labels is None:
+        nuclei_features.df().to_csv(path, index=False)
+    else:
+        nuclei_features.compute_tiles(labels, tiles, tile_names, windows).df().to_csv(path, index=False)
+
+
+def _stitched_features(labels, tiles, tile_names, full_img, features, halo, path, out=None):
+    # labels are streamed into the stitched image at out, or at a temporary .npy next to path,
+    # and the features are computed window by window
+    tmp_path = None if out is not None else f'{os.path.splitext(path)[0]}.labels.tmp.npy'
+    with span('restore_tiles', tiles=len(tile_names)):
+        mosaic = _Mosaic(_tile_shapes(tiles, tile_names), tiff=True, halo=halo, out=out or tmp_path)
+        deque(_added(mosaic, labels, tile_names), maxlen=0)
+        img = mosaic.close()
+    base = tile_names[0].rsplit('_', 2)[0]
+    windows = _stitched_windows(img, full_img, mosaic.y_ticks, mosaic.x_ticks, base)
+    _save_features(NucleiFeatures(None, None, features=features), path, *_unzip(windows, 4))
+    if tmp_path is not None:
+        del img, mosaic
+        os.remove(tmp_path)
+        return None
+    return img
+
+
+def _merge_boxes(boxes):
+    # one box (label, first row, last row, first column, last column) per label
+    if not boxes.shape[1]:
+        return boxes
+    boxes = boxes[:, np.argsort(boxes[0], kind='stable')]
+    starts = np.flatnonzero(np.r_[True, boxes[0, 1:] != boxes[0, :-1]])
+    return np.stack([boxes[0, starts], np.minimum.reduceat(boxes[1], starts), np.maximum.reduceat(boxes[2], starts),
+                     np.minimum.reduceat(boxes[3], starts), np.maximum.reduceat(boxes[4], starts)])
+
+
+def _label_boxes(labels, y0, x0):
+    # boxes of the labels of a window in slide coordinates
+    pixels = np.flatnonzero(labels)
+    rows, cols = np.divmod(pixels, labels.shape[1])
+    return _merge_boxes(np.stack([labels.ravel()[pixels].astype(np.int64), rows + y0, rows + y0,
+                                  cols + x0, cols + x0]))
+
+
+def _stitched_windows(img, full_img, y_ticks, x_ticks, base):
+    """
+    Splits a stitched label image for NucleiFeatures without cutting nuclei: every nucleus belongs to the
+    window of the tile grid that holds the top left corner of its bounding box. A window is the crop of the
+    bounding boxes of its nuclei with one pixel of background around, relabelled 1..k.
+
+    Yields
+    ------
+    labels : numpy ndarray
+        Labels of the crop.
+    orig : numpy ndarray
+        BGR crop of the slide.
+    tile_name : str
+        Name of the window, as the tile of split_image at the same place.
+    window : dict
+        offset of the crop in the slide and n_labels for NucleiFeatures.tile_columns.
+    """
+    windows = [(x, y) for x in range(len(x_ticks) - 1) for y in range(len(y_ticks) - 1)]
+    with span('label_boxes', windows=len(windows)):
+        boxes = _merge_boxes(np.concatenate([
+            _label_boxes(np.asarray(img[y_ticks[y]:y_ticks[y + 1], x_ticks[x]:x_ticks[x + 1]]), y_ticks[y], x_ticks[x])
+            for x, y in windows], axis=1))
+        owners_x = np.searchsorted(x_ticks, boxes[3], 'right') - 1
+        owners_y = np.searchsorted(y_ticks, boxes[1], 'right') - 1
+        order = np.lexsort((boxes[0], owners_y, owners_x))
+        boxes, owners = boxes[:, order], np.stack([owners_x[order], owners_y[order]])
+    bounds = np.searchsorted(owners[0] * len(y_ticks) + owners[1],
+                             [x * len(y_ticks) + y for x, y in windows] + [len(x_ticks) * len(y_ticks)])
+    for (x, y), start, stop in zip(windows, bounds[:-1], bounds[1:]):
+        if start == stop:
+            continue
+        owned, r0, r1, c0, c1 = boxes[:, start:stop]
+        r0, c0 = max(int(r0.min()) - 1, 0), max(int(c0.min()) - 1, 0)
+        r1, c1 = min(int(r1.max()) + 2, img.shape[0]), min(int(c1.max()) + 2, img.shape[1])
+        crop = np.asarray(img[r0:r1, c0:c1])
+        index = np.searchsorted(owned, crop)
+        hit = owned[np.minimum(index, len(owned) - 1)] == crop
+        labels = np.where(hit, index + 1, 0).astype(np.int32)
+        yield labels, prepare_tile(np.asarray(full_img[r0:r1, c0:c1])), f'{base}_{x}_{y}', \
+            {'offset': (c0, r0), 'n_labels': len(owned)}
+
+
+def _segment_on_disk(tiles, tile_names, sample_dir, network_dir, result_dir, force=False, empty=(),
+                     prediction_store=None):
     network_dir = Path(network_dir)
-    try:
-        full_img = cv.imread(full_img_path, -1)
-    except cv.error:
-        full_img = plt.imread(full_img_path)
-    tiles, tile_names = split_image(img=full_img, x_tile_size=1000, y_tile_size=1000)
-    prepare_test_data(tiles, tile_names, sample_dir, force=force)
+    with span('prepare_test_data', tiles=len(tile_names)):
+        prepare_test_data(tiles, tile_names, sample_dir, force=force)
 
     try:
         dir_util.remove_tree(str(network_dir / 'data_test'))
     except:
         pass
     os.mkdir(str(network_dir / 'data_test'))
-    dir_util.copy_tree(sample_dir, str(network_dir / 'data_test'));
+    with span('copy_data_test'):
+        for name in tile_names:
+            if name not in empty:
+                dir_util.copy_tree(str(Path(sample_dir) / name), str(network_dir / 'data_test' / name))
 
     try:
         dir_util.remove_tree(str(network_dir / 'predictions'))
@@ -180,20 +562,139 @@ def perform_segmentation(full_img_path, sample_dir, network_dir, force=False, fe
     except:
         pass
 
-    result_dir = str(Path(sample_dir)) + '_segmented'
+    # the scripts import tracing, prediction_store and image_cache from this directory,
+    # every tile is decoded once into image_cache and read from there by all networks
+    image_cache_dir = network_dir / 'image_cache'
+    try:
+        dir_util.remove_tree(str(image_cache_dir))
+    except:
+        pass
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.abspath(__file__)),
+                                                       os.environ.get('PYTHONPATH', '')]))
+    env[CACHE_ENV] = str(image_cache_dir)
+    env.pop(STORE_ENV, None)
+    if prediction_store is not None:
+        env[STORE_ENV] = prediction_store
+    with span('predict_test.sh'):
+        subprocess.run(f"cd {network_dir} && bash 'predict_test.sh'", shell=True, env=env)
+    try:
+        dir_util.remove_tree(str(image_cache_dir))
+    except:
+        pass
+    with span('copy_predictions'):
+        dir_util.copy_tree(str(network_dir / 'predictions'), result_dir);
 
-    subprocess.run(f"cd {network_dir} && bash 'predict_test.sh'", shell=True)
-    dir_util.copy_tree(str(network_dir / 'predictions'), result_dir);
+    for name in empty:
+        shape = cv.imread(str(Path(sample_dir) / name / 'images' / f'{name}.png'), -1).shape[:2]
+        for folder in ['lgbm_test_sub1', 'lgbm_test_sub2']:
+            cv.imwrite(f'{result_dir}/{folder}/{name}.tif', np.zeros(shape, dtype=np.uint16))
+        for folder in ['color_test_sub1', 'color_test_sub2']:
+            cv.imwrite(f'{result_dir}/{folder}/{name}.png', np.zeros(shape + (3,), dtype=np.uint8))
 
-    if features is not None:
-        NucleiFeatures(f'{result_dir}/lgbm_test_sub2', sample_dir,
-                       features=features).df().to_csv(f'{result_dir}/{os.path.split(sample_dir)[1]}.csv',
-                                                      index=False)
+
+def label_palette(n=60, seed=None):
+    """
+    Random colours for label images, label i gets palette[i % n].
+
+    Parameters
+    ----------
+    n : integer
+        Number of colours.
+    seed : integer
+        Seed of the palette, the same seed gives the same colours.
+
+    Returns
+    -------
+    palette : numpy ndarray
+        uint8 array of shape (n, 3).
+    """
+    return np.random.RandomState(seed).randint(0, 255, (n, 3)).astype(np.uint8)
 
 
-def color_tiff(img, n=60):
-    img = img % n
-    seg_color = np.zeros((*img.shape, 3), dtype=np.uint8)
-    for i in tqdm(range(1, img.max() + 1)):
-        seg_color[img == i] = np.random.randint(0, 255, 3)
+def _color_band(labels, palette):
+    seg_color = palette[labels % len(palette)]
+    seg_color[labels == 0] = 0
     return seg_color
+
+
+def color_tiff(img, n=60, seed=None, out=None, band=2048):
+    """
+    Colours a label image with a random palette, background stays black.
+    The image is processed in bands of rows with one lookup per pixel, so img can be a memmap
+    or a slides.TiffSource and the result can be written to disk.
+
+    Parameters
+    ----------
+    img : numpy ndarray or slides.TiffSource
+        Label image.
+    n : integer
+        Number of colours.
+    seed : integer
+        Seed of the palette.
+    out : numpy ndarray or str
+        Preallocated array or path to a disk-backed result, see restore_tiles.
+    band : integer
+        Number of rows processed at once.
+
+    Returns
+    -------
+    seg_color : numpy ndarray
+        uint8 colour image.
+    """
+    palette = label_palette(n, seed)
+    seg_color = _allocate_mosaic(out, tuple(img.shape[:2]) + (3,), np.uint8)
+    for y0 in tqdm(range(0, img.shape[0], band)):
+        seg_color[y0:y0 + band] = _color_band(np.asarray(img[y0:y0 + band]), palette)
+    return seg_color
+
+
+def preview_pyramid(img, out_dir, n=60, seed=None, min_size=1024, band=2048, ext='.npy'):
+    """
+    Writes coloured previews of a label image downsampled by 2, 4, 8, ... until the larger side
+    is at most min_size. All levels are built in one pass over bands of img, labels are subsampled
+    before colouring so nuclei keep their colours on every level.
+    Levels are saved as out_dir/level_{k}.npy (or .tif, see slides.create_slide) and can be opened with
+    slides.open_slide, the smallest one is also saved as out_dir/preview.png.
+
+    Parameters
+    ----------
+    img : numpy ndarray or slides.TiffSource
+        Label image.
+    out_dir : str
+        Full path to directory for the levels.
+    n : integer
+        Number of colours.
+    seed : integer
+        Seed of the palette, the same seed as in color_tiff gives the same colours.
+    min_size : integer
+        Size of the smallest level.
+    band : integer
+        Approximate number of full resolution rows processed at once.
+    ext : str
+        '.npy' or '.tif'.
+
+    Returns
+    -------
+    paths : list
+        Paths of the levels, from the largest to the smallest.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    palette = label_palette(n, seed)
+    steps = [2]
+    while max(img.shape[:2]) / steps[-1] > min_size:
+        steps.append(steps[-1] * 2)
+    band = max(band // steps[-1], 1) * steps[-1]
+
+    paths = [os.path.join(out_dir, f'level_{k + 1}{ext}') for k in range(len(steps))]
+    levels = [create_slide(path, (-(-img.shape[0] // step), -(-img.shape[1] // step), 3), np.uint8)
+              for path, step in zip(paths, steps)]
+
+    for y0 in tqdm(range(0, img.shape[0], band)):
+        labels = np.asarray(img[y0:y0 + band])
+        for level, step in zip(levels, steps):
+            level[y0 // step:(y0 + band) // step] = _color_band(labels[::step, ::step], palette)
+
+    for level in levels:
+        level.flush()
+    cv.imwrite(os.path.join(out_dir, 'preview.png'), np.asarray(levels[-1]))
+    return paths
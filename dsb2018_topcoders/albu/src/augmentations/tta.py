@@ -6,12 +6,16 @@ from torch.nn import functional as F
 
 
 class TTAOp:
-    def __init__(self, sigmoid=True):
+    def __init__(self, sigmoid=True, device=None):
         self.sigmoid = sigmoid
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
 
     def __call__(self, model, batch):
-        forwarded = torch.autograd.Variable(torch.from_numpy(self.forward(batch.numpy())), volatile=True).cuda()
-        return self.backward(self.to_numpy(model(forwarded)))
+        with torch.no_grad():
+            forwarded = torch.from_numpy(self.forward(batch.numpy())).to(self.device)
+            return self.backward(self.to_numpy(model(forwarded)))
 
     def forward(self, img):
         raise NotImplementedError
@@ -21,10 +25,10 @@ class TTAOp:
 
     def to_numpy(self, batch):
         if self.sigmoid:
-            batch = F.sigmoid(batch)
+            batch = torch.sigmoid(batch)
         else:
             batch = F.softmax(batch, dim=1)
-        data = batch.data.cpu().numpy()
+        data = batch.cpu().numpy()
         return data
 
 class BasicTTAOp(TTAOp):
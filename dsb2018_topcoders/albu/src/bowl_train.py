@@ -7,8 +7,9 @@ import numpy as np
 from utils import get_csv_folds, update_config, get_folds
 from config import Config
 from dataset.reading_image_provider import ReadingImageProvider, CachingImageProvider, InFolderImageProvider
-from dataset.raw_image import RawImageType
-from pytorch_utils.concrete_eval import FullImageEvaluator
+from dataset.bowl_image_types import PaddedImageType, PaddedSigmoidImageType, BorderImageType, SigmoidBorderImageType
+from pytorch_utils.concrete_eval import FullImageEvaluator, FoldMergingEvaluator
+from pytorch_utils.eval import set_threads
 from augmentations.transforms import aug_victor
 from pytorch_utils.train import train
 from merge_preds import merge_files
@@ -19,6 +20,13 @@ parser = argparse.ArgumentParser()
 parser.add_argument('config_path')
 parser.add_argument('--fold', type=int)
 parser.add_argument('--training', action='store_true')
+parser.add_argument('--merge_folds', action='store_true', help='average the folds while predicting, without fold files')
+parser.add_argument('--tta', default='none', help='test time augmentation policy of tta.py: none, lr, flips or d4')
+parser.add_argument('--device', help='cpu, cuda or cuda:<n> for evaluation, the GPU if there is one by default')
+parser.add_argument('--precision', default='fp32', choices=['fp32', 'int8'],
+                    help='int8 runs the models of quantize_models.py on CPU')
+parser.add_argument('--threads', type=int, help='torch threads inside one operation')
+parser.add_argument('--interop_threads', type=int, help='torch threads running independent operations')
 args = parser.parse_args()
 with open(args.config_path, 'r') as f:
     cfg = json.load(f)
@@ -43,45 +51,6 @@ else:
     paths = {"images": config.dataset_path}
 num_workers = 0 if os.name == 'nt' else 4
 
-class MinSizeImageType(RawImageType):
-    def finalyze(self, data):
-        rows, cols = data.shape[:2]
-        nrows = (256 - rows) if rows < 256 else 0
-        ncols = (256 - cols) if cols < 256 else 0
-        if nrows > 0 or ncols > 0:
-            return cv2.copyMakeBorder(data, 0, nrows, 0, ncols, cv2.BORDER_CONSTANT)
-        return data
-
-class SigmoidBorderImageType(MinSizeImageType):
-    def read_mask(self):
-        path = os.path.join(self.paths['masks'], self.fn_mapping['masks'](self.fn))
-        mask = imread(path, mode='RGB')
-        label = self.read_label()
-        fin = self.finalyze(mask)
-        data = np.dstack((fin[...,2], fin[...,1], (label > 0).astype(np.uint8) * 255))
-        return data
-
-class BorderImageType(MinSizeImageType):
-    def read_mask(self):
-        path = os.path.join(self.paths['masks'], self.fn_mapping['masks'](self.fn))
-        msk = imread(path, mode='RGB')
-        msk[..., 2] = (msk[..., 2] > 127)
-        msk[..., 1] = (msk[..., 1] > 127) * (msk[..., 2] == 0)
-        msk[..., 0] = (msk[..., 1] == 0) * (msk[..., 2] == 0)
-        return self.finalyze(msk.astype(np.uint8) * 255)
-
-
-class PaddedImageType(BorderImageType):
-    def finalyze(self, data):
-        rows, cols = data.shape[:2]
-        return cv2.copyMakeBorder(data, 0, (32-rows%32), 0, (32-cols%32), cv2.BORDER_REFLECT)
-
-class PaddedSigmoidImageType(SigmoidBorderImageType):
-    def finalyze(self, data):
-        rows, cols = data.shape[:2]
-        return cv2.copyMakeBorder(data, 0, (32-rows%32), 0, (32-cols%32), cv2.BORDER_REFLECT)
-
-
 def train_bowl():
     torch.backends.cudnn.benchmark = True
     im_type = BorderImageType if not config.sigmoid else SigmoidBorderImageType
@@ -97,6 +66,7 @@ def train_bowl():
 
 def eval_bowl():
     global config
+    set_threads(args.threads, args.interop_threads)
     test = not args.training
     im_val_type = PaddedImageType if not config.sigmoid else PaddedSigmoidImageType
     im_prov_type = InFolderImageProvider if test else ReadingImageProvider
@@ -106,7 +76,13 @@ def eval_bowl():
     else:
         folds = [([], list(range(len(ds)))) for i in range(4)]
 
-    keval = FullImageEvaluator(config, ds, test=test, flips=3, num_workers=num_workers, border=0)
+    if test and args.fold is None and args.merge_folds:
+        keval = FoldMergingEvaluator(config, ds, test=test, flips=3, num_workers=num_workers, border=0, folds=len(folds),
+                                     tta=args.tta, device=args.device, precision=args.precision)
+        keval.predict_folds(list(range(len(folds))), folds[0][1])
+        return
+    keval = FullImageEvaluator(config, ds, test=test, flips=3, num_workers=num_workers, border=0, tta=args.tta,
+                               device=args.device, precision=args.precision)
     for fold, (t, e) in enumerate(folds):
         if args.fold is not None and int(args.fold) != fold:
             continue
@@ -1,16 +1,29 @@
 import os
 from scipy.misc import imread
 import cv2
+import numpy as np
+
+from image_cache import get_cache
 
 from dataset.abstract_image_type import AbstractImageType, AlphaNotAvailableException
 
 
 class RawImageType(AbstractImageType):
-    def __init__(self, paths, fn, fn_mapping, has_alpha):
+    def __init__(self, paths, fn, fn_mapping, has_alpha, image=None):
         super().__init__(paths, fn, fn_mapping, has_alpha)
-        self.im = imread(os.path.join(self.paths['images'], self.fn), mode='RGB')
-        if '646f5e00a2db3add97fb80a83ef3c07edd1b17b1b0d47c2bd650cdcab9f322c0' in fn:
-            self.im = cv2.imread(os.path.join(self.paths['images'], self.fn), cv2.IMREAD_COLOR)
+        cache = get_cache()
+        if image is not None:
+            self.im = image
+        elif cache is not None:
+            # decoded once for all configs and the other families, see image_cache.py
+            self.im = cache.read(os.path.join(self.paths['images'], self.fn), cv2.IMREAD_COLOR)
+            if '646f5e00a2db3add97fb80a83ef3c07edd1b17b1b0d47c2bd650cdcab9f322c0' not in fn:
+                self.im = self.im[..., ::-1]
+            self.im = np.ascontiguousarray(self.im)
+        else:
+            self.im = imread(os.path.join(self.paths['images'], self.fn), mode='RGB')
+            if '646f5e00a2db3add97fb80a83ef3c07edd1b17b1b0d47c2bd650cdcab9f322c0' in fn:
+                self.im = cv2.imread(os.path.join(self.paths['images'], self.fn), cv2.IMREAD_COLOR)
         # self.im = 255 - self.im
         # self.clahe = CLAHE(1)
         # self.im = self.clahe(image=self.im)['image']
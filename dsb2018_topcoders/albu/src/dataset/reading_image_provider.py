@@ -42,3 +42,24 @@ class InFolderImageProvider(ReadingImageProvider):
 
     def __getitem__(self, item):
         return self.image_type(self.paths, os.path.join(self.im_names[item], 'images', self.im_names[item] + '.png'), self.fn_mapping, self.has_alpha)
+
+
+class ArrayImageProvider(AbstractImageProvider):
+    """
+    Serves already decoded RGB images instead of reading them from paths['images']
+    """
+    def __init__(self, image_type, images, names, fn_mapping=lambda name: name, has_alpha=False):
+        super().__init__(image_type, fn_mapping, has_alpha=has_alpha)
+        self.images = images
+        self.im_names = names
+        self.paths = {}
+
+    def get_indexes_by_names(self, names):
+        indexes = {os.path.splitext(name)[0]: idx for idx, name in enumerate(self.im_names)}
+        return [indexes[name] for name in names if name in indexes]
+
+    def __getitem__(self, item):
+        return self.image_type(self.paths, self.im_names[item], self.fn_mapping, self.has_alpha, image=self.images[item])
+
+    def __len__(self):
+        return len(self.im_names)
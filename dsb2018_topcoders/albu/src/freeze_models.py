@@ -0,0 +1,24 @@
+import argparse
+import json
+
+from pytorch_utils.eval import set_threads
+from pytorch_utils.freeze import export_model
+
+parser = argparse.ArgumentParser(description='Exports the fold models of a config with batch norms folded into '
+                                             'convolutions as frozen TorchScript, read_model loads them instead')
+parser.add_argument('config_path')
+parser.add_argument('--folds', type=int, nargs='+', default=[0, 1, 2, 3])
+parser.add_argument('--device', help='cpu, cuda or cuda:<n>, the models only run on this device type')
+parser.add_argument('--tile_size', type=int, default=1024, help='padded size of the tiles the models are traced on')
+parser.add_argument('--atol', type=float, default=1e-3, help='largest allowed difference of the sigmoid outputs')
+parser.add_argument('--threads', type=int)
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    set_threads(args.threads)
+    with open(args.config_path, 'r') as f:
+        cfg = json.load(f)
+    for fold in args.folds:
+        path, difference = export_model(cfg['folder'], fold, cfg['num_channels'], args.device, args.tile_size,
+                                        args.atol)
+        print('{}: max difference {:.2e}'.format(path, difference))
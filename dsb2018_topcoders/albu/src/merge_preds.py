@@ -1,26 +1,39 @@
 import os
+from functools import partial
+from multiprocessing.pool import ThreadPool
 import tqdm
 import numpy as np
-import cv2
 
-def merge_files(root):
+from prediction_store import list_predictions, load_prediction, save_prediction
+
+def merge_probs(probs):
+    # same rounding as cv2.imwrite applies to the float mean of the folds
+    return np.round(np.mean(probs, axis=0)).astype(np.uint8)
+
+def merge_file(root, res_path, prob_file):
+    probs = []
+    for fold in range(4):
+        prob_arr = load_prediction(root, 'fold{}_'.format(fold) + prob_file)
+        probs.append(prob_arr)
+    prob_arr = merge_probs(probs)
+
+    save_prediction(res_path, prob_file, prob_arr)
+
+def merge_files(root, workers=None):
+    """
+    Averages the fold files of every image in root, images are merged on a thread pool
+    (decoding and encoding release the GIL), every thread holds the folds of one image only.
+    """
     res_path = os.path.join('..', '..', 'predictions', os.path.split(root)[-1] + '_test')
     os.makedirs(res_path, exist_ok=True)
-    prob_files = {f for f in os.listdir(root) if os.path.splitext(f)[1] in ['.png']}
+    prob_files = {f for f in list_predictions(root) if os.path.splitext(f)[1] in ['.png']}
     unfolded = {f[6:] for f in prob_files if f.startswith('fold')}
     if not unfolded:
         unfolded = prob_files
 
-    for prob_file in tqdm.tqdm(unfolded):
-        probs = []
-        for fold in range(4):
-            prob = os.path.join(root, 'fold{}_'.format(fold) + prob_file)
-            prob_arr = cv2.imread(prob, cv2.IMREAD_UNCHANGED)
-            probs.append(prob_arr)
-        prob_arr = np.mean(probs, axis=0)
-
-        res_path_geo = os.path.join(res_path, prob_file)
-        cv2.imwrite(res_path_geo, prob_arr)
+    with ThreadPool(workers or os.cpu_count()) as pool:
+        for _ in tqdm.tqdm(pool.imap_unordered(partial(merge_file, root, res_path), sorted(unfolded)), total=len(unfolded)):
+            pass
 
 if __name__ == "__main__":
     val_dir = r'C:\dev\dsbowl\results_test\dpn_softmax_f0'
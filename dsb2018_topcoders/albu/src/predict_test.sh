@@ -1,3 +1,3 @@
-python bowl_eval.py ./configs/dpn_softmax_s2.json
-python bowl_eval.py ./configs/dpn_sigmoid_s2.json
-python bowl_eval.py ./configs/resnet_softmax_s2.json
+python bowl_eval.py ./configs/dpn_softmax_s2.json --merge_folds
+python bowl_eval.py ./configs/dpn_sigmoid_s2.json --merge_folds
+python bowl_eval.py ./configs/resnet_softmax_s2.json --merge_folds
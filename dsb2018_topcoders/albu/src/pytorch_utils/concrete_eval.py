@@ -7,6 +7,9 @@ import numpy as np
 
 from .eval import Evaluator
 
+from image_cache import get_cache
+from prediction_store import save_prediction
+
 
 class FullImageEvaluator(Evaluator):
     def __init__(self, *args, **kwargs):
@@ -17,18 +20,83 @@ class FullImageEvaluator(Evaluator):
         for i in range(len(names)):
             self.on_image_constructed(names[i], predicted[i,...], prefix)
 
-    def save(self, name, prediction, prefix=""):
+    def image_shape(self, name):
         if self.test:
             path = os.path.join(self.config.dataset_path, name)
         else:
             path = os.path.join(self.config.dataset_path, 'images_all', name)
-        rows, cols = cv2.imread(path, 0).shape[:2]
+        cache = get_cache()
+        if cache is not None:
+            # the image is in the cache already, only the header of the array is read
+            return cache.read(path, cv2.IMREAD_COLOR).shape[:2]
+        return cv2.imread(path, 0).shape[:2]
+
+    def prepare_prediction(self, name, prediction):
+        rows, cols = self.image_shape(name)
         prediction = prediction[0:rows, 0:cols,...]
         if prediction.shape[2] < 3:
             zeros = np.zeros((rows, cols), dtype=np.float32)
             prediction = np.dstack((prediction[...,0], prediction[...,1], zeros))
         else:
             prediction = cv2.cvtColor(prediction, cv2.COLOR_RGB2BGR)
+        return (prediction * 255).astype(np.uint8)
+
+    def save(self, name, prediction, prefix=""):
+        prediction = self.prepare_prediction(name, prediction)
+        if self.test:
+            name = os.path.split(name)[-1]
+        save_prediction(self.save_dir, prefix + name, prediction)
+
+
+class FoldMergingEvaluator(FullImageEvaluator):
+    """
+    Averages the folds of every image as merge_preds.merge_files does while they are predicted,
+    fold files are not written: an image is saved to ../../predictions/<folder>_test once all its folds are added.
+    Only the sums of images with missing folds are kept, use predict_folds to keep just one batch.
+    """
+    save_to_disk = False
+
+    def __init__(self, *args, folds=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.folds = folds
+        self.fold_sums = {}
+        self.fold_counts = {}
+        self.merged_dir = os.path.join('..', '..', 'predictions', os.path.split(self.save_dir)[-1] + '_test')
+
+    def save(self, name, prediction, prefix=""):
+        prediction = self.prepare_prediction(name, prediction)
         if self.test:
             name = os.path.split(name)[-1]
-        cv2.imwrite(os.path.join(self.save_dir, prefix + name), (prediction * 255).astype(np.uint8))
+        if name in self.fold_sums:
+            self.fold_sums[name] += prediction
+            self.fold_counts[name] += 1
+        else:
+            self.fold_sums[name] = prediction.astype(np.uint16)
+            self.fold_counts[name] = 1
+        if self.fold_counts[name] == self.folds:
+            # same rounding as merge_preds.merge_probs
+            merged = np.round(self.fold_sums.pop(name) / self.folds).astype(np.uint8)
+            del self.fold_counts[name]
+            self.save_merged(name, merged)
+
+    def save_merged(self, name, prediction):
+        os.makedirs(self.merged_dir, exist_ok=True)
+        save_prediction(self.merged_dir, name, prediction)
+
+
+class InMemoryEvaluator(FoldMergingEvaluator):
+    """
+    Keeps the uint8 fold average of every image in self.predictions[name] instead of writing it,
+    expects ArrayImageProvider as ds
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.predictions = {}
+        self.shapes = {name: image.shape[:2] for name, image in zip(self.ds.im_names, self.ds.images)}
+
+    def image_shape(self, name):
+        return self.shapes[name]
+
+    def save_merged(self, name, prediction):
+        self.predictions[name] = prediction
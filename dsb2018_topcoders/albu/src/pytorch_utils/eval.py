@@ -8,13 +8,16 @@ import torch.nn.functional as F
 from torch import nn
 # torch.backends.cudnn.benchmark = True
 import tqdm
-from augmentations.tta import transforms as TTA
 from augmentations.transforms import ToTensor
 
 
 from dataset.neural_dataset import SequentialDataset
 from torch.utils.data.dataloader import DataLoader as PytorchDataLoader
 
+from tracing import span
+from tta import predict_tta
+from .freeze import optimize_frozen
+
 
 class flip:
     FLIP_NONE=0
@@ -22,64 +25,46 @@ class flip:
     FLIP_FULL=2
 
 
-def flip_tensor_lr(batch):
-    columns = batch.data.size()[-1]
-    index = torch.autograd.Variable(torch.LongTensor(list(reversed(range(columns)))).cuda())
-    return batch.index_select(3, index)
-
-
-def flip_tensor_ud(batch):
-    rows = batch.data.size()[-2]
-    index = torch.autograd.Variable(torch.LongTensor(list(reversed(range(rows)))).cuda())
-    return batch.index_select(2, index)
-
-
-def to_numpy(batch):
-    classes = batch.size(1)
-    if isinstance(batch, tuple):
-        batch = batch[0]
-    # batch = F.softmax(batch, dim=1)
-    data = np.moveaxis(batch.data.cpu().numpy(), 1, -1)
-    return data
-
-
-def predict(model, batch, flips=flip.FLIP_NONE):
-    batch = torch.autograd.Variable(batch, volatile=True).cuda()
-    pred1 = model(batch)
-    if flips > flip.FLIP_NONE:
-        pred2 = flip_tensor_lr(model(flip_tensor_lr(batch)))
-        masks = [pred1, pred2]
-        if flips > flip.FLIP_LR:
-            pred3 = flip_tensor_ud(model(flip_tensor_ud(batch)))
-            pred4 = flip_tensor_ud(flip_tensor_lr(model(flip_tensor_ud(flip_tensor_lr(batch)))))
-            masks.extend([pred3, pred4])
-        masks = [F.sigmoid(mask) for mask in masks]
-        new_mask = torch.mean(torch.stack(masks, 0), 0)
-        return to_numpy(new_mask)
-    return to_numpy(F.sigmoid(pred1))
-
-def predict8tta(model, batch, sigmoid):
-    ret = []
-    for cls in TTA:
-        ret.append(cls(sigmoid)(model, batch))
-    scale_tta = False
-    if scale_tta:
-        for scale in [0.8, 1.25]:
-            data = np.moveaxis(np.squeeze(batch.numpy()[0]), 0, -1)
-            srows, scols = data.shape[:2]
-            data = cv2.resize(data, (0, 0), fx=scale, fy=scale)
-            rows, cols = data.shape[:2]
-            data = cv2.copyMakeBorder(data, 0, (32-rows%32), 0, (32-cols%32), cv2.BORDER_REFLECT)
-            data = np.expand_dims(np.moveaxis(data, -1, 0), 0)
-            data = torch.from_numpy(data)
-            for cls in TTA:
-                r = (cls(sigmoid)(model, data))
-                r = np.moveaxis(np.squeeze(r), 0, -1)
-                r = r[:rows, :cols, ...]
-                r = cv2.resize(r, (scols, srows))
-                r = np.expand_dims(np.moveaxis(r, -1, 0), 0)
-                ret.append(r)
-    return np.moveaxis(np.mean(ret, axis=0), 1, -1)
+# transforms of tta.py used for the flips argument of predict
+flip_transforms = {flip.FLIP_NONE: 'none', flip.FLIP_LR: 'lr', flip.FLIP_FULL: 'flips'}
+
+
+def get_device(device=None):
+    """
+    torch.device from a name like 'cpu' or 'cuda:1', the GPU if there is one when device is None
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def set_threads(threads=None, interop_threads=None):
+    """
+    Number of threads torch uses inside one operation and to run independent operations, defaults are kept for None
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads and hasattr(torch, 'set_num_interop_threads'):
+        torch.set_num_interop_threads(interop_threads)
+
+
+def forward(model, batch):
+    with torch.no_grad():
+        return torch.sigmoid(model(batch))
+
+
+def predict(model, batch, flips=flip.FLIP_NONE, transforms=None, device=None):
+    """
+    Mean sigmoid of the model over the transforms of tta.py (a policy name or transform names, the flips by default),
+    all transforms of the batch are passed to the model at once where the shapes allow.
+    The batch is copied to the device once, flips and rotations run there (torch.flip, torch.rot90) and
+    only the mean is copied back
+    """
+    if transforms is None:
+        transforms = flip_transforms[min(flips, flip.FLIP_FULL)]
+    batch = torch.as_tensor(batch).to(get_device(device))
+    mean = predict_tta(lambda x: forward(model, x), batch, transforms, axes=(2, 3))
+    return np.moveaxis(mean.cpu().numpy(), 1, -1)
 
 
 def recursion_change_bn(module):
@@ -94,26 +79,70 @@ def recursion_change_bn(module):
     return module
 
 
-
-
-def read_model(project, fold):
-    if not torch.cuda.is_available():
-        model = torch.load(os.path.join('..', 'weights', project, 'fold{}_best.pth'.format(fold)), map_location={'cuda:0': 'cpu'})
+# precisions of read_model: the trained weights, or the int8 models of quantize_models.py on CPU
+PRECISIONS = ('fp32', 'int8')
+
+
+def frozen_model_path(project, fold, device):
+    """
+    Model of one fold exported by freeze_models.py for one device type
+    """
+    return os.path.join('..', 'weights', project, 'fold{}_best.frozen_{}.pt'.format(fold, get_device(device).type))
+
+
+def quantized_model_path(project, fold):
+    """
+    int8 model of one fold made by quantize_models.py, it runs on CPU only
+    """
+    return os.path.join('..', 'weights', project, 'fold{}_best.int8.pt'.format(fold))
+
+
+def read_model(project, fold, device=None, frozen=True, precision='fp32'):
+    """
+    Model of one fold on device (see get_device), wrapped in nn.DataParallel on GPUs only:
+    over all visible GPUs for 'cuda', on that GPU alone for an indexed device like 'cuda:1'.
+    With frozen the model exported by freeze_models.py is loaded if it is newer than the weights.
+    With precision 'int8' the quantized model of quantize_models.py is loaded, on CPU if device is None
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {}, use one of {}'.format(precision, PRECISIONS))
+    if precision == 'int8':
+        device = get_device(device or 'cpu')
+        if device.type != 'cpu':
+            raise ValueError('int8 models run on CPU only, got device {}'.format(device))
+        return torch.jit.load(quantized_model_path(project, fold), map_location=device)
+    device = get_device(device)
+    path = os.path.join('..', 'weights', project, 'fold{}_best.pth'.format(fold))
+    frozen_path = frozen_model_path(project, fold, device)
+    if frozen and os.path.exists(frozen_path) and os.path.getmtime(frozen_path) >= os.path.getmtime(path):
+        return optimize_frozen(torch.jit.load(frozen_path, map_location=device), device)
+    if device.type == 'cuda':
+        model = torch.load(path)
     else:
-        model = torch.load(os.path.join('..', 'weights', project, 'fold{}_best.pth'.format(fold)))
+        model = torch.load(path, map_location='cpu')
     for i, (name, module) in enumerate(model._modules.items()):
         module = recursion_change_bn(model)
     model.eval()
-    model = nn.DataParallel(model)
-    return model
+    if device.type == 'cuda':
+        if device.index is not None:
+            # DataParallel keeps its replicas on device_ids[0], all visible GPUs by default
+            return nn.DataParallel(model, device_ids=[device.index], output_device=device.index).to(device)
+        return nn.DataParallel(model).to(device)
+    return model.to(device)
 
 
 class Evaluator:
-    def __init__(self, config, ds, test=False, flips=0, num_workers=0, border=12, val_transforms=None):
+    save_to_disk = True
+
+    def __init__(self, config, ds, test=False, flips=0, num_workers=0, border=12, val_transforms=None, tta='none',
+                 device=None, precision='fp32'):
         self.config = config
+        self.precision = precision
+        self.device = get_device('cpu' if device is None and precision == 'int8' else device)
         self.ds = ds
         self.test = test
         self.flips = flips
+        self.tta = tta
         self.num_workers = num_workers
         self.image_needed = False
 
@@ -124,20 +153,47 @@ class Evaluator:
 
         self.save_dir = os.path.join(self.config.results_dir + ('_test' if self.test else ''), self.folder)
         self.val_transforms = val_transforms
-        os.makedirs(self.save_dir, exist_ok=True)
+        if self.save_to_disk:
+            os.makedirs(self.save_dir, exist_ok=True)
 
-    def predict(self, fold, val_indexes):
+    def predict(self, fold, val_indexes, model=None):
         prefix = ('fold' + str(fold) + "_") if self.test else ""
         val_dataset = SequentialDataset(self.ds, val_indexes, stage='test', config=self.config, transforms=self.val_transforms)
         val_dl = PytorchDataLoader(val_dataset, batch_size=self.config.predict_batch_size, num_workers=self.num_workers, drop_last=False)
-        model = read_model(self.folder, fold)
+        if model is None:
+            with span('albu.read_model', config=self.folder, fold=fold):
+                model = read_model(self.folder, fold, self.device, precision=self.precision)
+        pbar = tqdm.tqdm(val_dl, total=len(val_dl))
+        for data in pbar:
+            with span('albu.batch', config=self.folder, fold=fold, images=list(data['image_name'])):
+                samples = data['image']
+                predicted = predict(model, samples, transforms=self.tta, device=self.device)
+                self.process_batch(predicted, model, data, prefix=prefix)
+        with span('albu.post_predict', config=self.folder, fold=fold):
+            self.post_predict_action(prefix=prefix)
+
+    def predict_folds(self, folds, val_indexes, models=None):
+        """
+        Same as predict for every fold, but every batch is loaded once and passed to the models of all folds.
+        """
+        val_dataset = SequentialDataset(self.ds, val_indexes, stage='test', config=self.config, transforms=self.val_transforms)
+        val_dl = PytorchDataLoader(val_dataset, batch_size=self.config.predict_batch_size, num_workers=self.num_workers, drop_last=False)
+        if models is None:
+            models = []
+            for fold in folds:
+                with span('albu.read_model', config=self.folder, fold=fold):
+                    models.append(read_model(self.folder, fold, self.device, precision=self.precision))
         pbar = tqdm.tqdm(val_dl, total=len(val_dl))
         for data in pbar:
-            samples = data['image']
-            predicted = predict(model, samples)
-            #predicted = predict8tta(model, samples, self.config.sigmoid)
-            self.process_batch(predicted, model, data, prefix=prefix)
-        self.post_predict_action(prefix=prefix)
+            for fold, model in zip(folds, models):
+                prefix = ('fold' + str(fold) + "_") if self.test else ""
+                with span('albu.batch', config=self.folder, fold=fold, images=list(data['image_name'])):
+                    predicted = predict(model, data['image'], transforms=self.tta, device=self.device)
+                    self.process_batch(predicted, model, data, prefix=prefix)
+        for fold in folds:
+            prefix = ('fold' + str(fold) + "_") if self.test else ""
+            with span('albu.post_predict', config=self.folder, fold=fold):
+                self.post_predict_action(prefix=prefix)
 
     def cut_border(self, image):
         if image is None:
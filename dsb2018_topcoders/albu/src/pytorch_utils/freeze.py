@@ -0,0 +1,140 @@
+import copy
+
+import torch
+from torch import nn
+
+# modules whose forward applies the batch norm right after the convolution, by class name because
+# the models are pickled with the classes of pytorch_zoo; sequences are handled in fold_batchnorm
+CONV_BN_PAIRS = {
+    'BasicBlock': [('conv1', 'bn1'), ('conv2', 'bn2')],
+    'Bottleneck': [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')],
+    'BasicConv2d': [('conv', 'bn')],
+    'InputBlock': [('conv', 'bn')],
+}
+
+
+class Identity(nn.Module):
+    def forward(self, x):
+        return x
+
+
+def fuse_conv_bn(conv, bn):
+    """
+    Convolution computing bn(conv(x)) of a batch norm in eval mode, None if they can not be fused
+    """
+    transposed = isinstance(conv, nn.ConvTranspose2d)
+    if bn.running_mean is None or (transposed and conv.groups > 1):
+        return None
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        if bn.weight is not None:
+            scale = scale * bn.weight
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        bias = (bias - bn.running_mean) * scale
+        if bn.bias is not None:
+            bias = bias + bn.bias
+        fused = copy.deepcopy(conv)
+        shape = (1, -1, 1, 1) if transposed else (-1, 1, 1, 1)
+        fused.weight = nn.Parameter(conv.weight * scale.view(shape))
+        fused.bias = nn.Parameter(bias)
+    return fused
+
+
+def _fold(parent, conv_name, bn_name):
+    conv, bn = parent._modules[conv_name], parent._modules[bn_name]
+    if not isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)) or not isinstance(bn, nn.BatchNorm2d):
+        return 0
+    fused = fuse_conv_bn(conv, bn)
+    if fused is None:
+        return 0
+    parent._modules[conv_name] = fused
+    parent._modules[bn_name] = Identity()
+    return 1
+
+
+def fold_batchnorm(model):
+    """
+    Folds every batch norm that directly follows a convolution into it: in nn.Sequential and in the blocks
+    of CONV_BN_PAIRS. New convolutions replace the old ones, so the model must be a copy if the original is used.
+    Batch norms in front of convolutions (the pre-activation blocks of DPN and WideResnet38) stay.
+
+    Returns
+    -------
+    folded : int
+        Number of folded batch norms
+    """
+    folded = 0
+    for module in list(model.modules()):
+        if isinstance(module, nn.Sequential):
+            names = list(module._modules)
+            for conv_name, bn_name in zip(names, names[1:]):
+                folded += _fold(module, conv_name, bn_name)
+        for conv_name, bn_name in CONV_BN_PAIRS.get(type(module).__name__, []):
+            if conv_name in module._modules and bn_name in module._modules:
+                folded += _fold(module, conv_name, bn_name)
+    return folded
+
+
+def freeze(model, example, optimize=True):
+    """
+    Traced copy of the model with folded batch norms, frozen (constant weights) and, with optimize on CPU,
+    optimized for inference (see optimize_frozen). Optimized models can not be saved
+    """
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    model = copy.deepcopy(model).eval()
+    fold_batchnorm(model)
+    with torch.no_grad():
+        frozen = torch.jit.trace(model, example)
+    if hasattr(torch.jit, 'freeze'):
+        frozen = torch.jit.freeze(frozen)
+    if optimize:
+        frozen = optimize_frozen(frozen, example.device)
+    return frozen
+
+
+def optimize_frozen(model, device):
+    """
+    Activations and the like fused into the convolutions of a frozen TorchScript model on CPU
+    where the torch version supports it, the model is returned as is otherwise
+    """
+    if torch.device(device).type == 'cpu' and hasattr(torch.jit, 'optimize_for_inference'):
+        return torch.jit.optimize_for_inference(model)
+    return model
+
+
+def max_difference(model, frozen, batch):
+    """
+    Largest absolute difference of the sigmoid outputs of the two models
+    """
+    with torch.no_grad():
+        return (torch.sigmoid(model(batch)) - torch.sigmoid(frozen(batch))).abs().max().item()
+
+
+def export_model(project, fold, num_channels, device=None, tile_size=1024, atol=1e-3):
+    """
+    Freezes the model of one fold traced on a tile_size tile and saves it to frozen_model_path unoptimized,
+    read_model optimizes it after loading.
+    The outputs are compared with the original model on the traced shape and on a smaller non-square one,
+    nothing is saved if they differ by more than atol
+
+    Returns
+    -------
+    path : str
+    difference : float
+        Largest difference of the sigmoid outputs
+    """
+    # eval imports the albu datasets and augmentations, folding and freezing do not need them
+    from .eval import frozen_model_path, get_device, read_model
+    device = get_device(device)
+    model = read_model(project, fold, device, frozen=False)
+    generator = torch.Generator().manual_seed(fold)
+    example = torch.rand(1, num_channels, tile_size, tile_size, generator=generator).to(device)
+    frozen = freeze(model, example, optimize=False)
+    check = torch.rand(1, num_channels, tile_size - 64, tile_size - 128, generator=generator).to(device)
+    difference = max(max_difference(model, frozen, example), max_difference(model, frozen, check))
+    if difference > atol:
+        raise ValueError('Frozen {} fold {} differs from the model by {:.2e}'.format(project, fold, difference))
+    path = frozen_model_path(project, fold, device)
+    torch.jit.save(frozen, path)
+    return path, difference
@@ -0,0 +1,82 @@
+import copy
+
+import torch
+from torch import nn
+try:
+    from torch.ao.quantization import get_default_qconfig
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+except ImportError:
+    from torch.quantization import get_default_qconfig
+    from torch.quantization.quantize_fx import convert_fx, prepare_fx
+try:
+    from torch.ao.quantization import get_default_qconfig_mapping
+except ImportError:
+    # torch < 1.13 takes a qconfig dict and no example inputs
+    get_default_qconfig_mapping = None
+from torch.utils.data.dataloader import DataLoader as PytorchDataLoader
+
+from dataset.bowl_image_types import PaddedImageType, PaddedSigmoidImageType
+from dataset.neural_dataset import SequentialDataset
+from dataset.reading_image_provider import InFolderImageProvider
+from .eval import quantized_model_path, read_model
+from .freeze import fold_batchnorm, max_difference
+
+
+def quantization_backend():
+    """
+    Quantized kernels of torch for this CPU, x86 where the torch version has them
+    """
+    engines = torch.backends.quantized.supported_engines
+    return 'x86' if 'x86' in engines else 'fbgemm'
+
+
+def calibration_batches(config, folder, images=16):
+    """
+    Network inputs of the first images of a folder laid out as the test data (<id>/images/<id>.png),
+    one image per batch because the images differ in size
+    """
+    image_type = PaddedSigmoidImageType if config.sigmoid else PaddedImageType
+    ds = InFolderImageProvider(image_type, {'images': folder})
+    dataset = SequentialDataset(ds, list(range(min(images, len(ds)))), stage='test', config=config)
+    return [data['image'] for data in PytorchDataLoader(dataset, batch_size=1)]
+
+
+def quantize(model, batches):
+    """
+    int8 copy of the model by post-training static quantization (torch FX graph mode): batch norms are folded,
+    activation ranges are observed on the calibration batches and weights are quantized per channel.
+    Returns the traced and frozen TorchScript model, it runs on CPU only
+    """
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    model = copy.deepcopy(model).cpu().eval()
+    fold_batchnorm(model)
+    backend = quantization_backend()
+    torch.backends.quantized.engine = backend
+    if get_default_qconfig_mapping is not None:
+        prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (batches[0],))
+    else:
+        prepared = prepare_fx(model, {'': get_default_qconfig(backend)})
+    with torch.no_grad():
+        for batch in batches:
+            prepared(batch)
+        quantized = convert_fx(prepared)
+        return torch.jit.freeze(torch.jit.trace(quantized, batches[0]))
+
+
+def export_quantized(project, fold, batches):
+    """
+    Quantizes the model of one fold on the calibration batches and saves it to quantized_model_path
+
+    Returns
+    -------
+    path : str
+    difference : float
+        Largest difference of the sigmoid outputs on the calibration batches
+    """
+    model = read_model(project, fold, 'cpu', frozen=False)
+    quantized = quantize(model, batches)
+    difference = max(max_difference(model, quantized, batch) for batch in batches)
+    path = quantized_model_path(project, fold)
+    torch.jit.save(quantized, path)
+    return path, difference
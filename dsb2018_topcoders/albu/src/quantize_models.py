@@ -0,0 +1,27 @@
+import argparse
+import json
+
+from config import Config
+from pytorch_utils.eval import set_threads
+from pytorch_utils.quantize import calibration_batches, export_quantized
+
+parser = argparse.ArgumentParser(description='Quantizes the fold models of a config to int8 for CPU inference, '
+                                             'bowl_train.py --precision int8 and AlbuPredictor use them')
+parser.add_argument('config_path')
+parser.add_argument('--calibration_folder', help='tiles laid out as the test data, the test data of the config '
+                                                 'if not set')
+parser.add_argument('--calibration_images', type=int, default=16)
+parser.add_argument('--folds', type=int, nargs='+', default=[0, 1, 2, 3])
+parser.add_argument('--threads', type=int)
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    set_threads(args.threads)
+    with open(args.config_path, 'r') as f:
+        cfg = json.load(f)
+        cfg['dataset_path'] = cfg['dataset_path'] + '_test'
+    config = Config(**cfg)
+    batches = calibration_batches(config, args.calibration_folder or config.dataset_path, args.calibration_images)
+    for fold in args.folds:
+        path, difference = export_quantized(config.folder, fold, batches)
+        print('{}: max difference {:.2e} on {} calibration images'.format(path, difference, len(batches)))
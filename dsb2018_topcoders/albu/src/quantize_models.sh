@@ -0,0 +1,3 @@
+python quantize_models.py ./configs/dpn_softmax_s2.json
+python quantize_models.py ./configs/dpn_sigmoid_s2.json
+python quantize_models.py ./configs/resnet_softmax_s2.json
@@ -1,3 +1,9 @@
+# the scripts import tracing, tta, image_cache, prediction_store and batching from the repository root
+python -c "import batching, image_cache, prediction_store, tracing, tta" || {
+    echo "The repository root must be on PYTHONPATH to run predict_test.sh (perform_segmentation sets it)" >&2
+    exit 1
+}
+
 pushd selim
 sh ./predict_test.sh
 popd
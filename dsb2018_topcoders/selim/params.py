@@ -37,5 +37,14 @@ arg('--out_root_dir', default='../predictions')
 arg('--out_masks_folder')
 arg('--models',  nargs='+')
 arg('--out_channels',  type=int, default=2)
+arg('--predict_batch_size', type=int, default=4)
+arg('--images_per_chunk', type=int, default=16)
+arg('--tta', default='none', help='policy of tta.py (none, lr, flips, d4) applied to every input')
+arg('--tta_scales', type=float, nargs='+', default=[1])
+arg('--precision', default='fp32', choices=['fp32', 'int8'], help='int8 runs the TFLite models of quantize_models.py')
+arg('--calibration_folder', help='tiles for quantize_models.py laid out as the test data, test_folder if not set')
+arg('--calibration_images', type=int, default=16)
+arg('--calibration_shapes', nargs='*', default=[], help='network input shapes HxW that quantize_models.py converts '
+                                                        'a model for besides the shapes of the calibration tiles')
 
 args = parser.parse_args()
@@ -1,14 +1,16 @@
 import os
 
-from params import args
+if __name__ == '__main__':
+    from params import args
 
-os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
 from keras.preprocessing.image import img_to_array, load_img
 
 from keras.applications.imagenet_utils import preprocess_input
 
 from models.model_factory import make_model
+from tflite_models import TFLiteModel, quantized_paths
 
 from os import path, mkdir, listdir
 import numpy as np
@@ -24,113 +26,177 @@ import timeit
 import cv2
 from tqdm import tqdm
 
-test_folder = args.test_folder
-test_pred = os.path.join(args.out_root_dir, args.out_masks_folder)
+from batching import BatchStats, predict_buckets
+from image_cache import get_cache, read_image
+from prediction_store import save_prediction
+from tta import predict_tta
+
+# precisions of load_models and --precision
+PRECISIONS = ('fp32', 'int8')
 
 all_ids = []
 all_images = []
 all_masks = []
 
-OUT_CHANNELS = args.out_channels
-
-def preprocess_inputs(x):
-    return preprocess_input(x, mode=args.preprocessing_function)
-
-if __name__ == '__main__':
-    t0 = timeit.default_timer()
-
-    weights = [os.path.join(args.models_dir, m) for m in args.models]
+def preprocess_inputs(x, preprocessing_function):
+    return preprocess_input(x, mode=preprocessing_function)
+
+def model_files(weights, precision='fp32'):
+    '''
+    Files of the models load_models reads for the .h5 weights at precision
+    '''
+    if precision == 'int8':
+        return [p for w in weights for _, p in sorted(quantized_paths(w).items())]
+    return list(weights)
+
+def load_models(network, weights, precision='fp32'):
+    '''
+    precision: 'fp32' for the keras weights, 'int8' for the TFLite models of quantize_models.py,
+    one per input shape of every weights file
+    '''
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision {}, use one of {}'.format(precision, PRECISIONS))
+    if precision == 'int8':
+        print("Loading int8 models {}".format(model_files(weights, precision)))
+        return [TFLiteModel(w) for w in weights]
     models = []
     for w in weights:
-        model = make_model(args.network, (None, None, 3))
-        print("Building model {} from weights {} ".format(args.network, w))
+        model = make_model(network, (None, None, 3))
+        print("Building model {} from weights {} ".format(network, w))
         model.load_weights(w)
         models.append(model)
-    os.makedirs(test_pred, exist_ok=True)
-    print('Predicting test')
-    for d in tqdm(listdir(test_folder)):
-        if not path.isdir(path.join(test_folder, d)):
-            continue
-        final_mask = None
-        for scale in range(1):
-            fid = d
-            img = cv2.imread(path.join(test_folder, fid, 'images', '{0}.png'.format(fid)), cv2.IMREAD_COLOR)[...,::-1]
-
-            if final_mask is None:
-                final_mask = np.zeros((img.shape[0], img.shape[1], OUT_CHANNELS))
-            if scale == 1:
-                img = cv2.resize(img, None, fx=0.75, fy=0.75, interpolation=cv2.INTER_AREA)
-            elif scale == 2:
-                img = cv2.resize(img, None, fx=1.25, fy=1.25, interpolation=cv2.INTER_CUBIC)
-
-            x0 = 16
-            y0 = 16
-            x1 = 16
-            y1 = 16
-            if (img.shape[1] % 32) != 0:
-                x0 = int((32 - img.shape[1] % 32) / 2)
-                x1 = (32 - img.shape[1] % 32) - x0
-                x0 += 16
-                x1 += 16
-            if (img.shape[0] % 32) != 0:
-                y0 = int((32 - img.shape[0] % 32) / 2)
-                y1 = (32 - img.shape[0] % 32) - y0
-                y0 += 16
-                y1 += 16
-            img0 = np.pad(img, ((y0, y1), (x0, x1), (0, 0)), 'symmetric')
-
-            # inp0 = []
-            # inp1 = []
-            # for flip in range(2):
-            #     for rot in range(4):
-            #         if flip > 0:
-            #             img = img0[::-1, ...]
-            #         else:
-            #             img = img0
-            #         if rot % 2 == 0:
-            #             inp0.append(np.rot90(img, k=rot))
-            #         else:
-            #             inp1.append(np.rot90(img, k=rot))
-            #
-            # inp0 = np.asarray(inp0)
-            # inp0 = preprocess_inputs(np.array(inp0, "float32"))
-            # inp1 = np.asarray(inp1)
-            # inp1 = preprocess_inputs(np.array(inp1, "float32"))
-
-            # mask = np.zeros((img0.shape[0], img0.shape[1], OUT_CHANNELS))
-
-            # for model in models:
-            #     pred0 = model.predict(inp0, batch_size=1)
-            #     pred1 = model.predict(inp1, batch_size=1)
-            #     j = -1
-            #     for flip in range(2):
-            #         for rot in range(4):
-            #             j += 1
-            #             if rot % 2 == 0:
-            #                 pr = np.rot90(pred0[int(j / 2)], k=(4 - rot))
-            #             else:
-            #                 pr = np.rot90(pred1[int(j / 2)], k=(4 - rot))
-            #             if flip > 0:
-            #                 pr = pr[::-1, ...]
-            #             mask += pr  # [..., :2]
-
-            mask = np.zeros((img0.shape[0], img0.shape[1], OUT_CHANNELS))
-            for model in models:
-                inp = preprocess_inputs(np.array([img0], "float32"))
-                pred = model.predict(inp)
-                mask += pred[0]
-
-            mask /= (len(models))
+    return models
+
+def scaled_shape(shape, scale):
+    '''
+    Height and width of cv2.resize(img, None, fx=scale, fy=scale) for img of shape
+    '''
+    if scale == 1:
+        return shape[:2]
+    return int(np.rint(shape[0] * scale)), int(np.rint(shape[1] * scale))
+
+def padding(shape):
+    '''
+    Padding (y0, y1, x0, x1) of an image of shape to a multiple of 32 with at least 16 pixels on every side
+    '''
+    x0 = 16
+    y0 = 16
+    x1 = 16
+    y1 = 16
+    if (shape[1] % 32) != 0:
+        x0 = int((32 - shape[1] % 32) / 2)
+        x1 = (32 - shape[1] % 32) - x0
+        x0 += 16
+        x1 += 16
+    if (shape[0] % 32) != 0:
+        y0 = int((32 - shape[0] % 32) / 2)
+        y1 = (32 - shape[0] % 32) - y0
+        y0 += 16
+        y1 += 16
+    return y0, y1, x0, x1
+
+def scale_input(image, scale):
+    '''
+    Padded network input of image at scale
+    '''
+    img = image
+    if scale != 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale,
+                         interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC)
+    y0, y1, x0, x1 = padding(img.shape)
+    return np.pad(img, ((y0, y1), (x0, x1), (0, 0)), 'symmetric')
+
+def scale_inputs(image, scales=(1,), cache=None, key=None):
+    '''
+    Padded network inputs of image at every scale, with the padding (y0, y1, x0, x1) to cut from the predictions
+    cache: image_cache.ImageCache, keeps the inputs under key for the other selim networks
+    '''
+    inputs = []
+    for scale in scales:
+        if cache is None or key is None:
+            img0 = scale_input(image, scale)
+        else:
+            img0 = cache.get(key, 'selim_input_{}'.format(scale), lambda: scale_input(image, scale))
+        inputs.append((img0, padding(scaled_shape(image.shape, scale))))
+    return inputs
+
+def predict_batch(models, batch, preprocessing_function, out_channels, transforms='none'):
+    '''
+    batch: stacked inputs of equal shape from scale_inputs
+    Returns the mean prediction of models and transforms for every input
+    '''
+    inp = preprocess_inputs(np.array(batch, "float32"), preprocessing_function)
+    mask = np.zeros(batch.shape[:3] + (out_channels,))
+    for model in models:
+        mask += predict_tta(lambda x: model.predict(x, batch_size=len(x)), inp, transforms)
+    mask /= (len(models))
+    return mask
+
+def predict_images(models, images, preprocessing_function, out_channels, batch_size=4, stats=None,
+                   transforms='none', scales=(1,), cache=None, keys=None):
+    '''
+    images: RGB uint8 images of shape (height, width, 3)
+    The inputs of all images and scales are grouped by shape and passed to the models in batches of batch_size,
+    every model gets all transforms (a policy name or transform names, see tta.py) of a batch in one call
+    where the shapes allow
+    cache, keys: image_cache.ImageCache and the keys of images, prepared inputs are taken from and kept in it
+    Returns uint8 masks of the same sizes with 3 channels, as written to out_masks_folder
+    '''
+    keys = keys if keys is not None else [None] * len(images)
+    inputs = [scale_inputs(image, scales, cache, key) for image, key in zip(images, keys)]
+    masks = iter(predict_buckets(lambda batch: predict_batch(models, batch, preprocessing_function, out_channels,
+                                                             transforms),
+                                 [img0 for image_inputs in inputs for img0, _ in image_inputs], batch_size, stats))
+    final_masks = []
+    for image, image_inputs in zip(images, inputs):
+        final_mask = np.zeros((image.shape[0], image.shape[1], out_channels))
+        for img0, (y0, y1, x0, x1) in image_inputs:
+            mask = next(masks)
             mask = mask[y0:mask.shape[0] - y1, x0:mask.shape[1] - x1, ...]
-            if scale > 0:
+            if mask.shape[:2] != final_mask.shape[:2]:
                 mask = cv2.resize(mask, (final_mask.shape[1], final_mask.shape[0]))
             final_mask += mask
-        final_mask /= 1
-        if OUT_CHANNELS == 2:
+        final_mask /= len(image_inputs)
+        if out_channels == 2:
             final_mask = np.concatenate([final_mask, np.zeros_like(final_mask)[..., 0:1]], axis=-1)
         final_mask = final_mask * 255
-        final_mask = final_mask.astype('uint8')
-        cv2.imwrite(path.join(test_pred, '{0}.png'.format(fid)), final_mask, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+        final_masks.append(final_mask.astype('uint8'))
+    return final_masks
+
+def predict_image(models, image, preprocessing_function, out_channels):
+    '''
+    image: RGB uint8 image of shape (height, width, 3)
+    Returns uint8 mask of the same size with 3 channels, as written to out_masks_folder
+    '''
+    return predict_images(models, [image], preprocessing_function, out_channels)[0]
+
+if __name__ == '__main__':
+    t0 = timeit.default_timer()
+
+    test_folder = args.test_folder
+    test_pred = os.path.join(args.out_root_dir, args.out_masks_folder)
+
+    weights = [os.path.join(args.models_dir, m) for m in args.models]
+    models = load_models(args.network, weights, args.precision)
+    os.makedirs(test_pred, exist_ok=True)
+    print('Predicting test')
+    stats = BatchStats()
+    cache = get_cache()
+    fids = [d for d in sorted(listdir(test_folder)) if path.isdir(path.join(test_folder, d))]
+    for start in tqdm(range(0, len(fids), args.images_per_chunk)):
+        chunk = fids[start:start + args.images_per_chunk]
+        paths = [path.join(test_folder, fid, 'images', '{0}.png'.format(fid)) for fid in chunk]
+        imgs = [read_image(p, cv2.IMREAD_COLOR)[...,::-1] for p in paths]
+        keys = [cache.file_key(p) for p in paths] if cache is not None else None
+        final_masks = predict_images(models, imgs, args.preprocessing_function, args.out_channels,
+                                     batch_size=args.predict_batch_size, stats=stats, transforms=args.tta,
+                                     scales=args.tta_scales, cache=cache, keys=keys)
+        for fid, final_mask in zip(chunk, final_masks):
+            save_prediction(test_pred, '{0}.png'.format(fid), final_mask, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+    if stats is not None:
+        print(stats.report())
+    if cache is not None:
+        print(cache.report())
 
     elapsed = timeit.default_timer() - t0
     print('Time: {:.3f} min'.format(elapsed / 60))
\ No newline at end of file
@@ -0,0 +1,81 @@
+import os
+
+if __name__ == '__main__':
+    from params import args
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+
+from os import path, listdir
+
+import cv2
+import numpy as np
+from keras import backend as K
+
+from models.model_factory import make_model
+from pred_test import preprocess_inputs, scale_input
+from tflite_models import TFLiteModel, convert, quantized_path
+
+
+def calibration_images(folder, images=16):
+    '''
+    RGB images of the first tiles of folder (laid out as the test data)
+    '''
+    fids = [d for d in sorted(listdir(folder)) if path.isdir(path.join(folder, d))][:images]
+    return [cv2.imread(path.join(folder, fid, 'images', '{0}.png'.format(fid)), cv2.IMREAD_COLOR)[..., ::-1]
+            for fid in fids]
+
+
+def input_shapes(images, scales=(1,)):
+    '''
+    Distinct shapes (height, width) of the padded network inputs of images at scales, see pred_test.scale_input
+    '''
+    return sorted({scale_input(img, scale).shape[:2] for img in images for scale in scales})
+
+
+def parse_shape(shape):
+    '''
+    (height, width) of 'HxW'
+    '''
+    height, width = shape.lower().split('x')
+    return int(height), int(width)
+
+
+def calibration_inputs(images, preprocessing_function, shape, seed=1):
+    '''
+    Preprocessed crops of shape (height, width) of the padded network inputs of images,
+    inputs smaller than shape are padded symmetrically first
+    '''
+    rng = np.random.RandomState(seed)
+    inputs = []
+    for img in images:
+        img0 = scale_input(img, 1)
+        img0 = np.pad(img0, ((0, max(0, shape[0] - img0.shape[0])), (0, max(0, shape[1] - img0.shape[1])), (0, 0)),
+                      'symmetric')
+        y0 = rng.randint(0, img0.shape[0] - shape[0] + 1)
+        x0 = rng.randint(0, img0.shape[1] - shape[1] + 1)
+        inputs.append(preprocess_inputs(np.array(img0[y0:y0 + shape[0], x0:x0 + shape[1]], "float32"),
+                                        preprocessing_function))
+    return inputs
+
+
+if __name__ == '__main__':
+    images = calibration_images(args.calibration_folder or args.test_folder, args.calibration_images)
+    shapes = sorted(set(input_shapes(images, args.tta_scales)) | {parse_shape(s) for s in args.calibration_shapes})
+    print('Input shapes {}'.format(', '.join('{}x{}'.format(*shape) for shape in shapes)))
+    for m in args.models:
+        weights = path.join(args.models_dir, m)
+        for shape in shapes:
+            inputs = calibration_inputs(images, args.preprocessing_function, shape)
+            # the TF 1.15 converter needs a graph with a fixed input shape and without the training branches
+            K.clear_session()
+            K.set_learning_phase(0)
+            model = make_model(args.network, shape + (3,))
+            print("Quantizing model {} from weights {} for {}x{} inputs".format(args.network, weights, *shape))
+            model.load_weights(weights)
+            with open(quantized_path(weights, shape), 'wb') as f:
+                f.write(convert(model, inputs))
+            int8_model = TFLiteModel(weights)
+            difference = max(np.abs(model.predict(x[np.newaxis]) - int8_model.predict(x[np.newaxis])).max()
+                             for x in inputs)
+            print('{}: max difference {:.2e} on {} calibration inputs'.format(quantized_path(weights, shape),
+                                                                            difference, len(inputs)))
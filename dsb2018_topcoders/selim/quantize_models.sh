@@ -0,0 +1,25 @@
+#!/usr/bin/env bash
+########## int8 models for pred_test.py --precision int8, calibrated on the test tiles #############
+########## one model per input shape: the shapes of the test tiles and of the 1000 px slide tiles #
+python quantize_models.py \
+--gpu 0 \
+--calibration_shapes 1056x1056 \
+--preprocessing_function caffe \
+--network resnet101_2 \
+--models_dir nn_models \
+--models best_resnet101_2_fold0.h5 best_resnet101_2_fold1.h5 best_resnet101_2_fold2.h5 best_resnet101_2_fold3.h5
+
+python quantize_models.py \
+--gpu 0 \
+--calibration_shapes 1056x1056 \
+--preprocessing_function torch \
+--network densenet169_softmax \
+--models_dir nn_models \
+--models best_densenet169_softmax_fold0.h5 best_densenet169_softmax_fold1.h5 best_densenet169_softmax_fold2.h5 best_densenet169_softmax_fold3.h5
+
+python quantize_models.py \
+--gpu 0 \
+--calibration_shapes 1056x1056 \
+--preprocessing_function caffe \
+--network resnet152_2 \
+--models best_resnet152_2_fold0.h5 best_resnet152_2_fold1.h5 best_resnet152_2_fold2.h5 best_resnet152_2_fold3.h5
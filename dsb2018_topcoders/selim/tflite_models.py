@@ -0,0 +1,89 @@
+import os
+import re
+from glob import escape, glob
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+
+
+def quantized_path(weights, shape):
+    '''
+    TFLite int8 model written by quantize_models.py for a .h5 weights file and network inputs of shape (height, width)
+    '''
+    return '{}.int8.{}x{}.tflite'.format(os.path.splitext(weights)[0], shape[0], shape[1])
+
+
+def quantized_paths(weights):
+    '''
+    All TFLite int8 models of a .h5 weights file by input shape (height, width)
+    '''
+    base = os.path.splitext(weights)[0]
+    paths = {}
+    for p in glob(escape(base) + '.int8.*x*.tflite'):
+        match = re.match(r'^(\d+)x(\d+)$', p[len(base) + len('.int8.'):-len('.tflite')])
+        if match:
+            paths[(int(match.group(1)), int(match.group(2)))] = p
+    return paths
+
+
+def convert(model, calibration_inputs):
+    '''
+    Post-training int8 quantization of a keras model with the session converter of TensorFlow 1.15.
+    The converter needs every input dimension but the batch, so the model has to be built with a fixed
+    input shape (height, width, 3) after K.set_learning_phase(0), one model per input shape.
+    calibration_inputs: preprocessed float32 inputs of that shape, activation ranges are taken from them.
+    Inputs and outputs stay float32, ops without int8 kernels stay float
+    Returns the TFLite flatbuffer
+    '''
+    def representative_dataset():
+        for x in calibration_inputs:
+            yield [np.asarray(x, 'float32')[np.newaxis]]
+
+    converter = tf.lite.TFLiteConverter.from_session(K.get_session(), model.inputs, model.outputs)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+    return converter.convert()
+
+
+class TFLiteModel:
+    '''
+    int8 models of one weights file with the predict method of keras models that pred_test.py uses.
+    An input runs in the model of the smallest shape that holds it, padded at the bottom and right
+    and cropped back, so models for the common tile shapes cover the tiles at the slide borders too
+    '''
+    def __init__(self, weights):
+        self.paths = quantized_paths(weights)
+        if not self.paths:
+            raise IOError('No int8 models for {}, run quantize_models.py first'.format(weights))
+        self.interpreters = {}
+
+    def model_shape(self, shape):
+        fitting = [s for s in self.paths if s[0] >= shape[0] and s[1] >= shape[1]]
+        if not fitting:
+            raise ValueError('No int8 model holds inputs of {}x{}, the models are for {}, add the shape to '
+                             'quantize_models.py --calibration_shapes'.format(shape[0], shape[1],
+                                                                              sorted(self.paths)))
+        return min(fitting, key=lambda s: (s[0] * s[1], s))
+
+    def _interpreter(self, shape):
+        if shape not in self.interpreters:
+            interpreter = tf.lite.Interpreter(model_path=self.paths[shape])
+            interpreter.allocate_tensors()
+            self.interpreters[shape] = interpreter
+        return self.interpreters[shape]
+
+    def predict(self, x, batch_size=None):
+        x = np.asarray(x, 'float32')
+        shape = self.model_shape(x.shape[1:3])
+        interpreter = self._interpreter(shape)
+        input_index = interpreter.get_input_details()[0]['index']
+        output_index = interpreter.get_output_details()[0]['index']
+        pad = ((0, shape[0] - x.shape[1]), (0, shape[1] - x.shape[2]), (0, 0))
+        preds = []
+        # converted with batch size 1
+        for item in x:
+            interpreter.set_tensor(input_index, np.pad(item, pad, 'symmetric')[np.newaxis])
+            interpreter.invoke()
+            preds.append(interpreter.get_tensor(output_index)[0, :x.shape[1], :x.shape[2]])
+        return np.stack(preds)
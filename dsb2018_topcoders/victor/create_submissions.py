@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from os import path, listdir, mkdir
+from os import path, mkdir
 import numpy as np
 np.random.seed(1)
 import random
@@ -12,6 +12,8 @@ from multiprocessing import Pool
 import lightgbm as lgb
 from train_classifier import get_inputs
 import pandas as pd
+from prediction_store import list_predictions
+from tracing import span
 
 data_folder = path.join('..', 'data')
 pred_folder = path.join('..', 'predictions')
@@ -55,6 +57,73 @@ def pred_to_rles(y_pred):
         yield rle_encoding(y_pred == i)
         
             
+def load_gbm_models(lgbm_models_folder=lgbm_models_folder):
+    gbm_models = []
+    for it in range(num_split_iters):
+        for it2 in range(folds_count):
+            gbm_models.append(lgb.Booster(model_file=path.join(lgbm_models_folder, 'gbm_model_{0}_{1}.txt'.format(it, it2))))
+    return gbm_models
+
+def create_labels(gbm_models, inputs, labels, inputs2, labels2, separated_regions, thr):
+    '''
+    Classifies candidate nuclei from get_inputs with the LightGBM ensemble
+    Returns uint16 label image, removed and replaced counts, and bst_k histogram
+    '''
+    bst_k = np.zeros((sep_count+1))
+    removed = 0
+    replaced = 0
+    pred = np.zeros((inputs.shape[0]))
+    pred2 = [np.zeros((inp2.shape[0])) for inp2 in inputs2]
+    
+    for m in gbm_models:
+        if pred.shape[0] > 0:
+            pred += m.predict(inputs)
+        for k in range(len(inputs2)):
+            if pred2[k].shape[0] > 0:
+                pred2[k] += m.predict(inputs2[k])
+    if pred.shape[0] > 0:
+        pred /= len(gbm_models)
+    for k in range(len(pred2)):
+        if pred2[k].shape[0] > 0:
+            pred2[k] /= len(gbm_models)
+    
+    pred_labels = np.zeros_like(labels, dtype='uint16')
+    
+    clr = 1
+    
+    for i in range(pred.shape[0]):
+        max_sep = -1
+        max_pr = pred[i]
+        for k in range(len(separated_regions)):
+            if len(separated_regions[k][i]) > 0:
+                pred_lvl2 = pred2[k][separated_regions[k][i]]
+                if len(pred_lvl2) > 1 and pred_lvl2.mean() > max_pr:
+                    max_sep = k
+                    max_pr = pred_lvl2.mean()
+                    break
+                if len(pred_lvl2) > 1 and pred_lvl2.max() > max_pr:
+                    max_sep = k
+                    max_pr = pred_lvl2.max()
+                    
+        if max_sep >= 0:
+            pred_lvl2 = pred2[max_sep][separated_regions[max_sep][i]]
+            replaced += 1
+            for j in separated_regions[max_sep][i]:
+                if pred2[max_sep][j] > thr:
+                    pred_labels[labels2[max_sep] == j+1] = clr
+                    clr += 1
+                else:
+                    removed += 1
+        else:
+            if pred[i] > thr:
+                pred_labels[labels == i+1] = clr
+                clr += 1
+            else:
+                removed += 1
+        bst_k[max_sep+1] += 1
+        
+    return pred_labels, removed, replaced, bst_k
+
 if __name__ == '__main__':
     t0 = timeit.default_timer()
     
@@ -77,16 +146,13 @@ if __name__ == '__main__':
     fns = []
     paramss = []
     
-    gbm_models = []
-    
-    for it in range(num_split_iters):
-        for it2 in range(folds_count):
-            gbm_models.append(lgb.Booster(model_file=path.join(lgbm_models_folder, 'gbm_model_{0}_{1}.txt'.format(it, it2))))
+    with span('create_submissions.load_gbm_models'):
+        gbm_models = load_gbm_models()
     
     inputs = []
     paramss = []
-    for f in tqdm(sorted(listdir(test_pred_folder))):
-        if path.isfile(path.join(test_pred_folder, f)) and '.png' in f:
+    for f in tqdm(list_predictions(test_pred_folder)):
+        if '.png' in f:
             img_id = f.split('.')[0]
             paramss.append((f, test_pred_folder, path.join(test_images_folder, img_id, 'images'), None, extend_mask_test))
     
@@ -95,8 +161,9 @@ if __name__ == '__main__':
     labels= []
     labels2 = []
     separated_regions= []
-    with Pool(processes=DATA_THREADS) as pool:
-        results = pool.starmap(get_inputs, paramss)
+    with span('create_submissions.get_inputs', tiles=len(paramss)):
+        with Pool(processes=DATA_THREADS) as pool:
+            results = pool.starmap(get_inputs, paramss)
     for i in range(len(results)):
         inp, lbl, inp2, lbl2, sep_regs = results[i]
         inputs.append(inp)
@@ -119,60 +186,17 @@ if __name__ == '__main__':
         
         empty_cnt = 0
         
-        for f in tqdm(sorted(listdir(test_pred_folder))):
-            if path.isfile(path.join(test_pred_folder, f)) and '.png' in f:
+        for f in tqdm(list_predictions(test_pred_folder)):
+            if '.png' in f:
                 img_id = f.split('.')[0]
                 
-                inp = inputs[im_idx]
-                pred = np.zeros((inp.shape[0]))
-                pred2 = [np.zeros((inp2.shape[0])) for inp2 in inputs2[im_idx]]
-                
-                for m in gbm_models:
-                    if pred.shape[0] > 0:
-                        pred += m.predict(inp)
-                    for k in range(len(inputs2[im_idx])):
-                        if pred2[k].shape[0] > 0:
-                            pred2[k] += m.predict(inputs2[im_idx][k])
-                if pred.shape[0] > 0:
-                    pred /= len(gbm_models)
-                for k in range(len(pred2)):
-                    if pred2[k].shape[0] > 0:
-                        pred2[k] /= len(gbm_models)
-                
-                pred_labels = np.zeros_like(labels[im_idx], dtype='uint16')
-                
-                clr = 1
-                
-                for i in range(pred.shape[0]):
-                    max_sep = -1
-                    max_pr = pred[i]
-                    for k in range(len(separated_regions[im_idx])):
-                        if len(separated_regions[im_idx][k][i]) > 0:
-                            pred_lvl2 = pred2[k][separated_regions[im_idx][k][i]]
-                            if len(pred_lvl2) > 1 and pred_lvl2.mean() > max_pr:
-                                max_sep = k
-                                max_pr = pred_lvl2.mean()
-                                break
-                            if len(pred_lvl2) > 1 and pred_lvl2.max() > max_pr:
-                                max_sep = k
-                                max_pr = pred_lvl2.max()
-                                
-                    if max_sep >= 0:
-                        pred_lvl2 = pred2[max_sep][separated_regions[im_idx][max_sep][i]]
-                        replaced += 1
-                        for j in separated_regions[im_idx][max_sep][i]:
-                            if pred2[max_sep][j] > best_thrs[sub_id]:
-                                pred_labels[labels2[im_idx][max_sep] == j+1] = clr
-                                clr += 1
-                            else:
-                                removed += 1
-                    else:
-                        if pred[i] > best_thrs[sub_id]:
-                            pred_labels[labels[im_idx] == i+1] = clr
-                            clr += 1
-                        else:
-                            removed += 1
-                    bst_k[max_sep+1] += 1
+                with span('create_submissions.create_labels', tile=img_id, sub_id=sub_id):
+                    pred_labels, im_removed, im_replaced, im_bst_k = create_labels(gbm_models, inputs[im_idx], labels[im_idx],
+                                                                                   inputs2[im_idx], labels2[im_idx],
+                                                                                   separated_regions[im_idx], best_thrs[sub_id])
+                removed += im_removed
+                replaced += im_replaced
+                bst_k += im_bst_k
                     
                 total_cnt += pred_labels.max()
         
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from os import path, mkdir, listdir
+from os import path, mkdir
 import numpy as np
 np.random.seed(1)
 import random
@@ -9,6 +9,8 @@ tf.set_random_seed(1)
 import timeit
 import cv2
 from tqdm import tqdm
+from prediction_store import list_predictions, load_prediction, save_prediction
+from tracing import span
 
 pred_folders = [
         ('dpn_softmax_f0', 'dpn_softmax_f0_test', 1),
@@ -25,6 +27,64 @@ out_folder = path.join('..', 'predictions')
 test_out = path.join(out_folder, 'merged_test')
 test_extend_out = path.join(out_folder, 'merged_extend_test')
 
+# the extend mask is the mean of the first channel of these outputs, the channels of the first are swapped
+extend_folders = ['dpn_sigm_f0_test', 'pred_resnet101_full_masks']
+swapped_folders = ['dpn_sigm_f0_test']
+
+class EnsembleAccumulator(object):
+    '''
+    Running weighted sum of the pred_folders outputs per image, fed one model at a time,
+    so model outputs can be dropped as soon as they are added.
+    Weights are integers and predictions uint8, so the sums are exact and do not depend on the order.
+    '''
+    def __init__(self):
+        self.weights = {p[1]: p[2] for p in pred_folders}
+        self.w_sum = np.sum(list(self.weights.values()))
+        self.pred_sums = {}
+        self.ext_sums = {}
+        self.added = {}
+
+    def add(self, image_id, folder, pred):
+        pred = pred.astype('float32')
+        if image_id not in self.pred_sums:
+            self.pred_sums[image_id] = np.zeros_like(pred)
+            self.ext_sums[image_id] = np.zeros_like(pred)
+            self.added[image_id] = set()
+        if folder in extend_folders:
+            self.ext_sums[image_id][..., 0] += pred[..., 0]
+        if folder in swapped_folders:
+            pred = pred[..., ::-1]
+        pred *= self.weights[folder]
+        self.pred_sums[image_id] += pred
+        self.added[image_id].add(folder)
+
+    def ready(self, image_id):
+        return len(self.added.get(image_id, ())) == len(self.weights)
+
+    def pop(self, image_id):
+        '''
+        Returns merged prediction and extend mask as stored in merged_test and merged_extend_test
+        '''
+        if not self.ready(image_id):
+            missing = set(self.weights) - self.added.get(image_id, set())
+            raise ValueError('{} misses predictions of {}'.format(image_id, sorted(missing)))
+        pred_res = self.pred_sums.pop(image_id)
+        ext_res = self.ext_sums.pop(image_id)
+        del self.added[image_id]
+        pred_res /= self.w_sum
+        ext_res /= len(extend_folders)
+        return pred_res.astype('uint8'), ext_res.astype('uint8')
+
+def merge_predictions(preds):
+    '''
+    preds: uint8 predictions of one image, in the pred_folders order
+    Returns merged prediction and extend mask as stored in merged_test and merged_extend_test
+    '''
+    acc = EnsembleAccumulator()
+    for p, pred in zip(pred_folders, preds):
+        acc.add(0, p[1], pred)
+    return acc.pop(0)
+
 if __name__ == '__main__':
     t0 = timeit.default_timer()
 
@@ -33,29 +93,15 @@ if __name__ == '__main__':
     if not path.isdir(test_extend_out):
         mkdir(test_extend_out)
         
-    w_sum = np.sum([p[2] for p in pred_folders])            
-            
-    for f in tqdm(sorted(listdir(path.join(out_folder, pred_folders[0][1])))):
-        if path.isfile(path.join(out_folder, pred_folders[0][1], f)) and '.png' in f:
-            pred_res = None
-            ext_res = None
-            for i in range(len(pred_folders)):
-                pred = cv2.imread(path.join(out_folder, pred_folders[i][1], f), cv2.IMREAD_UNCHANGED).astype('float32')
-                if pred_res is None:
-                    pred_res = np.zeros_like(pred)
-                    ext_res = np.zeros_like(pred)
-                if i in [2, 5]:
-                    ext_res[..., 0] += pred[..., 0]
-                if i == 2:
-                    pred = pred[..., ::-1]
-                pred *= pred_folders[i][2]
-                pred_res += pred
-            pred_res /= w_sum
-            ext_res /= 2
-            pred_res = pred_res.astype('uint8')
-            ext_res = ext_res.astype('uint8')
-            cv2.imwrite(path.join(test_out, f), pred_res, [cv2.IMWRITE_PNG_COMPRESSION, 9])
-            cv2.imwrite(path.join(test_extend_out, f), ext_res, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+    for f in tqdm(list_predictions(path.join(out_folder, pred_folders[0][1]))):
+        if '.png' in f:
+            with span('merge_test', tile=f):
+                acc = EnsembleAccumulator()
+                for p in pred_folders:
+                    acc.add(f, p[1], load_prediction(path.join(out_folder, p[1]), f))
+                pred_res, ext_res = acc.pop(f)
+                save_prediction(test_out, f, pred_res, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+                save_prediction(test_extend_out, f, ext_res, [cv2.IMWRITE_PNG_COMPRESSION, 9])
             
     elapsed = timeit.default_timer() - t0
     print('Time: {:.3f} min'.format(elapsed / 60))
\ No newline at end of file
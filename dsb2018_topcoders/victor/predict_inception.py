@@ -12,11 +12,24 @@ import timeit
 import cv2
 from models import get_inception_resnet_v2_unet_softmax
 from tqdm import tqdm
+from batching import BatchStats, predict_buckets
+from image_cache import get_cache, read_image
+from prediction_store import save_prediction
+from tracing import span
+from tta import predict_tta
 
 test_folder = path.join('..', 'data_test')
 
 models_folder = 'nn_models'
+weights_file = 'inception_resnet_v2_weights_{0}.h5'
 test_pred = path.join('..', 'predictions', 'inception_test_pred_4')
+# inputs of equal shape passed to a model at once, images read and predicted together
+batch_size = 4
+images_per_chunk = 16
+# test time augmentation: dihedral transforms of every input (a policy name or transform names, see tta.py)
+# and scales of the image, every combination costs one forward pass of every fold
+tta_transforms = 'none'
+tta_scales = [1, 0.75, 1.25]
 
 all_ids = []
 all_images = []
@@ -39,6 +52,121 @@ def bgr_to_lab(img):
     return lab[..., np.newaxis]
 
 
+def load_models(models_folder=models_folder):
+    models = []
+    for it in range(4):
+        model = get_inception_resnet_v2_unet_softmax((None, None), weights=None)
+        model.load_weights(path.join(models_folder, weights_file.format(it)))
+        models.append(model)
+    return models
+
+
+def scaled_shape(shape, scale):
+    '''
+    Height and width of cv2.resize(img, None, fx=scale, fy=scale) for img of shape
+    '''
+    if scale == 1:
+        return shape[:2]
+    return int(np.rint(shape[0] * scale)), int(np.rint(shape[1] * scale))
+
+
+def padding(shape):
+    '''
+    Padding (y0, y1, x0, x1) of an image of shape to a multiple of 32 with at least 16 pixels on every side
+    '''
+    x0 = 16
+    y0 = 16
+    x1 = 16
+    y1 = 16
+    if (shape[1] % 32) != 0:
+        x0 = int((32 - shape[1] % 32) / 2)
+        x1 = (32 - shape[1] % 32) - x0
+        x0 += 16
+        x1 += 16
+    if (shape[0] % 32) != 0:
+        y0 = int((32 - shape[0] % 32) / 2)
+        y1 = (32 - shape[0] % 32) - y0
+        y0 += 16
+        y1 += 16
+    return y0, y1, x0, x1
+
+
+def scale_input(image, scale):
+    '''
+    Padded network input of image at scale with the LAB channel
+    '''
+    img = image
+    if scale != 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale)
+    y0, y1, x0, x1 = padding(img.shape)
+    img0 = np.pad(img, ((y0, y1), (x0, x1), (0, 0)), 'symmetric')
+    return np.concatenate([img0, bgr_to_lab(img0)], axis=2)
+
+
+def scale_inputs(image, scales=tta_scales, cache=None, key=None):
+    '''
+    Padded network inputs of image at every scale, with the padding (y0, y1, x0, x1) to cut from the predictions
+    cache: image_cache.ImageCache, keeps the inputs under key for the other victor scripts and predictors
+    '''
+    inputs = []
+    for scale in scales:
+        if cache is None or key is None:
+            img0 = scale_input(image, scale)
+        else:
+            img0 = cache.get(key, 'victor_input_{}'.format(scale), lambda: scale_input(image, scale))
+        inputs.append((img0, padding(scaled_shape(image.shape, scale))))
+    return inputs
+
+
+def predict_batch(models, batch, transforms=tta_transforms):
+    '''
+    batch: stacked inputs of equal shape from scale_inputs
+    Returns the mean prediction of models and transforms for every input
+    '''
+    inp = preprocess_inputs(batch)
+    mask = np.zeros(batch.shape[:3] + (3,))
+    for model in models:
+        mask += predict_tta(lambda x: model.predict(x, batch_size=len(x)), inp, transforms)
+    mask /= len(models)
+    return mask
+
+
+def predict_images(models, images, batch_size=batch_size, stats=None, transforms=tta_transforms, scales=tta_scales,
+                   cache=None, keys=None):
+    '''
+    images: BGR uint8 images of shape (height, width, 3)
+    The inputs of all images and scales are grouped by shape and passed to the models in batches of batch_size,
+    every model gets all transforms of a batch in one call where the shapes allow
+    cache, keys: image_cache.ImageCache and the keys of images, prepared inputs are taken from and kept in it
+    Returns uint8 probability masks of the same sizes, as stored in inception_test_pred_4
+    '''
+    keys = keys if keys is not None else [None] * len(images)
+    inputs = [scale_inputs(image, scales, cache, key) for image, key in zip(images, keys)]
+    masks = iter(predict_buckets(lambda batch: predict_batch(models, batch, transforms),
+                                 [img0 for image_inputs in inputs for img0, _ in image_inputs], batch_size, stats))
+    final_masks = []
+    for image, image_inputs in zip(images, inputs):
+        final_mask = np.zeros((image.shape[0], image.shape[1], 3))
+        for img0, (y0, y1, x0, x1) in image_inputs:
+            mask = next(masks)
+            mask = mask[y0:mask.shape[0] - y1, x0:mask.shape[1] - x1, ...]
+            if mask.shape[:2] != final_mask.shape[:2]:
+                mask = cv2.resize(mask, (final_mask.shape[1], final_mask.shape[0]))
+            final_mask += mask
+        final_mask /= len(image_inputs)
+        final_mask = final_mask * 255
+        final_masks.append(final_mask.astype('uint8'))
+    return final_masks
+
+
+def predict_image(models, image):
+    '''
+    image: BGR uint8 image of shape (height, width, 3)
+    Returns uint8 probability mask of the same size, as stored in inception_test_pred_4
+    '''
+    return predict_images(models, [image])[0]
+
+
 if __name__ == '__main__':
     t0 = timeit.default_timer()
 
@@ -47,97 +175,25 @@ if __name__ == '__main__':
 
     print('Loading models')
 
-    models = []
-
-    for it in range(4):
-        model = get_inception_resnet_v2_unet_softmax((None, None), weights=None)
-        model.load_weights(path.join(models_folder, 'inception_resnet_v2_weights_{0}.h5'.format(it)))
-        models.append(model)
+    with span('predict_inception.load_models'):
+        models = load_models()
 
     print('Predicting test')
-    for d in tqdm(listdir(test_folder)):
-        if not path.isdir(path.join(test_folder, d)):
-            continue
-        final_mask = None
-        for scale in range(3):
-            fid = d
-            img = cv2.imread(path.join(test_folder, fid, 'images', '{0}.png'.format(fid)), cv2.IMREAD_COLOR)
-            if final_mask is None:
-                final_mask = np.zeros((img.shape[0], img.shape[1], 3))
-            if scale == 1:
-                img = cv2.resize(img, None, fx=0.75, fy=0.75)
-            elif scale == 2:
-                img = cv2.resize(img, None, fx=1.25, fy=1.25)
-            elif scale == 3:
-                img = cv2.resize(img, None, fx=1.5, fy=1.5)
-
-            x0 = 16
-            y0 = 16
-            x1 = 16
-            y1 = 16
-            if (img.shape[1] % 32) != 0:
-                x0 = int((32 - img.shape[1] % 32) / 2)
-                x1 = (32 - img.shape[1] % 32) - x0
-                x0 += 16
-                x1 += 16
-            if (img.shape[0] % 32) != 0:
-                y0 = int((32 - img.shape[0] % 32) / 2)
-                y1 = (32 - img.shape[0] % 32) - y0
-                y0 += 16
-                y1 += 16
-            img0 = np.pad(img, ((y0, y1), (x0, x1), (0, 0)), 'symmetric')
-            img0 = np.concatenate([img0, bgr_to_lab(img0)], axis=2)
-
-            # inp0 = []
-            # inp1 = []
-            # for flip in range(2):
-            #     for rot in range(4):
-            #         if flip > 0:
-            #             img = img0[::-1, ...]
-            #         else:
-            #             img = img0
-            #         if rot % 2 == 0:
-            #             inp0.append(np.rot90(img, k=rot))
-            #         else:
-            #             inp1.append(np.rot90(img, k=rot))
-            #
-            # inp0 = np.asarray(inp0)
-            # inp0 = preprocess_inputs(np.array(inp0, "float32"))
-            # inp1 = np.asarray(inp1)
-            # inp1 = preprocess_inputs(np.array(inp1, "float32"))
-
-            # mask = np.zeros((img0.shape[0], img0.shape[1], OUT_CHANNELS))
-
-            # for model in models:
-            #     pred0 = model.predict(inp0, batch_size=1)
-            #     pred1 = model.predict(inp1, batch_size=1)
-            #     j = -1
-            #     for flip in range(2):
-            #         for rot in range(4):
-            #             j += 1
-            #             if rot % 2 == 0:
-            #                 pr = np.rot90(pred0[int(j / 2)], k=(4 - rot))
-            #             else:
-            #                 pr = np.rot90(pred1[int(j / 2)], k=(4 - rot))
-            #             if flip > 0:
-            #                 pr = pr[::-1, ...]
-            #             mask += pr  # [..., :2]
-
-            mask = np.zeros((img0.shape[0], img0.shape[1], 3))
-            for model in models:
-                inp = preprocess_inputs(np.array([img0], "float32"))
-                pred = model.predict(inp)
-                mask += pred[0]
-
-            mask /= (len(models))
-            mask = mask[y0:mask.shape[0] - y1, x0:mask.shape[1] - x1, ...]
-            if scale > 0:
-                mask = cv2.resize(mask, (final_mask.shape[1], final_mask.shape[0]))
-            final_mask += mask
-        final_mask /= 3
-        final_mask = final_mask * 255
-        final_mask = final_mask.astype('uint8')
-        cv2.imwrite(path.join(test_pred, '{0}.png'.format(fid)), final_mask, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+    stats = BatchStats()
+    cache = get_cache()
+    fids = [d for d in sorted(listdir(test_folder)) if path.isdir(path.join(test_folder, d))]
+    for start in tqdm(range(0, len(fids), images_per_chunk)):
+        chunk = fids[start:start + images_per_chunk]
+        with span('predict_inception', tiles=chunk):
+            paths = [path.join(test_folder, fid, 'images', '{0}.png'.format(fid)) for fid in chunk]
+            imgs = [read_image(p, cv2.IMREAD_COLOR) for p in paths]
+            keys = [cache.file_key(p) for p in paths] if cache is not None else None
+            for fid, final_mask in zip(chunk, predict_images(models, imgs, stats=stats, cache=cache, keys=keys)):
+                save_prediction(test_pred, '{0}.png'.format(fid), final_mask, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+    if stats is not None:
+        print(stats.report())
+    if cache is not None:
+        print(cache.report())
 
     elapsed = timeit.default_timer() - t0
     print('Time: {:.3f} min'.format(elapsed / 60))
@@ -18,6 +18,8 @@ import pandas as pd
 import math
 import numpy as np
 
+from prediction_store import load_prediction
+
 data_folder = path.join('..', 'data')
 pred_folder = path.join('..', 'predictions')
 
@@ -46,8 +48,15 @@ sep_count = 3
 sep_thresholds = [0.6, 0.7, 0.8]
     
 def get_inputs(filename, pred_folder, img_folder, truth_folder=None, extend_mask_folder=None):
+    pred = load_prediction(pred_folder, filename)
+    ext_pred = load_prediction(extend_mask_folder, filename)
+    truth_labels = None
+    if truth_folder is not None:
+        truth_labels = cv2.imread(path.join(truth_folder, filename.replace('.png', '.tif')), cv2.IMREAD_UNCHANGED)
+    return get_inputs_from_arrays(pred, ext_pred, truth_labels)
+
+def get_inputs_from_arrays(pred, ext_pred=None, truth_labels=None):
     inputs = []    
-    pred = cv2.imread(path.join(pred_folder, filename), cv2.IMREAD_UNCHANGED)
     
     pred_msk = pred / 255.
     pred_msk = pred_msk[..., 0] * (1 - pred_msk[..., 1])
@@ -72,7 +81,6 @@ def get_inputs(filename, pred_folder, img_folder, truth_folder=None, extend_mask
     else:
         mean_pred = 0
     
-    ext_pred = cv2.imread(path.join(extend_mask_folder, filename), cv2.IMREAD_UNCHANGED)
     if ext_pred is not None:
         nucl_msk = dilation((y_pred > 0) * 1, square(7))
         nucl_msk = nucl_msk * (ext_pred[..., 0] > extend_threshold)
@@ -335,12 +343,11 @@ def get_inputs(filename, pred_folder, img_folder, truth_folder=None, extend_mask
         inputs_lvl2 = np.asarray(inputs_lvl2)
         all_sep_inputs.append(inputs_lvl2)
         
-    if truth_folder is None:
+    if truth_labels is None:
         return inputs, pred_labels, all_sep_inputs, lvl2_labels, separated_regions
     else:
         outputs = []
         
-        truth_labels = cv2.imread(path.join(truth_folder, filename.replace('.png', '.tif')), cv2.IMREAD_UNCHANGED)
         truth_labels = measure.label(truth_labels, neighbors=8, background=0)
         truth_props = measure.regionprops(truth_labels)
         
@@ -0,0 +1,191 @@
+"""
+Resident ensemble: one process that keeps the selim, albu and victor models loaded (inference.Segmenter) and
+returns merged probability maps for tiles sent over a UNIX or local TCP socket, so callers do not pay for
+interpreter and framework start-up and weight loading on every run.
+
+    python ensemble_server.py --network-dir dsb2018_topcoders --socket /tmp/ensemble.sock --lazy --max-loaded 4
+
+    with EnsembleClient('/tmp/ensemble.sock') as client:
+        merged, extended = client.predict_merged([tile])[0]
+
+In the same process use Segmenter.predict_merged directly.
+"""
+import argparse
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+import numpy as np
+
+from inference import Segmenter, prepare_tile
+from tracing import span
+
+_STATUS_OK = 0
+_STATUS_ERROR = 1
+
+
+def send_arrays(f, arrays, status=_STATUS_OK):
+    """
+    Writes a message of a status byte, the number of arrays and the arrays in .npy format to a binary file.
+    """
+    f.write(struct.pack('<BI', status, len(arrays)))
+    for arr in arrays:
+        np.lib.format.write_array(f, np.ascontiguousarray(arr), allow_pickle=False)
+    f.flush()
+
+
+def _read_array(f):
+    # np.lib.format.read_array needs file positions, sockets have none
+    version = np.lib.format.read_magic(f)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    shape, fortran_order, dtype = read_header(f)
+    if dtype.hasobject:
+        raise ValueError('Arrays of objects are not accepted')
+    arr = np.empty(shape, dtype=dtype, order='F' if fortran_order else 'C')
+    buffer = memoryview(arr.reshape(-1, order='A')).cast('B')
+    read = 0
+    while read < len(buffer):
+        n = f.readinto(buffer[read:])
+        if not n:
+            raise ConnectionError('Connection closed inside an array')
+        read += n
+    return arr
+
+
+def recv_arrays(f):
+    """
+    Reads a message of send_arrays.
+
+    Returns
+    -------
+    status : int
+        None if the connection was closed before a message.
+    arrays : list
+    """
+    header = f.read(struct.calcsize('<BI'))
+    if len(header) == 0:
+        return None, []
+    if len(header) < struct.calcsize('<BI'):
+        raise ConnectionError('Connection closed inside a message header')
+    status, count = struct.unpack('<BI', header)
+    return status, [_read_array(f) for _ in range(count)]
+
+
+def _error_message(arrays):
+    return bytes(arrays[0]).decode() if arrays else 'unknown error'
+
+
+def _family(address):
+    return socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            status, tiles = recv_arrays(self.rfile)
+            if status is None:
+                return
+            try:
+                with self.server.lock, span('serve', tiles=len(tiles)):
+                    merged = self.server.segmenter.predict_merged([prepare_tile(tile) for tile in tiles])
+            except Exception as e:
+                message = f'{type(e).__name__}: {e}'
+                send_arrays(self.wfile, [np.frombuffer(message.encode(), dtype=np.uint8)], _STATUS_ERROR)
+                continue
+            send_arrays(self.wfile, [arr for pair in merged for arr in pair])
+
+
+class EnsembleServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Serves Segmenter.predict_merged on a UNIX socket (address is a path) or a TCP socket (address is (host, port)).
+    Every connection can send any number of requests. The models run one request at a time.
+
+    Parameters
+    ----------
+    address : str or tuple
+    segmenter : inference.Segmenter
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, segmenter):
+        self.address_family = _family(address)
+        self.segmenter = segmenter
+        self.lock = threading.Lock()
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+        super().__init__(address, _Handler)
+
+    def server_close(self):
+        super().server_close()
+        if isinstance(self.server_address, str) and os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class EnsembleClient:
+    """
+    Connection to an EnsembleServer.
+
+    Parameters
+    ----------
+    address : str or tuple
+        Path of the UNIX socket or (host, port).
+    timeout : float
+        Seconds to wait for a response, forever if None.
+    """
+
+    def __init__(self, address, timeout=None):
+        self.sock = socket.socket(_family(address), socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.file = self.sock.makefile('rwb')
+
+    def predict_merged(self, tiles):
+        """
+        Parameters
+        ----------
+        tiles : list
+            Tiles from split_image, converted with prepare_tile by the server.
+
+        Returns
+        -------
+        merged : list
+            For every tile the merged prediction and the extend mask, see Segmenter.predict_merged.
+        """
+        send_arrays(self.file, tiles)
+        status, arrays = recv_arrays(self.file)
+        if status is None:
+            raise ConnectionError('The ensemble server closed the connection')
+        if status != _STATUS_OK:
+            raise RuntimeError(f'Ensemble server error: {_error_message(arrays)}')
+        return list(zip(arrays[::2], arrays[1::2]))
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--network-dir', required=True)
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--socket', help='path of the UNIX socket')
+    address.add_argument('--port', type=int, help='TCP port on 127.0.0.1')
+    parser.add_argument('--lazy', action='store_true', help='load every model when it is first needed')
+    parser.add_argument('--max-loaded', type=int, help='number of models kept loaded, all of them if not set')
+    parser.add_argument('--cache', help='directory of a tile_cache.TileCache')
+    args = parser.parse_args()
+
+    segmenter = Segmenter(os.path.abspath(args.network_dir), cache=args.cache, lazy=args.lazy,
+                          max_loaded=args.max_loaded)
+    with EnsembleServer(args.socket or ('127.0.0.1', args.port), segmenter) as server:
+        print(f'serving on {server.server_address}, {segmenter.predictors.report()}')
+        server.serve_forever()
@@ -0,0 +1,155 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# columns written as integers, every other feature is float32
+INT_COLUMNS = {'size', 'tile_x', 'tile_y'}
+TILE_COLUMNS = ['tile_x', 'tile_y']
+META_FILE = 'meta.json'
+
+
+def get_x_and_y(name):
+    x, y = os.path.splitext(name)[0].split('_')[-2:]
+    return int(x), int(y)
+
+
+def column_dtype(name):
+    return np.dtype(np.int32 if name in INT_COLUMNS else np.float32)
+
+
+def exists(path):
+    return os.path.exists(os.path.join(path, META_FILE))
+
+
+class FeatureWriter:
+    """
+    Appends feature columns tile by tile to a columnar table: a directory with one raw file per column
+    and meta.json with the dtypes and the rows of every tile. Nothing but the current tile is kept in memory.
+    The table can be read once the writer is closed, see FeatureTable. Used as a context manager, meta.json
+    is only written if the block succeeds, so a table interrupted by an exception does not exist for readers.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the table, created if needed. An existing table is overwritten, column files of
+        other names are removed.
+    columns : list
+        Feature names, tile_x and tile_y are added.
+    groups : list
+        Feature groups of NucleiFeatures the columns belong to, kept in meta.json.
+    """
+
+    def __init__(self, path, columns, groups=()):
+        self.path = path
+        self.columns = list(columns) + TILE_COLUMNS
+        self.groups = list(groups)
+        self.tiles = []
+        self.rows = 0
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, META_FILE)):
+            os.remove(os.path.join(path, META_FILE))
+        for file_name in os.listdir(path):
+            if file_name.endswith('.bin') and file_name[:-len('.bin')] not in self.columns:
+                os.remove(os.path.join(path, file_name))
+        self._files = {name: open(os.path.join(path, f'{name}.bin'), 'wb') for name in self.columns}
+
+    def append(self, tile_name, columns, label_hash=None):
+        """
+        Parameters
+        ----------
+        tile_name : str
+            Tile name from split_image.
+        columns : list
+            One array per feature, see NucleiFeatures.tile_columns.
+        label_hash : str
+            Hash of the label image the features were computed from.
+        """
+        if len(columns) + len(TILE_COLUMNS) != len(self.columns):
+            raise ValueError(f'{len(columns)} columns for {len(self.columns) - len(TILE_COLUMNS)} feature names')
+        n = len(columns[0]) if columns else 0
+        x_tile, y_tile = get_x_and_y(tile_name)
+        columns = list(columns) + [np.full(n, x_tile), np.full(n, y_tile)]
+        for name, column in zip(self.columns, columns):
+            self._files[name].write(np.ascontiguousarray(column, dtype=column_dtype(name)).tobytes())
+        self.tiles.append([tile_name, self.rows, self.rows + n, label_hash])
+        self.rows += n
+
+    def _close_files(self):
+        for f in self._files.values():
+            f.close()
+
+    def close(self):
+        self._close_files()
+        meta = {'rows': self.rows, 'columns': {name: column_dtype(name).str for name in self.columns},
+                'groups': self.groups, 'tiles': self.tiles}
+        tmp_path = os.path.join(self.path, f'{META_FILE}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(self.path, META_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._close_files()
+
+
+class FeatureTable:
+    """
+    Lazy reader of a table written by FeatureWriter. Columns are memory-mapped, so only the
+    selected columns and tiles are read.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the table.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.rows = meta['rows']
+        self.dtypes = {name: np.dtype(dtype) for name, dtype in meta['columns'].items()}
+        self.groups = meta.get('groups', [])
+        self.tiles = {name: (start, stop) for name, start, stop, *_ in meta['tiles']}
+        self.label_hashes = {name: rest[0] if rest else None for name, start, stop, *rest in meta['tiles']}
+
+    @property
+    def columns(self):
+        return list(self.dtypes)
+
+    def __len__(self):
+        return self.rows
+
+    def column(self, name):
+        if self.rows == 0:
+            return np.empty(0, dtype=self.dtypes[name])
+        return np.memmap(os.path.join(self.path, f'{name}.bin'), dtype=self.dtypes[name], mode='r',
+                         shape=(self.rows,))
+
+    def read(self, columns=None, tiles=None):
+        """
+        Parameters
+        ----------
+        columns : list
+            Column names, all columns if None.
+        tiles : list
+            Tile names, all tiles if None.
+
+        Returns
+        -------
+        df : pandas DataFrame
+        """
+        columns = self.columns if columns is None else list(columns)
+        if tiles is None:
+            return pd.DataFrame({name: np.array(self.column(name)) for name in columns}, columns=columns)
+        ranges = [self.tiles[name] for name in tiles]
+        return pd.DataFrame({name: np.concatenate([self.column(name)[start:stop] for start, stop in ranges]
+                                                  + [np.empty(0, dtype=self.dtypes[name])])
+                             for name in columns}, columns=columns)
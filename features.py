@@ -1,4 +1,6 @@
 import os
+import shutil
+from itertools import repeat
 from multiprocessing import Pool as ProcessPool
 
 import cv2 as cv
@@ -8,6 +10,11 @@ import scipy.ndimage
 from PIL import Image
 from tqdm import tqdm
 
+import feature_store
+from feature_store import FeatureTable, FeatureWriter
+from tile_cache import array_hash
+from tracing import span
+
 Image.MAX_IMAGE_PIXELS = None
 
 
@@ -16,8 +23,16 @@ def get_x_and_y(name):
     return int(x), int(y)
 
 
-def flatten_list(l):
-    return [item for sublist in l for item in sublist]
+def _rows(columns):
+    return [list(row) for row in zip(*columns)]
+
+
+def _color_channels(orig, gray=False):
+    if gray and orig.ndim == 3:
+        orig = cv.cvtColor(orig, cv.COLOR_BGR2GRAY if orig.shape[2] == 3 else cv.COLOR_BGRA2GRAY)
+    if orig.ndim == 2:
+        return [orig] if gray else [orig] * 3
+    return [orig[..., c] for c in range(min(orig.shape[2], 3))]
 
 
 class NucleiFeatures:
@@ -30,7 +45,7 @@ class NucleiFeatures:
 
     def ellips(self, img, orig, **kwargs):
         try:
-            cont = cv.findContours(img.astype(np.uint8).T.copy(), cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)[1][0][:, 0, :]
+            cont = cv.findContours(img.astype(np.uint8).T.copy(), cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)[-2][0][:, 0, :]
             ellipse_center, axles, angle = cv.fitEllipse(cont)
             x, y = ellipse_center
             x = x + self.x_min + kwargs['x_tile'] * img.shape[0]
@@ -52,6 +67,8 @@ class NucleiFeatures:
         self.tif_folder = tif_folder
         self.png_folder = png_folder
         self.computed_features = None
+        # table written by compute_multipricess, df reads it
+        self.table_path = None
         self.feature_dict = {'position': (self.position, ['x', 'y']),
                              'size': (self.size, ['size']),
                              'ellipse': (
@@ -73,75 +90,290 @@ class NucleiFeatures:
 
     @property
     def feature_names(self):
+        return self.group_names(self.features)
+
+    def group_names(self, features):
         names = []
-        for f in self.features:
+        for f in features:
             names += self.feature_dict[f][1]
         return names
 
+    def compute_tile(self, img, orig, filename):
+        """
+        Computes features of labels 1..img.max() - 1 of one tile in one pass: position, size and color
+        are bincount reductions over the label image, ellipses are fitted on bounding box crops.
+        The rows are the same as evaluating the feature functions on img == i for every label.
+
+        Parameters
+        ----------
+        img : numpy ndarray
+            Label image of the tile.
+        orig : numpy ndarray
+            BGR tile.
+        filename : str
+            Tile name from split_image.
+
+        Returns
+        -------
+        computed_features : list
+            One list of feature values per label.
+        """
+        return _rows(self.tile_columns(img, orig, filename))
+
+    def tile_columns(self, img, orig, filename, features=None, offset=None, n_labels=None):
+        """
+        Same as compute_tile, but returns one array per feature column.
+        Only the given features are computed, self.features by default.
+        Windows of a stitched label image pass their offset (x, y) in the slide and n_labels to compute
+        labels 1..n_labels, otherwise the offset follows from the tile name and labels 1..img.max() - 1
+        are computed.
+        """
+        features = self.features if features is None else features
+        groups = self.group_columns(img, orig, filename, features, offset, n_labels)
+        return [column for f in features for column in groups[f]]
+
+    def group_columns(self, img, orig, filename, features, offset=None, n_labels=None):
+        """
+        Columns of tile_columns by feature group, a group has one column per name in feature_dict.
+        color_gray of a BGR tile is computed on its gray image and color of a gray tile on three equal channels.
+        """
+        n = int(img.max()) if n_labels is None else n_labels + 1
+        if n < 2:
+            return {f: [np.empty(0)] * len(self.feature_dict[f][1]) for f in features}
+        if offset is None:
+            x_tile, y_tile = get_x_and_y(filename)
+            # x is the column and y the row of the tile
+            offset = (x_tile * img.shape[1], y_tile * img.shape[0])
+        x_offset = self.x_min + offset[0]
+        y_offset = self.y_min + offset[1]
+
+        labels = img.ravel().astype(np.intp)
+        count = np.bincount(labels, minlength=n)[1:n]
+
+        def label_sum(weights):
+            return np.bincount(labels, weights=weights.ravel(), minlength=n)[1:n]
+
+        groups = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for f in features:
+                if f == 'position':
+                    rows, cols = np.indices(img.shape)
+                    columns = [label_sum(cols) / count + x_offset, label_sum(rows) / count + y_offset]
+                elif f == 'size':
+                    columns = [count]
+                elif f == 'ellipse':
+                    columns = list(np.array(self._crop_ellipses(img, n, x_offset, y_offset), dtype=float).T)
+                elif f in ('color', 'color_gray'):
+                    means, stds = [], []
+                    for channel in _color_channels(orig, gray=f == 'color_gray'):
+                        channel = channel.astype(np.float64)
+                        mean = label_sum(channel) / count
+                        means.append(mean)
+                        stds.append(np.sqrt(np.maximum(label_sum(channel ** 2) / count - mean ** 2, 0)))
+                    columns = means + stds
+                names = self.feature_dict[f][1]
+                if len(columns) != len(names):
+                    raise ValueError(f'{f} of {filename} gives {len(columns)} columns for the names {names}')
+                groups[f] = columns
+        return groups
+
+    def _crop_ellipses(self, img, n, x_offset, y_offset):
+        ellipses = []
+        for i, box in enumerate(scipy.ndimage.find_objects(img, max_label=n - 1), 1):
+            if box is None:
+                ellipses.append([0] * 5)
+                continue
+            # one pixel of background around the nucleus, as it is in the full tile
+            r0, c0 = max(box[0].start - 1, 0), max(box[1].start - 1, 0)
+            crop = (img[r0:box[0].stop + 1, c0:box[1].stop + 1] == i).astype(np.uint8)
+            try:
+                cont = cv.findContours(crop, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)[-2][0][:, 0, :]
+                (x, y), axles, angle = cv.fitEllipse(cont)
+            except cv.error:
+                ellipses.append([0] * 5)
+                continue
+            if axles[1] > 100:
+                axles = (30, 30)
+            ellipses.append([*axles, x + c0 + x_offset, y + r0 + y_offset, angle])
+        return ellipses
+
+    def _sources(self, labels=None, tiles=None, tile_names=None, windows=None):
+        # label images with a function returning the BGR tile and the tile_columns arguments of windows,
+        # tiles from png_folder are only read when needed
+        if labels is None:
+            tile_names = [os.path.splitext(i)[0] for i in os.listdir(self.tif_folder)]
+            for filename in tqdm(tile_names):
+                yield filename, cv.imread(f'{self.tif_folder}/{filename}.tif', -1), \
+                    lambda filename=filename: cv.imread(f'{self.png_folder}/{filename}/images/{filename}.png', 1), {}
+        else:
+            total = len(tile_names) if hasattr(tile_names, '__len__') else None
+            windows = windows if windows is not None else repeat({})
+            for img, orig, filename, window in tqdm(zip(labels, tiles, tile_names, windows), total=total):
+                yield filename, img, lambda orig=orig: orig, window
+
+    def _tiles(self, labels=None, tiles=None, tile_names=None, windows=None):
+        for filename, img, get_orig, window in self._sources(labels, tiles, tile_names, windows):
+            with span('features', tile=filename):
+                yield filename, self.tile_columns(img, get_orig(), filename, **window)
+
     def compute(self):
         self.computed_features = []
-        base_names = [os.path.splitext(i)[0] for i in os.listdir(self.tif_folder)]
-        for filename in tqdm(base_names):
-            img = cv.imread(f'{self.tif_folder}/{filename}.tif', -1)
-            orig = cv.imread(f'{self.png_folder}/{filename}/images/{filename}.png', 1)
-
-            img = np.rot90(img, k=3)
-            img = np.flip(img, axis=1)
-            orig = np.rot90(orig, k=3)
-            orig = np.flip(orig, axis=1)
-            for i in range(1, img.max()):
-                tmp_img = (img == i)
-                tmp = []
-                x_tile, y_tile = get_x_and_y(filename)
-                for f in self.features:
-                    tmp += self.feature_dict[f][0](tmp_img, orig, x_tile=x_tile, y_tile=y_tile)
-                self.computed_features.append(tmp)
+        for filename, columns in self._tiles():
+            self.computed_features += _rows(columns)
         return self
 
-    def compute_multipricess(self, n_workers=10):
+    def compute_tiles(self, labels, tiles, tile_names, windows=None):
+        """
+        Computes features from arrays instead of tif_folder and png_folder.
 
-        orig_list = []
-        img_list = []
-        filenames = []
-        base_names = [os.path.splitext(i)[0] for i in os.listdir(self.tif_folder)]
-        for filename in base_names:
-            img = cv.imread(f'{self.tif_folder}/{filename}.tif', -1)
-            orig = cv.imread(f'{self.png_folder}/{filename}/images/{filename}.png', 1)
-
-            img = np.rot90(img, k=3)
-            img = np.flip(img, axis=1)
-            orig = np.rot90(orig, k=3)
-            orig = np.flip(orig, axis=1)
-
-            orig_list.append(orig)
-            img_list.append(img)
-            filenames.append(filename)
-
-        global compute_one
-
-        def compute_one(data):
-            computed_features = []
-            img = data[0]
-            orig = data[1]
-            filename = data[2]
-
-            for i in range(1, img.max()):
-                tmp_img = (img == i)
-                tmp = []
-                x_tile, y_tile = get_x_and_y(filename)
-                for f in self.features:
-                    tmp += self.feature_dict[f][0](tmp_img, orig, x_tile=x_tile, y_tile=y_tile)
-                computed_features.append(tmp)
-            return computed_features
-
-        with ProcessPool(n_workers) as p:
-            result = list(tqdm(p.imap(compute_one, zip(img_list, orig_list, filenames)), total=len(orig_list)))
-            self.computed_features = flatten_list(result)
+        Parameters
+        ----------
+        labels : list
+            Label images of tiles.
+        tiles : list
+            BGR tiles.
+        tile_names : list
+            List of tile names from split_image.
+        windows : list
+            offset and n_labels of tile_columns for every tile, for windows of a stitched label image.
+        """
+        self.computed_features = []
+        for filename, columns in self._tiles(labels, tiles, tile_names, windows):
+            self.computed_features += _rows(columns)
+        return self
+
+    def write(self, path, labels=None, tiles=None, tile_names=None, windows=None):
+        """
+        Streams features tile by tile to a columnar table (see feature_store.FeatureWriter) instead of
+        collecting rows, read it back with feature_store.FeatureTable.
+        Tiles are read from tif_folder and png_folder, or taken from arrays as in compute_tiles.
+
+        Parameters
+        ----------
+        path : str
+            Directory of the table.
+        labels : list
+            Label images of tiles.
+        tiles : list
+            BGR tiles.
+        tile_names : list
+            List of tile names from split_image.
+        windows : list
+            See compute_tiles.
+
+        Returns
+        -------
+        path : str
+        """
+        with FeatureWriter(path, self.feature_names, self.features) as writer:
+            for filename, img, get_orig, window in self._sources(labels, tiles, tile_names, windows):
+                with span('features', tile=filename):
+                    writer.append(filename, self.tile_columns(img, get_orig(), filename, **window), array_hash(img))
+        return path
+
+    def update(self, path, labels=None, tiles=None, tile_names=None, windows=None):
+        """
+        Brings the columnar table at path up to date, computing only what it lacks. Tiles with an unchanged
+        label image keep their stored columns and get the feature groups missing from the table, new and
+        changed tiles are computed with all groups. Tiles which are not in the source any more are dropped.
+        Without a table at path this is the same as write. The table is rewritten, so the rows of a spatial
+        index built from the old table (spatial_index.build_index) no longer match.
+
+        Parameters
+        ----------
+        path : str
+            Directory of the table.
+        labels : list
+            Label images of tiles.
+        tiles : list
+            BGR tiles.
+        tile_names : list
+            List of tile names from split_image.
+        windows : list
+            See compute_tiles.
+
+        Returns
+        -------
+        stats : dict
+            Number of tiles computed from scratch, extended with new groups and reused as they were.
+        """
+        old = FeatureTable(path) if feature_store.exists(path) else None
+        groups = list(old.groups) if old is not None else []
+        groups += [f for f in self.features if f not in groups]
+        stats = {'computed': 0, 'extended': 0, 'reused': 0}
+        tmp_path = f'{path}.tmp'
+        with FeatureWriter(tmp_path, self.group_names(groups), groups) as writer:
+            for filename, img, get_orig, window in self._sources(labels, tiles, tile_names, windows):
+                label_hash = array_hash(img)
+                known = old is not None and old.label_hashes.get(filename) == label_hash
+                missing = [f for f in groups if not known or f not in old.groups]
+                stats['reused' if not missing else 'extended' if known else 'computed'] += 1
+                with span('features', tile=filename, groups=len(missing)):
+                    orig = get_orig() if {'color', 'color_gray'} & set(missing) else None
+                    computed = self.group_columns(img, orig, filename, missing, **window) if missing else {}
+                    columns = []
+                    for f in groups:
+                        if f in missing:
+                            columns += computed[f]
+                        else:
+                            start, stop = old.tiles[filename]
+                            columns += [old.column(name)[start:stop] for name in self.feature_dict[f][1]]
+                    writer.append(filename, columns, label_hash)
+        if old is not None:
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        return stats
 
+    def compute_multipricess(self, n_workers=10, chunksize=4, path=None):
+        """
+        Computes features of tif_folder with a process pool. Workers get file names only, read their own
+        tiles and send back the feature columns of every tile as soon as it is done. The parent appends them
+        to a columnar table (see feature_store.FeatureWriter) and drops them, so its memory does not grow
+        with the slide. df reads the table back.
+
+        Parameters
+        ----------
+        n_workers : int
+            Number of processes.
+        chunksize : int
+            Tiles sent to a worker at once.
+        path : str
+            Directory of the table, tif_folder + '.features' by default.
+        """
+        path = f'{os.path.normpath(self.tif_folder)}.features' if path is None else path
+        base_names = [os.path.splitext(i)[0] for i in os.listdir(self.tif_folder)]
+        initargs = (self.tif_folder, self.png_folder, list(self.features), self.x_min, self.y_min)
+        with ProcessPool(n_workers, initializer=_init_worker, initargs=initargs) as p, \
+                FeatureWriter(path, self.feature_names, self.features) as writer:
+            results = p.imap(_compute_file, base_names, chunksize=chunksize)
+            for filename, (columns, label_hash) in tqdm(zip(base_names, results), total=len(base_names)):
+                writer.append(filename, columns, label_hash)
+        self.computed_features = None
+        self.table_path = path
         return self
 
     def df(self):
+        if self.computed_features is None and self.table_path is not None:
+            return FeatureTable(self.table_path).read(self.feature_names)
         if self.computed_features is None:
             self.compute()
         df = pd.DataFrame(self.computed_features, columns=self.feature_names)
         return df
+
+
+_worker_features = None
+
+
+def _init_worker(tif_folder, png_folder, features, x_min, y_min):
+    global _worker_features
+    # one thread per worker, the pool is the parallelism
+    cv.setNumThreads(1)
+    _worker_features = NucleiFeatures(tif_folder, png_folder, features, x_min=x_min, y_min=y_min)
+
+
+def _compute_file(filename):
+    nf = _worker_features
+    with span('features', tile=filename):
+        img = cv.imread(f'{nf.tif_folder}/{filename}.tif', -1)
+        orig = cv.imread(f'{nf.png_folder}/{filename}/images/{filename}.png', 1)
+        return nf.tile_columns(img, orig, filename), array_hash(img)
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import tempfile
+
+import cv2 as cv
+import numpy as np
+
+# directory of the cache shared by the scripts of predict_test.sh, images are decoded by every script when not set
+CACHE_ENV = 'IMAGE_CACHE'
+
+
+class ImageCache:
+    """
+    Decoded images and arrays derived from them (padded network inputs with the LAB channel, ...), shared by
+    all predictors of a run, so every image is decoded and every input is prepared once.
+    With a directory the entries are .npy files, written atomically and read memory-mapped, so the separate
+    scripts of predict_test.sh share them. Without one they are kept in memory until clear is called.
+    Arrays read from the cache are read-only.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache, created if needed. None for an in-memory cache.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._arrays = {}
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def file_key(image_path):
+        """
+        Entry key of an image file, changes when the file does.
+        """
+        stat = os.stat(image_path)
+        return hashlib.sha1(f'{os.path.abspath(image_path)}:{stat.st_size}:{stat.st_mtime}'.encode()).hexdigest()
+
+    def _file(self, key, name):
+        return os.path.join(self.path, f'{key}.{name}.npy')
+
+    def get(self, key, name, compute):
+        """
+        The array called name of the entry key, compute() is called only if it is not in the cache yet.
+        Nothing is stored when compute returns None.
+        """
+        if self.path is None:
+            arr = self._arrays.get((key, name))
+        else:
+            try:
+                arr = np.load(self._file(key, name), mmap_mode='r')
+            except (OSError, ValueError):
+                arr = None
+        if arr is not None:
+            self.hits += 1
+            return arr
+        self.misses += 1
+        arr = compute()
+        if arr is None:
+            return None
+        arr = np.asarray(arr)
+        if self.path is None:
+            self._arrays[(key, name)] = arr
+        else:
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp_path, self._file(key, name))
+        return arr
+
+    def read(self, image_path, flags=cv.IMREAD_COLOR):
+        """
+        cv.imread with the decoded image kept in the cache.
+        """
+        return self.get(self.file_key(image_path), f'image{flags}', lambda: cv.imread(image_path, flags))
+
+    def clear(self):
+        self._arrays = {}
+        if self.path is not None:
+            for f in os.listdir(self.path):
+                if f.endswith('.npy'):
+                    os.remove(os.path.join(self.path, f))
+
+    def report(self):
+        return f'image cache: {self.hits} hits, {self.misses} misses'
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    The cache in the directory named by IMAGE_CACHE, None if it is not set.
+    """
+    global _cache
+    path = os.environ.get(CACHE_ENV)
+    if not path:
+        return None
+    if _cache is None or _cache.path != path:
+        _cache = ImageCache(path)
+    return _cache
+
+
+def read_image(image_path, flags=cv.IMREAD_COLOR):
+    """
+    cv.imread through the cache of IMAGE_CACHE if it is set.
+    """
+    cache = get_cache()
+    return cv.imread(image_path, flags) if cache is None else cache.read(image_path, flags)
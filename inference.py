@@ -0,0 +1,528 @@
+import contextlib
+import gc
+import importlib
+import json
+import os
+import sys
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+
+from batching import BatchStats
+from image_cache import ImageCache
+from tile_cache import TileCache, array_hash, entry_key, model_key
+from tracing import span
+from tta import get_policy
+
+FAMILY_DIRS = {'selim': 'selim',
+               'albu': os.path.join('albu', 'src'),
+               'victor': 'victor'}
+
+# (network, preprocessing function, output channels, output folder, weights) as in selim/predict_test.sh
+SELIM_NETWORKS = [('resnet101_2', 'caffe', 2, 'pred_resnet101_full_masks', 'best_resnet101_2_fold{}.h5'),
+                  ('densenet169_softmax', 'torch', 3, 'pred_densenet169_softmax', 'best_densenet169_softmax_fold{}.h5'),
+                  ('resnet152_2', 'caffe', 2, 'pred_resnet152', 'best_resnet152_2_fold{}.h5')]
+
+# albu/src/predict_test.sh
+ALBU_CONFIGS = ['dpn_softmax_s2', 'dpn_sigmoid_s2', 'resnet_softmax_s2']
+
+# (script, output folder) as in victor/predict_test.sh
+VICTOR_NETWORKS = [('predict_inception', 'inception_test_pred_4'),
+                   ('predict_densenet', 'densenet_test_pred_2')]
+
+
+_family_modules = {}
+
+
+def _module_dir(module):
+    file = getattr(module, '__file__', None)
+    if file is not None:
+        return os.path.dirname(os.path.abspath(file))
+    paths = list(getattr(module, '__path__', []))
+    return os.path.abspath(paths[0]) if paths else None
+
+
+def _modules_in(dirs):
+    names = []
+    for name, module in list(sys.modules.items()):
+        module_dir = _module_dir(module)
+        if module_dir is not None and any(module_dir == d or module_dir.startswith(d + os.sep) for d in dirs):
+            names.append(name)
+    return names
+
+
+@contextlib.contextmanager
+def family_context(network_dir, family):
+    """
+    Makes modules of one network family (selim, albu or victor) importable.
+    The families are written as scripts started from their own directory and
+    share module names (models, augmentations, ...), so the working directory
+    and sys.path are switched to the family directory and modules of the other
+    families are hidden while the context is active.
+    Modules imported inside the context keep working after it is closed and
+    are reused the next time the same family is entered.
+
+    Parameters
+    ----------
+    network_dir : str
+        Full path to dsb2018_topcoders.
+    family : str
+        'selim', 'albu' or 'victor'.
+    """
+    network_dir = Path(network_dir).resolve()
+    family_dir = str(network_dir / FAMILY_DIRS[family])
+    family_dirs = [str(network_dir / d) for d in FAMILY_DIRS.values()]
+
+    stashed = {name: sys.modules.pop(name) for name in _modules_in(family_dirs)}
+    sys.modules.update(_family_modules.get(family_dir, {}))
+    cwd = os.getcwd()
+    sys.path.insert(0, family_dir)
+    os.chdir(family_dir)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(family_dir)
+        _family_modules[family_dir] = {name: sys.modules.pop(name) for name in _modules_in(family_dirs)}
+        sys.modules.update(stashed)
+
+
+def prepare_tile(tile):
+    """
+    Converts a tile the same way as writing it with prepare_test_data and
+    reading it back with cv.IMREAD_COLOR does.
+
+    Parameters
+    ----------
+    tile : numpy ndarray
+        Tile from split_image.
+
+    Returns
+    -------
+    tile : numpy ndarray
+        Contiguous BGR uint8 tile.
+    """
+    if tile.max() <= 1:
+        tile = (tile * 255).astype(np.uint8)
+    if tile.dtype == np.uint16:
+        tile = (tile >> 8).astype(np.uint8)
+    if tile.ndim == 2:
+        tile = cv.cvtColor(tile, cv.COLOR_GRAY2BGR)
+    elif tile.shape[2] == 4:
+        tile = cv.cvtColor(tile, cv.COLOR_BGRA2BGR)
+    return np.ascontiguousarray(tile)
+
+
+class KerasSession:
+    """
+    TensorFlow graph and session of the keras models of one predictor. keras builds all models in one global
+    graph that only grows, models loaded inside scope live in this graph instead and are freed by close.
+    """
+
+    def __init__(self):
+        import tensorflow as tf
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph)
+
+    @contextlib.contextmanager
+    def scope(self):
+        """
+        Makes the graph and the session the defaults keras uses, for loading and running the models.
+        """
+        with self.graph.as_default(), self.session.as_default():
+            yield
+
+    def close(self):
+        self.session.close()
+        # keras keeps the learning phase and the layer name counters of every graph it has seen
+        from keras.backend import tensorflow_backend
+        for name in ('_GRAPH_LEARNING_PHASES', '_GRAPH_UID_DICTS'):
+            getattr(tensorflow_backend, name, {}).pop(self.graph, None)
+        self.graph = self.session = None
+
+
+def _precision_key(precision):
+    """
+    Precision for the cache keys of predictions, empty for fp32 so keys of earlier runs stay valid.
+    """
+    return {} if precision == 'fp32' else {'precision': precision}
+
+
+class SelimPredictor:
+    """
+    Four folds of one selim network, see selim/pred_test.py.
+    Tiles of equal shape are passed to the networks in batches of batch_size, see batching.predict_buckets.
+    tta is a tta.TTAPolicy, or a policy name or transform names, no augmentation by default.
+    Padded inputs are kept in images (an image_cache.ImageCache) under the keys of the tiles
+    for the other selim networks.
+    precision 'int8' runs the TFLite models of selim/quantize_models.py instead of the keras weights.
+    The keras models have their own graph and session (KerasSession), close frees them.
+    """
+    batch_size = 4
+
+    def __init__(self, network_dir, network, preprocessing_function, out_channels, name, weights,
+                 models_dir='nn_models', tta=None, images=None, precision='fp32'):
+        self.name = name
+        self.images = images
+        self.preprocessing_function = preprocessing_function
+        self.out_channels = out_channels
+        self.policy = get_policy(tta)
+        self.tta = {'preprocessing_function': preprocessing_function, 'out_channels': out_channels,
+                    **self.policy.key(), **_precision_key(precision)}
+        with family_context(network_dir, 'selim'):
+            self._pred_test = importlib.import_module('pred_test')
+            weights = [os.path.abspath(os.path.join(models_dir, weights.format(fold))) for fold in range(4)]
+            self.keras = KerasSession()
+            with self.keras.scope():
+                self.models = self._pred_test.load_models(network, weights, precision)
+            self.weights = self._pred_test.model_files(weights, precision)
+        self.stats = BatchStats()
+
+    def predict(self, tiles, keys=None):
+        with self.keras.scope():
+            return self._pred_test.predict_images(self.models, [tile[..., ::-1] for tile in tiles],
+                                                  self.preprocessing_function, self.out_channels,
+                                                  batch_size=self.batch_size, stats=self.stats,
+                                                  transforms=self.policy.transforms, scales=self.policy.scales,
+                                                  cache=self.images, keys=keys)
+
+    def close(self):
+        self.models = None
+        self.keras.close()
+
+
+class AlbuPredictor:
+    """
+    Four folds of one albu config, see albu/src/bowl_eval.py.
+    tta is a tta.TTAPolicy, or a policy name or transform names, no augmentation by default. albu inputs
+    are not resized, so the policy can not have scales.
+    device is a torch device name ('cpu', 'cuda', 'cuda:1'), the GPU if there is one by default.
+    precision 'int8' runs the quantized models of albu/src/quantize_models.py, on CPU only.
+    """
+
+    def __init__(self, network_dir, config_name, tta=None, device=None, precision='fp32'):
+        self.policy = get_policy(tta)
+        if self.policy.scales != [1]:
+            raise ValueError(f'albu predictions have no scale augmentation, got {self.policy}')
+        with family_context(network_dir, 'albu'):
+            config = importlib.import_module('config')
+            self._eval = importlib.import_module('pytorch_utils.eval')
+            self._concrete_eval = importlib.import_module('pytorch_utils.concrete_eval')
+            self._providers = importlib.import_module('dataset.reading_image_provider')
+            image_types = importlib.import_module('dataset.bowl_image_types')
+            with open(os.path.join('configs', f'{config_name}.json')) as f:
+                self.config = config.Config(**json.load(f))
+            self.device = self._eval.get_device('cpu' if device is None and precision == 'int8' else device)
+            self.models = [self._eval.read_model(self.config.folder, fold, self.device, precision=precision)
+                           for fold in range(4)]
+            if precision == 'int8':
+                self.weights = [os.path.abspath(self._eval.quantized_model_path(self.config.folder, fold))
+                                for fold in range(4)]
+            else:
+                self.weights = [os.path.abspath(os.path.join('..', 'weights', self.config.folder,
+                                                             f'fold{fold}_best.pth'))
+                                for fold in range(4)]
+        self.name = f'{self.config.folder}_test'
+        self.tta = {'config': config_name, 'flips': 3, 'border': 0, **self.policy.key(), **_precision_key(precision)}
+        self.image_type = image_types.PaddedSigmoidImageType if self.config.sigmoid else image_types.PaddedImageType
+
+    def predict(self, tiles, keys=None):
+        names = [str(i) for i in range(len(tiles))]
+        ds = self._providers.ArrayImageProvider(self.image_type, [tile[..., ::-1] for tile in tiles], names)
+        evaluator = self._concrete_eval.InMemoryEvaluator(self.config, ds, test=True, flips=3, border=0,
+                                                          folds=len(self.models), tta=self.policy.transforms,
+                                                          device=self.device)
+        evaluator.predict_folds(list(range(len(self.models))), list(range(len(ds))), models=self.models)
+        return [evaluator.predictions[n] for n in names]
+
+
+class VictorPredictor:
+    """
+    Four folds of one victor network at three scales, see victor/predict_inception.py.
+    Inputs of equal shape are passed to the networks in batches of batch_size, see batching.predict_buckets.
+    tta is a tta.TTAPolicy, or a policy name or transform names used with the three scales, the scales only by default.
+    Inputs with the LAB channel are kept in images (an image_cache.ImageCache) under the keys of the tiles
+    for the other victor network.
+    The keras models have their own graph and session (KerasSession), close frees them.
+    """
+    batch_size = 4
+    scales = [1, 0.75, 1.25]
+
+    def __init__(self, network_dir, script, name, tta=None, images=None):
+        self.name = name
+        self.images = images
+        self.policy = get_policy(tta, self.scales)
+        self.tta = self.policy.key()
+        with family_context(network_dir, 'victor'):
+            self._script = importlib.import_module(script)
+            self.keras = KerasSession()
+            with self.keras.scope():
+                self.models = self._script.load_models()
+            self.weights = [os.path.abspath(os.path.join(self._script.models_folder,
+                                                         self._script.weights_file.format(fold)))
+                            for fold in range(4)]
+        self.stats = BatchStats()
+
+    def predict(self, tiles, keys=None):
+        with self.keras.scope():
+            return self._script.predict_images(self.models, tiles, batch_size=self.batch_size, stats=self.stats,
+                                               transforms=self.policy.transforms, scales=self.policy.scales,
+                                               cache=self.images, keys=keys)
+
+    def close(self):
+        self.models = None
+        self.keras.close()
+
+
+class PredictorPool:
+    """
+    Predictors of the ensemble by name, each loaded the first time it is used. With max_loaded at most that many
+    stay loaded and the least recently used one is dropped before another is loaded. Iterating yields the loaded
+    predictors first, so a pass over all models uses every loaded one before it loads the others, and still loads
+    all but max_loaded of them: pass many tiles at once to spread the loads.
+    A dropped predictor is closed if it has a close method, which frees the keras graph and session of selim and
+    victor predictors, torch frees the weights of albu predictors with the predictor.
+
+    Parameters
+    ----------
+    factories : list
+        (name, callable returning a predictor) in ensemble order.
+    max_loaded : int
+        Number of predictors kept loaded, all if None.
+    """
+
+    def __init__(self, factories, max_loaded=None):
+        if max_loaded is not None and max_loaded < 1:
+            raise ValueError(f'max_loaded must be at least 1, got {max_loaded}')
+        self.factories = OrderedDict(factories)
+        self.max_loaded = max_loaded
+        # least recently used first
+        self.loaded = OrderedDict()
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, name):
+        if name in self.loaded:
+            self.loaded.move_to_end(name)
+            return self.loaded[name]
+        while self.max_loaded is not None and len(self.loaded) >= self.max_loaded:
+            self.evict()
+        with span('load_model', model=name):
+            predictor = self.factories[name]()
+        self.loaded[name] = predictor
+        self.loads += 1
+        return predictor
+
+    def evict(self, name=None):
+        """
+        Drops the predictor name, the least recently used one if None.
+        """
+        if name is None:
+            name = next(iter(self.loaded))
+        predictor = self.loaded.pop(name)
+        if hasattr(predictor, 'close'):
+            predictor.close()
+        del predictor
+        self.evictions += 1
+        gc.collect()
+
+    def preload(self):
+        """
+        Loads the first max_loaded predictors, all of them if max_loaded is None.
+        """
+        for name in list(self.factories)[:self.max_loaded]:
+            self.get(name)
+
+    def __iter__(self):
+        names = list(self.loaded) + [name for name in self.factories if name not in self.loaded]
+        for name in names:
+            yield self.get(name)
+
+    def __len__(self):
+        return len(self.factories)
+
+    def report(self):
+        return f'models: {len(self.loaded)} of {len(self)} loaded, {self.loads} loads, {self.evictions} evictions'
+
+
+class Segmenter:
+    """
+    In-process version of predict_test.sh: runs all predictors on tile arrays,
+    merges them as victor/merge_test.py does and labels nuclei with the
+    LightGBM step of victor/create_submissions.py. Models are loaded once.
+
+    Parameters
+    ----------
+    network_dir : str
+        Full path to dsb2018_topcoders.
+    sub_id : int
+        Submission whose threshold is used, 1 gives the same labels as lgbm_test_sub2.
+    cache : tile_cache.TileCache or str
+        Cache of predictions (or its directory), tiles found there are not passed to the networks.
+    tta : dict
+        Test time augmentation of single models, see tta.TTAPolicy. Keys are output folders of selim and
+        victor networks (SELIM_NETWORKS, VICTOR_NETWORKS) and albu config names (ALBU_CONFIGS).
+    precision : dict
+        'fp32' (the default) or 'int8' for selim output folders and albu config names, int8 models are made by
+        selim/quantize_models.py and albu/src/quantize_models.py.
+    lazy : bool
+        Load every model when it is first needed instead of now.
+    max_loaded : int
+        Number of models kept loaded, see PredictorPool. All of them if None.
+    """
+
+    def __init__(self, network_dir, sub_id=1, cache=None, tta=None, precision=None, lazy=False, max_loaded=None):
+        tta = tta or {}
+        precision = precision or {}
+        # network inputs prepared for the tiles of one predict call, shared by the networks of a family
+        self.images = ImageCache()
+        factories = [(params[3], lambda params=params: SelimPredictor(
+            network_dir, *params, tta=tta.get(params[3]), images=self.images,
+            precision=precision.get(params[3], 'fp32'))) for params in SELIM_NETWORKS]
+        factories += [(config_name, lambda config_name=config_name: AlbuPredictor(
+            network_dir, config_name, tta=tta.get(config_name), precision=precision.get(config_name, 'fp32')))
+            for config_name in ALBU_CONFIGS]
+        factories += [(params[1], lambda params=params: VictorPredictor(
+            network_dir, *params, tta=tta.get(params[1]), images=self.images)) for params in VICTOR_NETWORKS]
+        # the merge does not depend on the order of the models, so loaded ones can run first
+        self.predictors = PredictorPool(factories, max_loaded)
+        if not lazy:
+            self.predictors.preload()
+        with family_context(network_dir, 'victor'):
+            self._merge_test = importlib.import_module('merge_test')
+            self._train_classifier = importlib.import_module('train_classifier')
+            self._create_submissions = importlib.import_module('create_submissions')
+            self.gbm_models = self._create_submissions.load_gbm_models()
+        self.threshold = self._create_submissions.best_thrs[sub_id]
+        self.cache = TileCache(cache) if isinstance(cache, str) else cache
+        self._model_keys = {}
+
+    def predict(self, tiles):
+        """
+        Parameters
+        ----------
+        tiles : list
+            BGR uint8 tiles, see prepare_tile.
+
+        Returns
+        -------
+        predictions : list
+            For every tile a dict from output folder name to uint8 prediction.
+        """
+        predictions = [{} for _ in tiles]
+        tile_hashes = [array_hash(tile) for tile in tiles] if self.cache is not None else None
+        try:
+            for predictor in self.predictors:
+                for tile_predictions, pred in zip(predictions, self._predict_model(predictor, tiles, tile_hashes)):
+                    tile_predictions[predictor.name] = pred
+        finally:
+            self.images.clear()
+        return predictions
+
+    def _predict_model(self, predictor, tiles, tile_hashes):
+        with span('predict', model=predictor.name, tiles=len(tiles)):
+            if self.cache is None:
+                return predictor.predict(tiles, keys=[str(i) for i in range(len(tiles))])
+            return self._predict_cached(predictor, tiles, tile_hashes)
+
+    def _predict_cached(self, predictor, tiles, tile_hashes):
+        if predictor.name not in self._model_keys:
+            self._model_keys[predictor.name] = model_key(predictor.name, predictor.weights, predictor.tta)
+        keys = [entry_key(tile_hash, self._model_keys[predictor.name]) for tile_hash in tile_hashes]
+        preds = [self.cache.get(key, predictor.name) for key in keys]
+        missing = [i for i, pred in enumerate(preds) if pred is None]
+        if missing:
+            for i, pred in zip(missing, predictor.predict([tiles[i] for i in missing], keys=[str(i) for i in missing])):
+                self.cache.put(keys[i], pred)
+                preds[i] = pred
+        return preds
+
+    def merge(self, tile_predictions):
+        preds = [tile_predictions[folder] for _, folder, _ in self._merge_test.pred_folders]
+        return self._merge_test.merge_predictions(preds)
+
+    def predict_merged(self, tiles):
+        """
+        Same as merge applied to predict, but every model output is added to a running weighted sum
+        (victor/merge_test.EnsembleAccumulator) and dropped right away, so the outputs of all models
+        are never held together.
+
+        Parameters
+        ----------
+        tiles : list
+            BGR uint8 tiles, see prepare_tile.
+
+        Returns
+        -------
+        merged : list
+            For every tile the merged prediction and the extend mask, as in merged_test and merged_extend_test.
+        """
+        accumulator = self._merge_test.EnsembleAccumulator()
+        tile_hashes = [array_hash(tile) for tile in tiles] if self.cache is not None else None
+        try:
+            for predictor in self.predictors:
+                preds = self._predict_model(predictor, tiles, tile_hashes)
+                with span('merge', model=predictor.name):
+                    for i, pred in enumerate(preds):
+                        accumulator.add(i, predictor.name, pred)
+                del preds
+        finally:
+            self.images.clear()
+        return [accumulator.pop(i) for i in range(len(tiles))]
+
+    def label(self, merged, extended):
+        inputs, labels, inputs2, labels2, separated_regions = self._train_classifier.get_inputs_from_arrays(merged,
+                                                                                                           extended)
+        pred_labels, _, _, _ = self._create_submissions.create_labels(self.gbm_models, inputs, labels, inputs2,
+                                                                      labels2, separated_regions, self.threshold)
+        return pred_labels
+
+    def segment(self, tiles, batch_size=8, background=None):
+        """
+        Segments tiles without writing anything to disk.
+
+        Parameters
+        ----------
+        tiles : iterable
+            Tiles from split_image.
+        batch_size : int
+            Number of tiles passed to the predictors at once.
+        background : background.BackgroundDetector
+            Tiles it marks as empty are not passed to the predictors and get all-zero labels.
+
+        Yields
+        ------
+        labels : numpy ndarray
+            uint16 label image of every tile, as in lgbm_test_sub2.
+        """
+        # tiles waiting for the batch in front of them, None marks a tile of the batch
+        pending = []
+        batch = []
+        for tile in tiles:
+            tile = prepare_tile(tile)
+            if background is not None and background.is_empty(tile):
+                empty = np.zeros(tile.shape[:2], dtype=np.uint16)
+                if batch:
+                    pending.append(empty)
+                else:
+                    yield empty
+                continue
+            pending.append(None)
+            batch.append(tile)
+            if len(batch) == batch_size:
+                yield from self._flush(pending, batch)
+                pending, batch = [], []
+        yield from self._flush(pending, batch)
+
+    def _flush(self, pending, batch):
+        labels = self._segment_batch(batch) if batch else iter(())
+        for item in pending:
+            yield next(labels) if item is None else item
+
+    def _segment_batch(self, batch):
+        for merged in self.predict_merged(batch):
+            with span('label'):
+                labels = self.label(*merged)
+            yield labels
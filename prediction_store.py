@@ -0,0 +1,197 @@
+import json
+import os
+import struct
+import tempfile
+import zlib
+
+import cv2 as cv
+import numpy as np
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+# codec of the chunk files written by save_prediction, PNG files are written when it is not set
+STORE_ENV = 'PREDICTION_STORE'
+META_FILE = 'meta.json'
+EXTENSION = '.chunk'
+_MAGIC = b'PCHK'
+
+
+def _compress(data, codec, level):
+    if codec == 'none':
+        return data
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    if codec == 'lz4':
+        return lz4.compress(data)
+    raise ValueError(f'Unknown codec {codec}')
+
+
+def _decompress(data, codec):
+    if codec == 'none':
+        return data
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'lz4':
+        return lz4.decompress(data)
+    raise ValueError(f'Unknown codec {codec}')
+
+
+def available_codecs():
+    return ['none', 'zlib'] + (['lz4'] if lz4 is not None else [])
+
+
+class PredictionDataset:
+    """
+    Predictions of one model (or one stage) for many images in a directory, one file per image:
+    a JSON header with shape, dtype, codec and chunk offsets followed by square chunks, so windows
+    are read without decoding the whole image. Every file is written to a temporary file and renamed,
+    so any number of processes can write to the same dataset.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the dataset, created if needed. Settings of an existing dataset are kept.
+    dtype : numpy dtype
+        Images are converted to it on write.
+    codec : str
+        'none', 'zlib' or 'lz4' (needs `pip install lz4`).
+    chunk : int
+        Chunk size along both axes.
+    level : int
+        zlib compression level.
+    """
+
+    def __init__(self, path, dtype=np.uint8, codec='zlib', chunk=256, level=1):
+        self.path = path
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+        else:
+            if codec not in available_codecs():
+                raise ValueError(f'Codec {codec} is not available, use one of {available_codecs()}')
+            meta = {'dtype': np.dtype(dtype).str, 'codec': codec, 'chunk': int(chunk), 'level': int(level)}
+            os.makedirs(path, exist_ok=True)
+            _atomic_write(meta_path, json.dumps(meta).encode())
+        self.dtype = np.dtype(meta['dtype'])
+        self.codec = meta['codec']
+        self.chunk = meta['chunk']
+        self.level = meta['level']
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, META_FILE))
+
+    def _file(self, image_id):
+        return os.path.join(self.path, image_id + EXTENSION)
+
+    def __contains__(self, image_id):
+        return os.path.exists(self._file(image_id))
+
+    def ids(self):
+        return sorted(f[:-len(EXTENSION)] for f in os.listdir(self.path) if f.endswith(EXTENSION))
+
+    def write(self, image_id, img):
+        img = np.asarray(img).astype(self.dtype, copy=False)
+        c = self.chunk
+        chunks, offsets = [], []
+        offset = 0
+        for y in range(0, img.shape[0], c):
+            for x in range(0, img.shape[1], c):
+                data = _compress(np.ascontiguousarray(img[y:y + c, x:x + c]).tobytes(), self.codec, self.level)
+                chunks.append(data)
+                offsets.append([offset, len(data)])
+                offset += len(data)
+        header = json.dumps({'shape': img.shape, 'dtype': self.dtype.str, 'codec': self.codec, 'chunk': c,
+                             'offsets': offsets}).encode()
+        _atomic_write(self._file(image_id), b''.join([_MAGIC, struct.pack('<I', len(header)), header] + chunks))
+
+    def _header(self, f):
+        if f.read(4) != _MAGIC:
+            raise ValueError(f'{f.name} is not a chunk file')
+        header = json.loads(f.read(struct.unpack('<I', f.read(4))[0]))
+        return header, f.tell()
+
+    def shape(self, image_id):
+        with open(self._file(image_id), 'rb') as f:
+            return tuple(self._header(f)[0]['shape'])
+
+    def read(self, image_id, window=None):
+        """
+        Parameters
+        ----------
+        image_id : str
+        window : tuple
+            (y0, y1, x0, x1), the whole image if None.
+
+        Returns
+        -------
+        img : numpy ndarray
+        """
+        with open(self._file(image_id), 'rb') as f:
+            header, start = self._header(f)
+            shape, c = header['shape'], header['chunk']
+            dtype = np.dtype(header['dtype'])
+            y0, y1, x0, x1 = window if window is not None else (0, shape[0], 0, shape[1])
+            y0, x0 = max(y0, 0), max(x0, 0)
+            y1, x1 = min(y1, shape[0]), min(x1, shape[1])
+            out = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0)) + tuple(shape[2:]), dtype=dtype)
+            chunks_x = -(-shape[1] // c)
+            for cy in range(y0 // c, -(-y1 // c)):
+                for cx in range(x0 // c, -(-x1 // c)):
+                    offset, length = header['offsets'][cy * chunks_x + cx]
+                    f.seek(start + offset)
+                    h, w = min(c, shape[0] - cy * c), min(c, shape[1] - cx * c)
+                    block = np.frombuffer(_decompress(f.read(length), header['codec']), dtype=dtype)
+                    block = block.reshape((h, w) + tuple(shape[2:]))
+                    by0, bx0 = max(y0 - cy * c, 0), max(x0 - cx * c, 0)
+                    by1, bx1 = min(y1 - cy * c, h), min(x1 - cx * c, w)
+                    out[cy * c + by0 - y0:cy * c + by1 - y0, cx * c + bx0 - x0:cx * c + bx1 - x0] = \
+                        block[by0:by1, bx0:bx1]
+        return out
+
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+# PNG folder or dataset, used by the scripts of dsb2018_topcoders: file names stay '<id>.png'
+
+def save_prediction(folder, file_name, img, png_params=()):
+    """
+    Writes a prediction to a dataset when PREDICTION_STORE names a codec, to a PNG file otherwise.
+    """
+    codec = os.environ.get(STORE_ENV)
+    if not codec:
+        os.makedirs(folder, exist_ok=True)
+        cv.imwrite(os.path.join(folder, file_name), img, list(png_params))
+    else:
+        PredictionDataset(folder, dtype=img.dtype, codec=codec).write(os.path.splitext(file_name)[0], img)
+
+
+def load_prediction(folder, file_name):
+    """
+    Reads a prediction written by save_prediction, from a dataset if the folder is one.
+    """
+    image_id = os.path.splitext(file_name)[0]
+    if PredictionDataset.exists(folder):
+        dataset = PredictionDataset(folder)
+        if image_id in dataset:
+            return dataset.read(image_id)
+    return cv.imread(os.path.join(folder, file_name), cv.IMREAD_UNCHANGED)
+
+
+def list_predictions(folder):
+    """
+    Sorted '<id>.png' names of the predictions in a folder or dataset.
+    """
+    names = {f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)) and '.png' in f}
+    if PredictionDataset.exists(folder):
+        names.update(image_id + '.png' for image_id in PredictionDataset(folder).ids())
+    return sorted(names)
@@ -0,0 +1,429 @@
+"""
+Local segmentation service for many concurrent slide workers: tiles of all requests are collected into batches of
+up to max_batch tiles or max_delay seconds, run through the ensemble (inference.Segmenter.predict_merged) and
+labelled with the LightGBM step of victor/create_submissions.py.
+
+    python segmentation_service.py --network-dir dsb2018_topcoders --port 8765 --max-batch 8 --max-delay 0.05
+    python segmentation_service.py --network-dir dsb2018_topcoders --socket /tmp/segmentation.sock
+
+POST /segment
+    Body: one tile as an encoded image (PNG, JPEG, TIFF) or as .npy with Content-Type application/x-npy.
+    Returns the uint16 labels as .npy, with ?format=rle JSON run lengths of every nucleus instead
+    (column-major, 1-based starts as in the Kaggle submissions).
+GET /metrics
+    Queue depth, batch sizes and latency percentiles as JSON.
+GET /health
+"""
+import argparse
+import http.client
+import http.server
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from urllib.parse import parse_qs, urlparse
+
+import cv2 as cv
+import numpy as np
+
+from inference import Segmenter, prepare_tile
+from tracing import span
+
+NPY_TYPE = 'application/x-npy'
+
+
+def label_rles(labels):
+    """
+    Run lengths of every nucleus in one pass over the label image, the same runs as
+    victor/create_submissions.rle_encoding of every label.
+
+    Parameters
+    ----------
+    labels : numpy ndarray
+        Label image, 0 is background.
+
+    Returns
+    -------
+    rles : dict
+        Label to [start, length, start, length, ...] with 1-based starts in column-major order.
+    """
+    flat = labels.T.ravel()
+    if flat.size == 0:
+        return {}
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate([[0], change])
+    lengths = np.diff(np.concatenate([starts, [flat.size]]))
+    values = flat[starts]
+    nuclei = values > 0
+    starts, lengths, values = starts[nuclei], lengths[nuclei], values[nuclei]
+    order = np.argsort(values, kind='stable')
+    rles = {}
+    for value, start, length in zip(values[order].tolist(), (starts[order] + 1).tolist(), lengths[order].tolist()):
+        rles.setdefault(value, []).extend((start, length))
+    return rles
+
+
+def _percentiles(values, q=(50, 90, 99)):
+    if not values:
+        return {f'p{p}': None for p in q}
+    return {f'p{p}': float(v) for p, v in zip(q, np.percentile(np.asarray(values) * 1000, q))}
+
+
+class ServiceStats:
+    """
+    Counters of a service and the latencies of the last window requests, safe to update from any thread.
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_sizes = Counter()
+        self.batch_seconds = 0.
+        self.max_queue_depth = 0
+        self.latencies = deque(maxlen=window)
+        self.queue_waits = deque(maxlen=window)
+
+    def add_batch(self, size, seconds, queue_waits):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes[size] += 1
+            self.batch_seconds += seconds
+            self.queue_waits.extend(queue_waits)
+
+    def add_request(self, seconds, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            if not error:
+                self.latencies.append(seconds)
+
+    def add_queue_depth(self, depth):
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def snapshot(self, queue_depth=0):
+        with self.lock:
+            tiles = sum(size * count for size, count in self.batch_sizes.items())
+            return {'queue_depth': queue_depth,
+                    'max_queue_depth': self.max_queue_depth,
+                    'requests': self.requests,
+                    'errors': self.errors,
+                    'batches': self.batches,
+                    'mean_batch_size': tiles / self.batches if self.batches else None,
+                    'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                    'inference_ms_per_batch': 1000 * self.batch_seconds / self.batches if self.batches else None,
+                    'latency_ms': _percentiles(list(self.latencies)),
+                    'queue_wait_ms': _percentiles(list(self.queue_waits))}
+
+
+class DynamicBatcher:
+    """
+    Collects tiles submitted from any thread and passes them to Segmenter.predict_merged in one worker thread:
+    a batch starts with the oldest waiting tile and takes what arrives within max_delay seconds of it,
+    up to max_batch tiles.
+
+    Parameters
+    ----------
+    segmenter : inference.Segmenter
+    max_batch : int
+    max_delay : float
+        Seconds the first tile of a batch waits for others.
+    stats : ServiceStats
+    """
+
+    def __init__(self, segmenter, max_batch=8, max_delay=0.05, stats=None):
+        self.segmenter = segmenter
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.stats = stats if stats is not None else ServiceStats()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='DynamicBatcher', daemon=True)
+        self.thread.start()
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def submit(self, tile):
+        """
+        Returns a concurrent.futures.Future of the merged prediction and the extend mask of a prepare_tile tile.
+        """
+        future = Future()
+        self.queue.put((tile, future, time.perf_counter()))
+        self.stats.add_queue_depth(self.queue.qsize())
+        return future
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = first[2] + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # stop after this batch
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            t0 = time.perf_counter()
+            try:
+                with span('service.batch', tiles=len(batch)):
+                    merged = self.segmenter.predict_merged([tile for tile, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            self.stats.add_batch(len(batch), time.perf_counter() - t0, [t0 - queued for _, _, queued in batch])
+            for (_, future, _), result in zip(batch, merged):
+                future.set_result(result)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def _decode_tile(body, content_type):
+    if content_type == NPY_TYPE:
+        return np.load(io.BytesIO(body), allow_pickle=False)
+    tile = cv.imdecode(np.frombuffer(body, dtype=np.uint8), cv.IMREAD_UNCHANGED)
+    if tile is None:
+        raise ValueError('The body is neither .npy nor an image OpenCV can decode')
+    return tile
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def _send(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code, obj):
+        self._send(code, json.dumps(obj).encode())
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif path == '/metrics':
+            self._send_json(200, self.server.metrics())
+        else:
+            self._send_json(404, {'error': f'unknown path {path}'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/segment':
+            self._send_json(404, {'error': f'unknown path {url.path}'})
+            return
+        output = parse_qs(url.query).get('format', ['labels'])[0]
+        if output not in ('labels', 'rle'):
+            self._send_json(400, {'error': f'unknown format {output}, use labels or rle'})
+            return
+        t0 = time.perf_counter()
+        try:
+            tile = prepare_tile(_decode_tile(body, self.headers.get('Content-Type')))
+        except Exception as e:
+            self.server.stats.add_request(time.perf_counter() - t0, error=True)
+            self._send_json(400, {'error': f'{type(e).__name__}: {e}'})
+            return
+        try:
+            merged, extended = self.server.batcher.submit(tile).result()
+            # labelling of one request overlaps with the inference of the next batch
+            with self.server.label_lock, span('service.label'):
+                labels = self.server.segmenter.label(merged, extended)
+        except Exception as e:
+            self.server.stats.add_request(time.perf_counter() - t0, error=True)
+            self._send_json(500, {'error': f'{type(e).__name__}: {e}'})
+            return
+        if output == 'rle':
+            rles = label_rles(labels)
+            body = json.dumps({'shape': list(labels.shape),
+                               'nuclei': [{'label': label, 'rle': rle} for label, rle in rles.items()]}).encode()
+            content_type = 'application/json'
+        else:
+            buffer = io.BytesIO()
+            np.save(buffer, labels.astype(np.uint16), allow_pickle=False)
+            body, content_type = buffer.getvalue(), NPY_TYPE
+        self.server.stats.add_request(time.perf_counter() - t0)
+        self._send(200, body, content_type)
+
+
+class SegmentationService(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    HTTP service of a Segmenter with dynamic batching on a UNIX socket (address is a path) or a TCP socket
+    (address is (host, port)). Every request is served by its own thread, which waits for the batch of its tile
+    and labels the tile. Labelling holds a lock because LightGBM boosters are not guaranteed to be thread-safe.
+
+    Parameters
+    ----------
+    address : str or tuple
+    segmenter : inference.Segmenter
+    max_batch : int
+        Largest number of tiles passed to the ensemble at once.
+    max_delay : float
+        Seconds a tile waits for others to fill its batch.
+    verbose : bool
+        Log every request to stderr.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, segmenter, max_batch=8, max_delay=0.05, verbose=False):
+        self.address_family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+        self.segmenter = segmenter
+        self.verbose = verbose
+        self.stats = ServiceStats()
+        self.label_lock = threading.Lock()
+        self.batcher = DynamicBatcher(segmenter, max_batch, max_delay, self.stats)
+        super().__init__(address, _Handler)
+
+    def server_bind(self):
+        if self.address_family != socket.AF_UNIX:
+            super().server_bind()
+            return
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+    def metrics(self):
+        metrics = self.stats.snapshot(self.batcher.queue_depth)
+        metrics['max_batch'] = self.batcher.max_batch
+        metrics['max_delay_ms'] = 1000 * self.batcher.max_delay
+        predictors = getattr(self.segmenter, 'predictors', None)
+        if hasattr(predictors, 'report'):
+            metrics['models'] = predictors.report()
+        return metrics
+
+    def server_close(self):
+        super().server_close()
+        self.batcher.close()
+        if isinstance(self.server_address, str) and os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class SegmentationClient:
+    """
+    Keep-alive connection to a SegmentationService, one per thread.
+
+    Parameters
+    ----------
+    address : str or tuple
+        Path of the UNIX socket or (host, port).
+    timeout : float
+        Seconds to wait for a response, forever if None.
+    """
+
+    def __init__(self, address, timeout=None):
+        if isinstance(address, str):
+            self.connection = _UnixHTTPConnection(address, timeout)
+        else:
+            self.connection = http.client.HTTPConnection(*address, timeout=timeout)
+
+    def _request(self, method, path, body=None, headers=None):
+        self.connection.request(method, path, body=body, headers=headers or {})
+        response = self.connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise RuntimeError(f'Segmentation service error {response.status}: {data.decode()}')
+        return response, data
+
+    def segment(self, tile, rle=False):
+        """
+        Parameters
+        ----------
+        tile : numpy ndarray
+            Tile from split_image.
+        rle : bool
+            Return run lengths instead of the label image.
+
+        Returns
+        -------
+        labels : numpy ndarray or dict
+            uint16 labels, or label to run lengths (see label_rles) and the tile shape under 'shape'.
+        """
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(tile), allow_pickle=False)
+        _, data = self._request('POST', '/segment?format=rle' if rle else '/segment', buffer.getvalue(),
+                                {'Content-Type': NPY_TYPE})
+        if not rle:
+            return np.load(io.BytesIO(data), allow_pickle=False)
+        result = json.loads(data)
+        rles = {nucleus['label']: nucleus['rle'] for nucleus in result['nuclei']}
+        rles['shape'] = tuple(result['shape'])
+        return rles
+
+    def metrics(self):
+        return json.loads(self._request('GET', '/metrics')[1])
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--network-dir', required=True)
+    address = parser.add_mutually_exclusive_group(required=True)
+    address.add_argument('--socket', help='path of the UNIX socket')
+    address.add_argument('--port', type=int, help='TCP port')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--max-delay', type=float, default=0.05, help='seconds a tile waits for a fuller batch')
+    parser.add_argument('--lazy', action='store_true', help='load every model when it is first needed')
+    parser.add_argument('--max-loaded', type=int, help='number of models kept loaded, all of them if not set')
+    parser.add_argument('--cache', help='directory of a tile_cache.TileCache')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    segmenter = Segmenter(os.path.abspath(args.network_dir), cache=args.cache, lazy=args.lazy,
+                          max_loaded=args.max_loaded)
+    with SegmentationService(args.socket or (args.host, args.port), segmenter, args.max_batch, args.max_delay,
+                             args.verbose) as service:
+        print(f'serving on {service.server_address}, batches of up to {args.max_batch} tiles or {args.max_delay} s')
+        service.serve_forever()
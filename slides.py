@@ -0,0 +1,193 @@
+import os
+
+import cv2 as cv
+import numpy as np
+from matplotlib import pyplot as plt
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+def read_image(full_img_path):
+    try:
+        full_img = cv.imread(full_img_path, -1)
+    except cv.error:
+        full_img = plt.imread(full_img_path)
+    return full_img
+
+
+def open_slide(full_img_path, shape=None, dtype=np.uint8):
+    """
+    Opens a slide for windowed reading.
+    The result has shape, dtype and numpy-style img[y0:y1, x0:x1] slicing, only the requested window is read:
+    .npy and .raw files and uncompressed TIFFs are memory-mapped, other TIFFs are read strip by strip
+    or tile by tile with TiffSource. Formats without random access (png, jpg, ...) are decoded completely.
+
+    Parameters
+    ----------
+    full_img_path : str
+        Path to the image.
+    shape : tuple
+        Shape of a .raw file, (height, width) or (height, width, channels).
+    dtype : numpy dtype
+        Data type of a .raw file.
+
+    Returns
+    -------
+    img : numpy ndarray or TiffSource
+        The slide.
+    """
+    ext = os.path.splitext(full_img_path)[1].lower()
+    if ext == '.npy':
+        return np.load(full_img_path, mmap_mode='r')
+    if ext == '.raw':
+        if shape is None:
+            raise ValueError('Specify shape of the raw file.')
+        return np.memmap(full_img_path, dtype=dtype, mode='r', shape=tuple(shape))
+    if ext in ('.tif', '.tiff') and tifffile is not None:
+        with tifffile.TiffFile(full_img_path) as tif:
+            memmappable = tif.pages[0].is_memmappable
+        if memmappable:
+            return tifffile.memmap(full_img_path, mode='r')
+        return TiffSource(full_img_path)
+    return read_image(full_img_path)
+
+
+def create_slide(full_img_path, shape, dtype):
+    """
+    Creates a disk-backed image which can be written window by window.
+
+    Parameters
+    ----------
+    full_img_path : str
+        Path to a '.npy' file or a '.tif' file, TIFFs are written as BigTIFF and need tifffile.
+    shape : tuple
+        Shape of the image.
+    dtype : numpy dtype
+        Data type of the image.
+
+    Returns
+    -------
+    img : numpy memmap
+        Writable image, open it later with open_slide.
+    """
+    ext = os.path.splitext(full_img_path)[1].lower()
+    shape = tuple(int(i) for i in shape)
+    if ext == '.npy':
+        return np.lib.format.open_memmap(full_img_path, mode='w+', dtype=dtype, shape=shape)
+    if ext in ('.tif', '.tiff'):
+        if tifffile is None:
+            raise ImportError('Writing TIFF slides needs tifffile')
+        photometric = 'rgb' if len(shape) == 3 and shape[2] in (3, 4) else 'minisblack'
+        return tifffile.memmap(full_img_path, shape=shape, dtype=dtype, bigtiff=True, photometric=photometric)
+    raise ValueError(f'Unsupported slide format {ext}, use .npy or .tif')
+
+
+class TiffSource:
+    """
+    First page of a TIFF file read lazily: img[y0:y1, x0:x1] decodes only the strips or tiles
+    overlapping the window. Needs tifffile.
+
+    Parameters
+    ----------
+    path : str
+        Path to the TIFF file.
+    """
+
+    def __init__(self, path):
+        if tifffile is None:
+            raise ImportError('TiffSource needs tifffile')
+        self.path = path
+        self._tif = tifffile.TiffFile(path)
+        self._page = self._tif.pages[0]
+        if self._page.planarconfig != 1 and self._page.samplesperpixel > 1:
+            raise ValueError(f'{path}: only contiguous TIFF samples are supported')
+        self.shape = self._page.shape
+        self.dtype = self._page.dtype
+        self.ndim = len(self.shape)
+        if self._page.is_tiled:
+            self._segment_shape = (self._page.tilelength, self._page.tilewidth)
+        else:
+            self._segment_shape = (min(self._page.rowsperstrip, self.shape[0]), self.shape[1])
+        self._segments_x = -(-self.shape[1] // self._segment_shape[1])
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (2 - len(key))
+        (y0, y1, y_step), (x0, x1, x_step) = [k.indices(n) for k, n in zip(key[:2], self.shape[:2])]
+        if y_step != 1 or x_step != 1:
+            raise IndexError('TiffSource supports only contiguous windows')
+        window = self.read(y0, max(y1, y0), x0, max(x1, x0))
+        return window[(slice(None), slice(None)) + key[2:]]
+
+    def read(self, y0, y1, x0, x1):
+        """
+        Decodes a window of the slide.
+
+        Parameters
+        ----------
+        y0, y1, x0, x1 : integer
+            Window bounds, arr.shape[0] is y.
+
+        Returns
+        -------
+        window : numpy ndarray
+            Window of shape (y1 - y0, x1 - x0) + channels.
+        """
+        window = np.zeros((y1 - y0, x1 - x0) + self.shape[2:], dtype=self.dtype)
+        if y1 == y0 or x1 == x0:
+            return window
+        segment_h, segment_w = self._segment_shape
+        fh = self._tif.filehandle
+        for segment_y in range(y0 // segment_h, -(-y1 // segment_h)):
+            for segment_x in range(x0 // segment_w, -(-x1 // segment_w)):
+                index = segment_y * self._segments_x + segment_x
+                data = None
+                if self._page.databytecounts[index] > 0:
+                    with fh.lock:
+                        fh.seek(self._page.dataoffsets[index])
+                        data = fh.read(self._page.databytecounts[index])
+                segment, (_, _, top, left, _), _ = self._page.decode(data, index, jpegtables=self._page.jpegtables)
+                if segment is None:
+                    continue
+                segment = segment[0].reshape(segment.shape[1:3] + self.shape[2:])
+                sy0, sy1 = max(y0, top), min(y1, top + segment.shape[0], self.shape[0])
+                sx0, sx1 = max(x0, left), min(x1, left + segment.shape[1], self.shape[1])
+                window[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = segment[sy0 - top:sy1 - top, sx0 - left:sx1 - left]
+        return window
+
+    def close(self):
+        self._tif.close()
+
+
+class TileWindows:
+    """
+    Tiles of a TiffSource for split_image: a list-like object which reads a tile when it is accessed,
+    so only the tiles in use are kept in memory.
+
+    Parameters
+    ----------
+    img : TiffSource
+        The slide.
+    windows : list
+        (y0, y1, x0, x1) of every tile.
+    """
+
+    def __init__(self, img, windows):
+        self.img = img
+        self.windows = windows
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return TileWindows(self.img, self.windows[i])
+        return self.img.read(*self.windows[i])
+
+    def __iter__(self):
+        for window in self.windows:
+            yield self.img.read(*window)
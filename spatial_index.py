@@ -0,0 +1,158 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from feature_store import FeatureTable, FeatureWriter
+
+
+def read_features(features_path, columns=None):
+    """
+    Features saved by perform_segmentation, a .csv file or a .features table.
+    """
+    if features_path.endswith('.features'):
+        return FeatureTable(features_path).read(columns)
+    return pd.read_csv(features_path, usecols=columns)
+
+
+class NucleiIndex:
+    """
+    Slide-level spatial index of nuclei centres in global coordinates (the x and y features).
+    Queries return row numbers of the features table. Nuclei without a position (NaN) are not indexed.
+
+    Parameters
+    ----------
+    x, y : numpy ndarray
+        Coordinates of nuclei.
+    ids : numpy ndarray
+        Row numbers of nuclei, 0..len(x) - 1 by default.
+    """
+
+    def __init__(self, x, y, ids=None):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        ids = np.arange(len(x)) if ids is None else np.asarray(ids)
+        finite = np.isfinite(x) & np.isfinite(y)
+        self.rows = len(x)
+        self.ids = ids[finite]
+        self.points = np.stack([x[finite], y[finite]], axis=1)
+        self.tree = cKDTree(self.points)
+
+    @classmethod
+    def from_df(cls, df, x='x', y='y'):
+        return cls(df[x].values, df[y].values)
+
+    @classmethod
+    def from_features(cls, features_path):
+        return cls.from_df(read_features(features_path, ['x', 'y']))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def radius(self, x, y, r):
+        """
+        Row numbers of nuclei within r pixels of (x, y).
+        """
+        return np.sort(self.ids[self.tree.query_ball_point([x, y], r)])
+
+    def knn(self, x, y, k=1):
+        """
+        The k nearest nuclei of (x, y).
+
+        Returns
+        -------
+        distances : numpy ndarray
+        ids : numpy ndarray
+            Row numbers of the nuclei, nearest first.
+        """
+        k = min(k, len(self))
+        if k == 0:
+            return np.empty(0), self.ids[:0]
+        distances, found = self.tree.query([x, y], k=k)
+        return np.atleast_1d(distances), self.ids[np.atleast_1d(found)]
+
+    def rectangle(self, x0, y0, x1, y1):
+        """
+        Row numbers of nuclei with x0 <= x <= x1 and y0 <= y <= y1.
+        """
+        # the chebyshev ball around the centre contains the rectangle, widened by more than the rounding
+        # of the centre so that nuclei on the border are found
+        half = max(x1 - x0, y1 - y0, 0) / 2 + 1e-9 * max(1, abs(x0), abs(x1), abs(y0), abs(y1))
+        found = np.asarray(self.tree.query_ball_point([(x0 + x1) / 2, (y0 + y1) / 2], half, p=np.inf), dtype=np.intp)
+        points = self.points[found]
+        inside = (points[:, 0] >= x0) & (points[:, 0] <= x1) & (points[:, 1] >= y0) & (points[:, 1] <= y1)
+        return np.sort(self.ids[found[inside]])
+
+    def density_features(self, radii=(50, 100, 150), k=5):
+        """
+        Neighbourhood features of every nucleus, computed for all nuclei at once:
+        the number of other nuclei within each radius and the mean distance to the k nearest ones.
+
+        Returns
+        -------
+        df : pandas DataFrame
+            One row per row of the features table, NaN for nuclei without a position.
+        """
+        columns = {}
+        for r in radii:
+            counts = np.full(self.rows, np.nan)
+            counts[self.ids] = self.tree.query_ball_point(self.points, r, return_length=True) - 1
+            columns[f'neighbors_{r}'] = counts
+        distances = np.full(self.rows, np.nan)
+        if len(self) > 1:
+            neighbours = min(k, len(self) - 1)
+            distances[self.ids] = self.tree.query(self.points, k=neighbours + 1)[0][:, 1:].mean(axis=1)
+        columns[f'knn_{k}_distance'] = distances
+        return pd.DataFrame(columns)
+
+    def save(self, path):
+        np.savez(path, x=self.points[:, 0], y=self.points[:, 1], ids=self.ids, rows=self.rows)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(data['x'], data['y'], data['ids'])
+        index.rows = int(data['rows'])
+        return index
+
+
+def index_path(features_path):
+    return f'{os.path.splitext(features_path)[0]}.index.npz'
+
+
+def density_path(features_path):
+    base, extension = os.path.splitext(features_path)
+    return f'{base}.density{extension}'
+
+
+def save_density(density, features_path):
+    """
+    Saves density features next to the features file in the same format, see density_path. A .features
+    table gets a table with the same tiles and rows (see feature_store.FeatureWriter), a .csv file a .csv file.
+    """
+    path = density_path(features_path)
+    if not features_path.endswith('.features'):
+        density.to_csv(path, index=False)
+        return path
+    table = FeatureTable(features_path)
+    with FeatureWriter(path, list(density.columns), ['density']) as writer:
+        for tile_name, (start, stop) in sorted(table.tiles.items(), key=lambda item: item[1]):
+            writer.append(tile_name, [density[name].values[start:stop] for name in density.columns],
+                          table.label_hashes[tile_name])
+    return path
+
+
+def build_index(features_path, radii=(50, 100, 150), k=5):
+    """
+    Builds the spatial index of a features file and saves it next to it (see index_path) together with
+    the density features of every nucleus (see NucleiIndex.density_features and save_density).
+
+    Returns
+    -------
+    index : NucleiIndex
+    """
+    index = NucleiIndex.from_features(features_path)
+    index.save(index_path(features_path))
+    save_density(index.density_features(radii, k), features_path)
+    return index
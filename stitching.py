@@ -0,0 +1,123 @@
+import numpy as np
+
+
+def crop_halo(tile, x, y, x_max, y_max, halo):
+    """
+    Cuts the halo added by split_image from a tile.
+
+    Parameters
+    ----------
+    tile : numpy ndarray
+        Tile with halo.
+    x, y : integer
+        Tile position from its name.
+    x_max, y_max : integer
+        Last tile positions.
+    halo : integer
+        Halo size used in split_image.
+
+    Returns
+    -------
+    tile : numpy ndarray
+        View of the tile without halo.
+    """
+    top = halo if y > 0 else 0
+    bottom = tile.shape[0] - (halo if y < y_max else 0)
+    left = halo if x > 0 else 0
+    right = tile.shape[1] - (halo if x < x_max else 0)
+    return tile[top:bottom, left:right]
+
+
+def overlap_label_pairs(a, b, min_overlap=0.5):
+    """
+    Finds labels of two tiles which mark the same nucleus in the area both tiles cover.
+
+    Parameters
+    ----------
+    a, b : numpy ndarray
+        The same area of the slide labeled by two neighbouring tiles, labels are unique over the slide.
+    min_overlap : float
+        Part of the smaller of the two objects in the area which has to coincide.
+
+    Returns
+    -------
+    pairs : numpy ndarray
+        Array of shape (n, 2) with label pairs.
+    """
+    a = a.ravel().astype(np.int64)
+    b = b.ravel().astype(np.int64)
+    both = (a > 0) & (b > 0)
+    if not both.any():
+        return np.zeros((0, 2), dtype=np.int64)
+    # labels of one tile are a contiguous range, so the areas are counted relative to its smallest label
+    a_min = a[a > 0].min()
+    b_min = b[b > 0].min()
+    a_area = np.bincount(a[a > 0] - a_min)
+    b_area = np.bincount(b[b > 0] - b_min)
+
+    keys, counts = np.unique((a[both] << 32) | b[both], return_counts=True)
+    pairs = np.stack([keys >> 32, keys & 0xffffffff], axis=1)
+    smaller = np.minimum(a_area[pairs[:, 0] - a_min], b_area[pairs[:, 1] - b_min])
+    return pairs[counts >= min_overlap * smaller]
+
+
+def merge_labels(pairs, n_labels):
+    """
+    Union-find over label pairs.
+
+    Parameters
+    ----------
+    pairs : numpy ndarray
+        Array of shape (n, 2) with labels of the same nucleus.
+    n_labels : integer
+        Largest label.
+
+    Returns
+    -------
+    lut : numpy ndarray
+        Lookup table from a label to the smallest label of its group, lut[0] is 0.
+    """
+    parent = np.arange(n_labels + 1)
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for a, b in pairs:
+        a, b = find(a), find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    while True:
+        grandparent = parent[parent]
+        if (grandparent == parent).all():
+            return parent
+        parent = grandparent
+
+
+def sequential_lut(lut, present):
+    """
+    Renumbers merged labels to 1..n in the order of their smallest member.
+
+    Parameters
+    ----------
+    lut : numpy ndarray
+        Lookup table from merge_labels.
+    present : numpy ndarray
+        Boolean mask of labels left in the image after cropping halos.
+
+    Returns
+    -------
+    lut : numpy ndarray
+        Lookup table to consecutive labels.
+    """
+    present = present.copy()
+    present[0] = False
+    roots = np.unique(lut[present])
+    new_ids = np.zeros(len(lut), dtype=np.int64)
+    new_ids[roots] = np.arange(1, len(roots) + 1)
+    return new_ids[lut]
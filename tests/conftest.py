@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the root modules are imported as in run_test.py, from the repository root
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,53 @@
+"""
+batch.run_batch on a spawn pool with a segmenter that labels bright pixels instead of running the networks.
+"""
+import json
+import os
+
+import cv2 as cv
+import numpy as np
+
+from batch import run_batch
+from data_tools import split_image
+
+
+class ThresholdSegmenter:
+    # loaded once per worker as inference.Segmenter is
+    def __init__(self, network_dir, cache=None):
+        self.cache = cache
+
+    def segment(self, tiles, background=None):
+        for tile in tiles:
+            gray = cv.cvtColor(np.asarray(tile), cv.COLOR_BGR2GRAY)
+            yield cv.connectedComponents((gray > 127).astype(np.uint8))[1].astype(np.uint16)
+
+
+def slide(path, seed):
+    img = np.zeros((150, 200, 3), dtype=np.uint8)
+    rng = np.random.RandomState(seed)
+    for x, y in zip(rng.randint(0, 200, 10), rng.randint(0, 150, 10)):
+        cv.circle(img, (int(x), int(y)), 5, (255, 255, 255), -1)
+    np.save(path, img)
+    return img
+
+
+def test_run_batch(tmp_path):
+    images = [slide(str(tmp_path / f'slide{i}.npy'), i) for i in range(3)]
+    slides = [str(tmp_path / f'slide{i}.npy') for i in range(3)] + [str(tmp_path / 'missing.npy')]
+    manifest = run_batch(slides, str(tmp_path / 'out'), str(tmp_path), workers=2, threads_per_job=1,
+                         segmenter_class=ThresholdSegmenter, tile_size=100)
+
+    with open(tmp_path / 'out' / 'manifest.json') as f:
+        assert json.load(f) == manifest
+    jobs = {job['name']: job for job in manifest['jobs']}
+    assert [jobs[f'slide{i}']['status'] for i in range(3)] == ['done'] * 3
+    assert jobs['missing']['status'] == 'failed' and 'missing.npy' in jobs['missing']['error']
+    assert len({job['pid'] for job in manifest['jobs']}) <= 2
+    for i, img in enumerate(images):
+        job = jobs[f'slide{i}']
+        assert job['tiles'] == len(split_image(img, x_tile_size=100, y_tile_size=100)[1])
+        assert job['started'] <= job['finished']
+        labels = np.load(job['labels'])
+        assert job['labels'] == os.path.join(job['workspace'], 'labels.npy')
+        # tiles are labelled separately, a nucleus cut by a seam gets two labels
+        np.testing.assert_array_equal(labels > 0, cv.cvtColor(img, cv.COLOR_BGR2GRAY) > 127)
@@ -0,0 +1,115 @@
+"""
+NucleiFeatures.tile_columns against the per-label feature functions of NucleiFeatures, on one tile and on the
+windows of a stitched label image with nuclei cut by tile seams.
+"""
+import cv2 as cv
+import numpy as np
+import pytest
+
+from data_tools import _stitched_windows, restore_tiles, split_image
+from feature_store import FeatureTable
+from features import NucleiFeatures, get_x_and_y
+
+FEATURES = ['position', 'size', 'ellipse', 'color']
+ELLIPSE = ['first_axis', 'second_axis', 'ellipse_x', 'ellipse_y', 'ellipse_angle']
+
+
+def nuclei_mask(shape, nuclei, seed=0):
+    rng = np.random.RandomState(seed)
+    mask = np.zeros(shape, dtype=np.uint8)
+    for x, y, r in zip(rng.randint(0, shape[1], nuclei), rng.randint(0, shape[0], nuclei), rng.randint(3, 8, nuclei)):
+        cv.ellipse(mask, (int(x), int(y)), (int(r), int(r) + int(rng.randint(0, 4))), int(rng.randint(0, 180)),
+                   0, 360, 1, -1)
+    return mask
+
+
+def per_label_rows(nuclei_features, img, orig, filename, labels):
+    # the feature functions on the mask of every label, on transposed tiles as NucleiFeatures.compute did
+    x_tile, y_tile = get_x_and_y(filename)
+    if orig.ndim == 2:
+        # NucleiFeatures.color takes the channels from the last axis
+        orig = orig[..., np.newaxis]
+    img, orig = img.swapaxes(0, 1), orig.swapaxes(0, 1)
+    rows = []
+    for i in labels:
+        row = []
+        for f in nuclei_features.features:
+            row += nuclei_features.feature_dict[f][0](img == i, orig, x_tile=x_tile, y_tile=y_tile)
+        rows.append(row)
+    return np.array(rows, dtype=float).reshape(len(rows), len(nuclei_features.feature_names))
+
+
+def assert_rows_equal(nuclei_features, rows, expected):
+    names = nuclei_features.feature_names
+    exact = [i for i, name in enumerate(names) if name not in ELLIPSE]
+    ellipse = [i for i, name in enumerate(names) if name in ELLIPSE]
+    np.testing.assert_allclose(rows[:, exact], expected[:, exact], rtol=1e-9, atol=1e-9)
+    # contours of the bounding box crops are shifted, the fitted ellipses differ by rounding only
+    np.testing.assert_allclose(rows[:, ellipse], expected[:, ellipse], rtol=1e-4, atol=1e-3)
+
+
+@pytest.mark.parametrize('features, channels', [(FEATURES, 3), (['position', 'size', 'color_gray'], 1)])
+def test_tile_columns_match_per_label_features(features, channels):
+    # not square, so rows and columns can not be swapped unnoticed
+    img = cv.connectedComponents(nuclei_mask((240, 320), 120))[1].astype(np.uint16)
+    shape = img.shape if channels == 1 else img.shape + (channels,)
+    orig = np.random.RandomState(1).randint(0, 256, shape).astype(np.uint8)
+    nuclei_features = NucleiFeatures(None, None, features, x_min=5, y_min=7)
+    rows = np.array(nuclei_features.compute_tile(img, orig, 'img_2_1'), dtype=float)
+    # labels 1..img.max() - 1 as before
+    expected = per_label_rows(nuclei_features, img, orig, 'img_2_1', range(1, img.max()))
+    assert rows.shape == expected.shape
+    assert_rows_equal(nuclei_features, rows, expected)
+
+
+def test_color_gray_of_bgr_tile_uses_the_gray_image():
+    img = cv.connectedComponents(nuclei_mask((100, 100), 20))[1].astype(np.uint16)
+    orig = np.random.RandomState(1).randint(0, 256, img.shape + (3,)).astype(np.uint8)
+    nuclei_features = NucleiFeatures(None, None, ['color_gray'])
+    gray = nuclei_features.tile_columns(img, cv.cvtColor(orig, cv.COLOR_BGR2GRAY), 'img_0_0')
+    np.testing.assert_allclose(nuclei_features.tile_columns(img, orig, 'img_0_0'), gray)
+
+
+def test_compute_multipricess_streams_to_table(tmp_path):
+    tif_folder, png_folder = tmp_path / 'labels', tmp_path / 'tiles'
+    tif_folder.mkdir()
+    rng = np.random.RandomState(1)
+    for i, (x, y) in enumerate([(0, 0), (1, 0), (0, 1), (1, 1), (2, 0)]):
+        name = f'img_{x}_{y}'
+        img = cv.connectedComponents(nuclei_mask((120, 160), 20, seed=i))[1].astype(np.uint16)
+        cv.imwrite(str(tif_folder / f'{name}.tif'), img)
+        (png_folder / name / 'images').mkdir(parents=True)
+        cv.imwrite(str(png_folder / name / 'images' / f'{name}.png'), rng.randint(0, 256, (120, 160, 3), np.uint8))
+
+    nuclei_features = NucleiFeatures(str(tif_folder), str(png_folder), FEATURES)
+    df = nuclei_features.compute_multipricess(n_workers=2, chunksize=2).df()
+    # the parent keeps no rows, the table holds them
+    assert nuclei_features.computed_features is None
+    assert len(FeatureTable(f'{tif_folder}.features')) == len(df)
+    expected = NucleiFeatures(str(tif_folder), str(png_folder), FEATURES).compute().df()
+    assert list(df.columns) == list(expected.columns)
+    np.testing.assert_allclose(df.values, expected.values, rtol=1e-5, atol=1e-3)
+
+
+def test_stitched_windows_match_whole_image():
+    halo = 16
+    mask = nuclei_mask((300, 400), 100)
+    # nuclei on the corner of four tiles and on a vertical seam
+    cv.circle(mask, (133, 150), 6, 1, -1)
+    cv.circle(mask, (266, 60), 7, 1, -1)
+    orig = np.random.RandomState(1).randint(0, 256, mask.shape + (3,)).astype(np.uint8)
+    tiles, tile_names = split_image(mask, x_tiles_cnt=3, y_tiles_cnt=2, halo=halo)
+    labels = restore_tiles([cv.connectedComponents(tile)[1].astype(np.uint16) for tile in tiles], tile_names,
+                           tiff=True, halo=halo)
+    x_ticks, y_ticks = np.linspace(0, 400, 4).astype(int), np.linspace(0, 300, 3).astype(int)
+    windows = list(_stitched_windows(labels, orig, y_ticks, x_ticks, 'img'))
+
+    nuclei_features = NucleiFeatures(None, None, FEATURES)
+    rows = np.array(nuclei_features.compute_tiles(*zip(*windows)).computed_features, dtype=float)
+    expected = per_label_rows(nuclei_features, labels, orig, 'img_0_0', range(1, labels.max() + 1))
+    assert rows.shape == expected.shape
+    # windows list the nuclei in another order
+    assert_rows_equal(nuclei_features, rows[np.lexsort(rows[:, :2].T)], expected[np.lexsort(expected[:, :2].T)])
+    sizes = rows[:, nuclei_features.feature_names.index('size')]
+    for x, y in [(133, 150), (266, 60)]:
+        assert (labels == labels[y, x]).sum() in sizes
@@ -0,0 +1,56 @@
+"""
+Frozen albu models of pytorch_utils/freeze.py against the eager models, with random weights on CPU.
+"""
+import functools
+import importlib
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from inference import family_context
+
+NETWORK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dsb2018_topcoders')
+ATOL = 1e-3
+
+
+def random_model(unet, network, num_classes=3, num_channels=3):
+    torch.manual_seed(0)
+    model = getattr(unet, network)(num_classes, num_channels)
+    # batch norms with default statistics fold into the identity
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.1, 0.1)
+            module.running_var.uniform_(0.5, 1.5)
+            module.weight.data.uniform_(0.5, 1.5)
+            module.bias.data.uniform_(-0.1, 0.1)
+    return model.eval()
+
+
+@pytest.mark.parametrize('network', ['Resnet34_upsample', 'DPNUnet'])
+def test_frozen_model_matches(network, monkeypatch):
+    with family_context(NETWORK_DIR, 'albu'):
+        abstract_model = importlib.import_module('pytorch_zoo.abstract_model')
+        unet = importlib.import_module('pytorch_zoo.unet')
+        freeze = importlib.import_module('pytorch_utils.freeze')
+    # random encoder weights instead of the downloaded pretrained ones
+    monkeypatch.setattr(abstract_model.AbstractModel, 'initialize_encoder', lambda self, *args, **kwargs: None)
+    dpn92 = abstract_model.encoder_params['dpn92']
+    monkeypatch.setitem(dpn92, 'init_op', functools.partial(dpn92['init_op'], pretrained=None))
+    model = random_model(unet, network)
+
+    folded_model = random_model(unet, network)
+    assert freeze.fold_batchnorm(folded_model) > 0
+
+    generator = torch.Generator().manual_seed(0)
+    example = torch.rand(1, 3, 256, 256, generator=generator)
+    assert freeze.max_difference(model, folded_model, example) < ATOL
+    frozen = freeze.freeze(model, example, optimize=False)
+    # the traced shape and a smaller non-square one, as export_model checks
+    check = torch.rand(1, 3, 192, 128, generator=generator)
+    assert freeze.max_difference(model, frozen, example) < ATOL
+    assert freeze.max_difference(model, frozen, check) < ATOL
+
+    optimized = freeze.freeze(model, example)
+    assert freeze.max_difference(model, optimized, example) < ATOL
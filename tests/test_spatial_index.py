@@ -0,0 +1,110 @@
+"""
+spatial_index.NucleiIndex queries against brute-force distances on a small random point set.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from feature_store import FeatureTable, FeatureWriter
+from spatial_index import NucleiIndex, build_index, density_path, index_path
+
+
+def random_points(n=300, seed=0):
+    rng = np.random.RandomState(seed)
+    # integer coordinates put many nuclei exactly on query radii and rectangle borders
+    x = rng.randint(0, 200, n).astype(float)
+    y = rng.randint(0, 100, n).astype(float)
+    x[::37] = np.nan
+    return x, y
+
+
+def distances(x, y, x0, y0):
+    return np.hypot(x - x0, y - y0)
+
+
+def test_radius():
+    x, y = random_points()
+    index = NucleiIndex(x, y)
+    assert len(index) == np.isfinite(x).sum()
+    for x0, y0, r in [(50, 50, 10), (0, 0, 20), (100.5, 30.5, 0.1), (150, 50, 0)]:
+        expected = np.flatnonzero(distances(x, y, x0, y0) <= r)
+        np.testing.assert_array_equal(index.radius(x0, y0, r), expected)
+    assert len(index.radius(-100, -100, 5)) == 0
+
+
+@pytest.mark.parametrize('k', [1, 7])
+def test_knn(k):
+    x, y = random_points()
+    index = NucleiIndex(x, y)
+    found_distances, ids = index.knn(60.3, 40.7, k)
+    d = distances(x, y, 60.3, 40.7)
+    np.testing.assert_allclose(found_distances, np.sort(d[np.isfinite(d)])[:k])
+    np.testing.assert_allclose(d[ids], found_distances)
+    # more neighbours than nuclei, and no nuclei at all
+    assert len(NucleiIndex(x[:5], y[:5]).knn(0, 0, 10)[1]) == np.isfinite(x[:5]).sum()
+    found_distances, ids = NucleiIndex(np.empty(0), np.empty(0)).knn(0, 0, k)
+    assert len(found_distances) == len(ids) == 0
+
+
+def test_rectangle():
+    x, y = random_points()
+    index = NucleiIndex(x, y)
+    for x0, y0, x1, y1 in [(10, 20, 60, 40), (0, 0, 199, 99), (30, 30, 30, 30), (50, 10, 52, 90), (10, 10, 5, 20)]:
+        expected = np.flatnonzero((x >= x0) & (x <= x1) & (y >= y0) & (y <= y1))
+        np.testing.assert_array_equal(index.rectangle(x0, y0, x1, y1), expected)
+    # nuclei on the borders of a rectangle whose centre is rounded
+    border = NucleiIndex([544.9, 602.8, 570, 603], [0, 0, 0, 0])
+    np.testing.assert_array_equal(border.rectangle(544.9, 0, 602.8, 0), [0, 1, 2])
+    assert len(NucleiIndex(np.empty(0), np.empty(0)).rectangle(0, 0, 10, 10)) == 0
+
+
+def test_density_features():
+    x, y = random_points()
+    density = NucleiIndex(x, y).density_features(radii=(5, 20), k=3)
+    assert len(density) == len(x)
+    finite = np.isfinite(x)
+    for i in range(len(x)):
+        if not finite[i]:
+            assert density.iloc[i].isna().all()
+            continue
+        d = distances(x, y, x[i], y[i])
+        d = np.delete(d, i)
+        d = d[np.isfinite(d)]
+        assert density['neighbors_5'][i] == (d <= 5).sum()
+        assert density['neighbors_20'][i] == (d <= 20).sum()
+        assert density['knn_3_distance'][i] == pytest.approx(np.sort(d)[:3].mean())
+
+
+def test_save_load(tmp_path):
+    x, y = random_points()
+    index = NucleiIndex(x, y)
+    index.save(str(tmp_path / 'index.npz'))
+    loaded = NucleiIndex.load(str(tmp_path / 'index.npz'))
+    assert loaded.rows == index.rows and len(loaded) == len(index)
+    np.testing.assert_array_equal(loaded.rectangle(10, 20, 60, 40), index.rectangle(10, 20, 60, 40))
+    np.testing.assert_array_equal(loaded.radius(50, 50, 10), index.radius(50, 50, 10))
+    pd.testing.assert_frame_equal(loaded.density_features(), index.density_features())
+
+
+def test_build_index_saves_density(tmp_path):
+    x, y = random_points()
+    size = np.arange(len(x))
+    features_path = str(tmp_path / 'sample.features')
+    with FeatureWriter(features_path, ['x', 'y', 'size'], ['position', 'size']) as writer:
+        for name, start, stop in [('img_0_0', 0, 100), ('img_1_0', 100, 100), ('img_0_1', 100, len(x))]:
+            writer.append(name, [x[start:stop], y[start:stop], size[start:stop]], name)
+    index = build_index(features_path)
+    assert os.path.exists(index_path(features_path))
+
+    density = FeatureTable(density_path(features_path))
+    features = FeatureTable(features_path)
+    assert density.tiles == features.tiles and density.label_hashes == features.label_hashes
+    expected = index.density_features()
+    np.testing.assert_allclose(density.read(expected.columns).values, expected.values, rtol=1e-6)
+
+    csv_path = str(tmp_path / 'sample.csv')
+    pd.DataFrame({'x': x, 'y': y}).to_csv(csv_path, index=False)
+    build_index(csv_path)
+    pd.testing.assert_frame_equal(pd.read_csv(density_path(csv_path)), expected)
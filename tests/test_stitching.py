@@ -0,0 +1,88 @@
+"""
+Seam stitching of data_tools.restore_tiles against stacking the tiles and against labelling the whole mask.
+"""
+import cv2 as cv
+import numpy as np
+import pytest
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from data_tools import get_x_and_y, restore_tiles, split_image
+from stitching import merge_labels, overlap_label_pairs
+
+
+def nuclei_mask(shape, nuclei, seed=0):
+    rng = np.random.RandomState(seed)
+    mask = np.zeros(shape, dtype=np.uint8)
+    for x, y, r in zip(rng.randint(0, shape[1], nuclei), rng.randint(0, shape[0], nuclei), rng.randint(3, 8, nuclei)):
+        cv.circle(mask, (int(x), int(y)), int(r), 1, -1)
+    return mask
+
+
+def label_tiles(mask, halo, x_tiles=3, y_tiles=2):
+    tiles, tile_names = split_image(mask, x_tiles_cnt=x_tiles, y_tiles_cnt=y_tiles, halo=halo)
+    return [cv.connectedComponents(tile)[1].astype(np.uint16) for tile in tiles], tile_names
+
+
+def stack_tiles(tiles, tile_names):
+    # labels of every tile shifted by the largest label so far, row by row, and stacked
+    tiles = dict(zip([get_x_and_y(n) for n in tile_names], tiles))
+    x_max, y_max = np.array(list(tiles)).max(axis=0)
+    max_number = 0
+    for coords in sorted(tiles, key=lambda c: c[::-1]):
+        tile = tiles[coords].astype(np.uint32)
+        tiles[coords] = (tile + max_number) * (tile > 0)
+        max_number = max(max_number, int(tiles[coords].max()))
+    return np.vstack([np.hstack([tiles[(x, y)] for x in range(x_max + 1)]) for y in range(y_max + 1)])
+
+
+def same_partition(a, b):
+    # a one to one map between the labels of a and b
+    pairs = np.unique(np.stack([a.ravel(), b.ravel()]), axis=1)
+    return len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == pairs.shape[1]
+
+
+def test_restore_without_halo_matches_stacked_tiles():
+    tiles, tile_names = label_tiles(nuclei_mask((300, 400), 150), halo=0)
+    expected = stack_tiles(tiles, tile_names)
+    np.testing.assert_array_equal(restore_tiles(tiles, tile_names, tiff=True), expected)
+    # streamed tiles in split_image order are numbered differently, but cut the same nuclei
+    restored = restore_tiles(iter(tiles), tile_names, tiff=True, shapes=[t.shape for t in tiles])
+    assert same_partition(restored, expected)
+
+
+@pytest.mark.parametrize('halo', [8, 16])
+def test_nuclei_cut_by_seams_are_merged(halo):
+    mask = nuclei_mask((300, 400), 150)
+    # a nucleus on the corner of four tiles and one on a vertical seam
+    cv.circle(mask, (133, 150), 6, 1, -1)
+    cv.circle(mask, (266, 60), 7, 1, -1)
+    restored = restore_tiles(*label_tiles(mask, halo), tiff=True, halo=halo)
+    n, expected = cv.connectedComponents(mask)
+    assert restored.shape == mask.shape
+    assert same_partition(restored, expected)
+    np.testing.assert_array_equal(np.unique(restored), np.arange(n))
+    for x, y in [(133, 150), (266, 60)]:
+        assert (restored == restored[y, x]).sum() == (expected == expected[y, x]).sum()
+
+
+def test_overlap_label_pairs():
+    a = np.array([[1, 1, 0, 2],
+                  [1, 1, 0, 2]])
+    b = np.array([[5, 0, 0, 6],
+                  [5, 0, 7, 6]])
+    np.testing.assert_array_equal(overlap_label_pairs(a, b), [[1, 5], [2, 6]])
+    assert overlap_label_pairs(a, np.zeros_like(b)).shape == (0, 2)
+
+
+def test_merge_labels_matches_connected_components():
+    rng = np.random.RandomState(0)
+    n_labels = 500
+    pairs = rng.randint(1, n_labels + 1, (300, 2))
+    lut = merge_labels(pairs, n_labels)
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n_labels + 1, n_labels + 1))
+    _, components = connected_components(graph, directed=False)
+    smallest = {}
+    for label, component in enumerate(components):
+        smallest.setdefault(component, label)
+    np.testing.assert_array_equal(lut, [smallest[c] for c in components])
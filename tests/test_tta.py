@@ -0,0 +1,42 @@
+"""
+tta.predict_tta on torch tensors against numpy arrays, and against the mean over single transforms.
+"""
+import numpy as np
+import pytest
+
+from tta import POLICIES, TRANSFORMS, augment, deaugment, predict_tta
+
+torch = pytest.importorskip('torch')
+
+
+def conv(x):
+    # not equivariant to flips, so every transform gives another prediction
+    weight = torch.arange(18, dtype=torch.float32).reshape(2, 1, 3, 3) - 8
+    return torch.sigmoid(torch.nn.functional.conv2d(x, weight, padding=1))
+
+
+@pytest.mark.parametrize('policy', sorted(POLICIES))
+@pytest.mark.parametrize('shape', [(2, 1, 16, 16), (2, 1, 12, 20)])
+def test_tensors_match_arrays(policy, shape):
+    batch = torch.rand(*shape, generator=torch.Generator().manual_seed(0))
+    calls = []
+
+    def predict(x):
+        calls.append(type(x))
+        return conv(x)
+
+    mean = predict_tta(predict, batch, policy, axes=(2, 3))
+    assert isinstance(mean, torch.Tensor) and set(calls) == {torch.Tensor}
+    expected = predict_tta(lambda x: conv(torch.from_numpy(np.ascontiguousarray(x))).numpy(), batch.numpy(), policy,
+                           axes=(2, 3))
+    np.testing.assert_allclose(mean.numpy(), expected, rtol=1e-6, atol=1e-6)
+    single = [deaugment(conv(augment(batch, t, (2, 3))), t, (2, 3)) for t in POLICIES[policy]]
+    np.testing.assert_allclose(mean.numpy(), torch.stack(single).mean(0).numpy(), rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize('transform', list(TRANSFORMS))
+def test_deaugment_inverts_augment(transform):
+    batch = torch.rand(2, 3, 12, 20)
+    np.testing.assert_array_equal(deaugment(augment(batch, transform, (2, 3)), transform, (2, 3)), batch)
+    np.testing.assert_array_equal(augment(batch, transform, (2, 3)).numpy(),
+                                  augment(batch.numpy(), transform, (2, 3)))
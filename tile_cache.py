@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+_file_hashes = {}
+
+
+def array_hash(arr):
+    """
+    Content hash of an array, shape and dtype included.
+    """
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.sha1(f'{arr.shape}{arr.dtype}'.encode())
+    h.update(arr.data)
+    return h.hexdigest()
+
+
+def file_hash(path):
+    """
+    Content hash of a file, remembered while the file size and modification time do not change.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                h.update(chunk)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def model_key(name, weights, tta):
+    """
+    Identifies the output of a predictor.
+
+    Parameters
+    ----------
+    name : str
+        Model id, the output folder name of the predictor.
+    weights : list
+        Paths to weights of all folds.
+    tta : dict
+        Test time augmentation and any other option changing the output.
+
+    Returns
+    -------
+    key : str
+    """
+    h = hashlib.sha1(name.encode())
+    for path in weights:
+        h.update(file_hash(path).encode())
+    h.update(json.dumps(tta, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def entry_key(tile_hash, model):
+    """
+    Cache key of one tile predicted by one model, see array_hash and model_key.
+    """
+    return hashlib.sha1(f'{tile_hash}:{model}'.encode()).hexdigest()
+
+
+class TileCache:
+    """
+    Persistent cache of per-model predictions keyed by tile content and model.
+    Entries are .npy files in cache_dir, the least recently used ones are deleted when
+    the cache grows over max_bytes. Several processes may share a directory, entries are
+    written atomically and every process evicts only entries it knows about.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Full path to the cache directory.
+    max_bytes : int
+        Size limit of the cache.
+    """
+
+    def __init__(self, cache_dir, max_bytes=20 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = [e for e in os.scandir(cache_dir) if e.name.endswith('.npy')]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        self._entries = OrderedDict((e.name[:-4], e.stat().st_size) for e in entries)
+        self._size = sum(self._entries.values())
+        self.reset_stats()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def get(self, key, model=None):
+        """
+        Returns the cached array or None. model is used only for the statistics.
+        """
+        path = self._path(key)
+        try:
+            arr = np.load(path)
+        except (OSError, ValueError):
+            self._size -= self._entries.pop(key, 0)
+            self.stats[model][1] += 1
+            return None
+        os.utime(path)
+        size = os.path.getsize(path)
+        self._size += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        self.stats[model][0] += 1
+        return arr
+
+    def put(self, key, arr):
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp_path, self._path(key))
+        size = os.path.getsize(self._path(key))
+        self._size += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def reset_stats(self):
+        self.stats = defaultdict(lambda: [0, 0])
+
+    def report(self):
+        """
+        Hit/miss statistics since the last reset_stats, one line per model.
+        """
+        lines = [f'{"model":<32}{"hits":>8}{"misses":>8}']
+        for model, (hits, misses) in sorted(self.stats.items(), key=lambda x: str(x[0])):
+            lines.append(f'{str(model):<32}{hits:>8}{misses:>8}')
+        hits, misses = [sum(s[i] for s in self.stats.values()) for i in range(2)]
+        lines.append(f'{"total":<32}{hits:>8}{misses:>8}')
+        lines.append(f'cache size {self._size / 2 ** 20:.1f} MB in {len(self._entries)} entries')
+        return '\n'.join(lines)
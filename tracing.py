@@ -0,0 +1,188 @@
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict
+
+# spans of subprocesses (predict_test.sh, victor and albu scripts) are appended to the file named here
+TRACE_ENV = 'SEGMENTATION_TRACE'
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def _rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _io():
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class Tracer:
+    """
+    Collects named spans with wall time, CPU time (own and of finished subprocesses), peak RSS
+    and bytes read/written by this process. Spans can be nested and used from several threads.
+    Subprocesses report their own spans when they use the same trace file.
+    Nothing is recorded until the tracer is enabled.
+
+    Parameters
+    ----------
+    path : str
+        JSON lines file every finished span is appended to, several processes may share it.
+    interval : float
+        RSS sampling period of open spans, seconds.
+    """
+
+    def __init__(self, path=None, interval=0.05):
+        self.path = path
+        self.enabled = path is not None
+        self.interval = interval
+        self.spans = []
+        self._open = []
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def enable(self, path=None):
+        self.path = path
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            rss = _rss()
+            with self._lock:
+                for record in self._open:
+                    record['peak_rss_mb'] = max(record['peak_rss_mb'], rss / 2 ** 20)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """
+        Records the enclosed block. The yielded dict can be used to add arguments: span['args']['tiles'] = 10.
+        """
+        if not self.enabled:
+            yield {'args': args}
+            return
+
+        rss = _rss()
+        read, written = _io()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record = {'name': name, 'pid': os.getpid(), 'tid': threading.get_ident(), 'start': time.time(),
+                  'peak_rss_mb': rss / 2 ** 20, 'args': args}
+        with self._lock:
+            record['depth'] = sum(r['tid'] == record['tid'] for r in self._open)
+            self._open.append(record)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - wall
+            record['cpu_s'] = time.process_time() - cpu
+            children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record['children_cpu_s'] = (children_end.ru_utime + children_end.ru_stime
+                                        - children.ru_utime - children.ru_stime)
+            read_end, written_end = _io()
+            record['read_mb'] = (read_end - read) / 2 ** 20
+            record['written_mb'] = (written_end - written) / 2 ** 20
+            with self._lock:
+                record['peak_rss_mb'] = max(record['peak_rss_mb'], _rss() / 2 ** 20)
+                self._open.remove(record)
+                self.spans.append(record)
+            if self.path is not None:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+
+_tracer = Tracer(os.environ.get(TRACE_ENV))
+
+
+def get_tracer():
+    return _tracer
+
+
+def span(name, **args):
+    """
+    Span of the process-wide tracer, see Tracer.span.
+    """
+    return _tracer.span(name, **args)
+
+
+def enable(path=None):
+    """
+    Starts recording spans of this process. With a path the spans are appended to it, and
+    subprocesses started afterwards (predict_test.sh and the scripts it runs) append theirs too.
+    """
+    if path is not None:
+        path = os.path.abspath(path)
+        os.environ[TRACE_ENV] = path
+    _tracer.enable(path)
+
+
+def load(path):
+    """
+    Spans from a file written by an enabled tracer.
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_json(spans, path):
+    with open(path, 'w') as f:
+        json.dump(spans, f, indent=1)
+
+
+def save_chrome_trace(spans, path):
+    """
+    Saves spans in the Chrome trace event format, open it in chrome://tracing or https://ui.perfetto.dev.
+    """
+    t0 = min([s['start'] for s in spans], default=0)
+    events = []
+    for s in spans:
+        args = dict(s['args'])
+        args.update({k: round(s[k], 3) for k in ['cpu_s', 'children_cpu_s', 'peak_rss_mb', 'read_mb', 'written_mb']})
+        events.append({'name': s['name'], 'ph': 'X', 'pid': s['pid'], 'tid': s['tid'],
+                       'ts': (s['start'] - t0) * 1e6, 'dur': s['wall_s'] * 1e6, 'args': args})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def summary(spans):
+    """
+    Totals per span name: count, wall and CPU time, maximal peak RSS and bytes read/written.
+
+    Returns
+    -------
+    table : str
+    """
+    totals = OrderedDict()
+    for s in sorted(spans, key=lambda s: s['start']):
+        t = totals.setdefault(s['name'], {'count': 0, 'wall_s': 0, 'cpu_s': 0, 'peak_rss_mb': 0,
+                                          'read_mb': 0, 'written_mb': 0})
+        t['count'] += 1
+        t['wall_s'] += s['wall_s']
+        t['cpu_s'] += s['cpu_s'] + s['children_cpu_s']
+        t['peak_rss_mb'] = max(t['peak_rss_mb'], s['peak_rss_mb'])
+        t['read_mb'] += s['read_mb']
+        t['written_mb'] += s['written_mb']
+    lines = [f'{"span":<36}{"count":>7}{"wall, s":>10}{"cpu, s":>10}{"peak rss, MB":>14}{"read, MB":>10}'
+             f'{"written, MB":>13}']
+    for name, t in totals.items():
+        lines.append(f'{name:<36}{t["count"]:>7}{t["wall_s"]:>10.2f}{t["cpu_s"]:>10.2f}{t["peak_rss_mb"]:>14.1f}'
+                     f'{t["read_mb"]:>10.1f}{t["written_mb"]:>13.1f}')
+    return '\n'.join(lines)
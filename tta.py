@@ -0,0 +1,169 @@
+from collections import OrderedDict
+
+import numpy as np
+
+# dihedral transforms as (upside down flip, counterclockwise quarter turns applied after it)
+TRANSFORMS = OrderedDict([('identity', (False, 0)), ('rot90', (False, 1)), ('rot180', (False, 2)),
+                          ('rot270', (False, 3)), ('flip', (True, 0)), ('flip_rot90', (True, 1)),
+                          ('flip_rot180', (True, 2)), ('flip_rot270', (True, 3))])
+
+# named sets of transforms: 'flips' are the left-right, upside down and both flips of albu (flips=2),
+# 'd4' all eight rotations and flips
+POLICIES = {'none': ['identity'],
+            'lr': ['identity', 'flip_rot180'],
+            'flips': ['identity', 'flip_rot180', 'flip', 'rot180'],
+            'd4': list(TRANSFORMS)}
+
+
+def policy_transforms(transforms):
+    """
+    Transform names of a policy name or a list of transform names.
+    """
+    if isinstance(transforms, str):
+        if transforms not in POLICIES:
+            raise ValueError(f'Unknown TTA policy {transforms}, use one of {sorted(POLICIES)}')
+        return list(POLICIES[transforms])
+    unknown = [t for t in transforms if t not in TRANSFORMS]
+    if unknown or not transforms:
+        raise ValueError(f'Unknown TTA transforms {unknown}, use some of {list(TRANSFORMS)}')
+    return list(transforms)
+
+
+class TTAPolicy:
+    """
+    Test time augmentation of one model: the dihedral transforms applied to every network input
+    and the scales the image is resized to. A prediction costs len(transforms) * len(scales)
+    forward passes of every fold.
+
+    Parameters
+    ----------
+    transforms : str or list
+        Name from POLICIES or names from TRANSFORMS.
+    scales : list
+        Resize factors of the image, 1 is the original size.
+    """
+
+    def __init__(self, transforms='none', scales=(1,)):
+        self.transforms = policy_transforms(transforms)
+        self.scales = list(scales)
+        if not self.scales:
+            raise ValueError('TTA policy without scales')
+
+    @property
+    def cost(self):
+        return len(self.transforms) * len(self.scales)
+
+    def key(self):
+        """
+        Settings that differ from no augmentation, for cache keys of the predictions.
+        """
+        key = {}
+        if self.transforms != ['identity']:
+            key['transforms'] = self.transforms
+        if self.scales != [1]:
+            key['scales'] = self.scales
+        return key
+
+    def __repr__(self):
+        return f'TTAPolicy({self.transforms}, scales={self.scales})'
+
+
+def get_policy(tta=None, scales=(1,)):
+    """
+    Parameters
+    ----------
+    tta : TTAPolicy, str or list
+        A policy, or the transforms of a policy with the given scales. No augmentation if None.
+    scales : list
+        Scales of the policy if tta is not a TTAPolicy.
+
+    Returns
+    -------
+    policy : TTAPolicy
+    """
+    if isinstance(tta, TTAPolicy):
+        return tta
+    return TTAPolicy('none' if tta is None else tta, scales)
+
+
+# numpy arrays are transformed with strided views, torch tensors with torch.flip and torch.rot90 on their device,
+# so tta.py does not need torch
+def _flip(batch, axis):
+    return np.flip(batch, axis) if isinstance(batch, np.ndarray) else batch.flip([axis])
+
+
+def _rot90(batch, k, axes):
+    return np.rot90(batch, k, axes) if isinstance(batch, np.ndarray) else batch.rot90(k, list(axes))
+
+
+def _concatenate(batches):
+    if isinstance(batches[0], np.ndarray):
+        return np.concatenate(batches)
+    import torch
+    return torch.cat(batches)
+
+
+def _accumulator(pred):
+    # a float32 or float64 copy
+    if isinstance(pred, np.ndarray):
+        return pred.astype(np.promote_types(pred.dtype, np.float32))
+    import torch
+    return pred.to(torch.float64 if pred.dtype == torch.float64 else torch.float32, copy=True)
+
+
+def augment(batch, transform, axes=(1, 2)):
+    flip, k = TRANSFORMS[transform]
+    if flip:
+        batch = _flip(batch, axes[0])
+    return _rot90(batch, k, axes)
+
+
+def deaugment(batch, transform, axes=(1, 2)):
+    flip, k = TRANSFORMS[transform]
+    batch = _rot90(batch, -k, axes)
+    if flip:
+        batch = _flip(batch, axes[0])
+    return batch
+
+
+def predict_tta(predict, batch, transforms='none', axes=(1, 2)):
+    """
+    Mean prediction of a batch over dihedral transforms. All transforms that give inputs of the same shape
+    (all of them for square inputs, the even and the odd quarter turns otherwise) are stacked and passed
+    to predict at once. Outputs are transformed back and added to a running sum right away, so only the
+    outputs of one call are kept besides the sum.
+
+    Parameters
+    ----------
+    predict : callable
+        Takes stacked inputs and returns stacked outputs of the same type with the same spatial axes.
+    batch : numpy ndarray or torch Tensor
+        Stacked inputs. Tensors stay on their device, predict gets and returns tensors and so does predict_tta.
+    transforms : str or list
+        Name from POLICIES or names from TRANSFORMS.
+    axes : tuple
+        Spatial (row, column) axes of inputs and outputs, (2, 3) for NCHW batches.
+
+    Returns
+    -------
+    mean : numpy ndarray or torch Tensor
+        At least float32.
+    """
+    transforms = policy_transforms(transforms)
+    square = batch.shape[axes[0]] == batch.shape[axes[1]]
+    groups = OrderedDict()
+    for t in transforms:
+        groups.setdefault(0 if square else TRANSFORMS[t][1] % 2, []).append(t)
+    n = len(batch)
+    total = None
+    for group in groups.values():
+        preds = predict(_concatenate([augment(batch, t, axes) for t in group]))
+        for i, t in enumerate(group):
+            pred = deaugment(preds[i * n:(i + 1) * n], t, axes)
+            if total is None:
+                total = _accumulator(pred)
+            else:
+                total += pred
+    if len(transforms) > 1:
+        total /= len(transforms)
+    return total